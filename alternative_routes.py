@@ -0,0 +1,84 @@
+import time
+import numpy as np
+
+
+def tree_path(tree_edges, next_nodes, node, root):
+    """
+    Edges from node to the root of a shortest path tree, given the tree edge of every node and the node it reaches
+    """
+    path_edges = []
+    while node != root:
+        path_edges.append(tree_edges[node])
+        node = next_nodes[tree_edges[node]]
+    return path_edges
+
+
+def alternative_paths(graph, source, target, weight='distance', k=2, max_overlap=0.6, max_stretch=1.4):
+    """
+    Up to k meaningfully different paths between two dense node indices, with the via-node method: one shortest
+    path tree from the source and one towards the target give, for every node v, the shortest path through v.
+    The candidate nodes are tried by increasing cost of their path, at most max_stretch times the shortest one,
+    and a path is kept if it has no loops and shares at most max_overlap of its distance with each path already
+    kept. The nodes of the tried paths are not tried again, as their paths are mostly the same.
+    Returns the cost and the edges of the paths, the shortest path first.
+    """
+    forward_cost, predecessors = graph.one_to_all(source, weight)
+    backward_cost, successors = graph.one_to_all(target, weight, reverse=True)
+    if not np.isfinite(forward_cost[target]):
+        return []
+    parent_edges = graph.tree_edges(predecessors, weight).tolist()
+    next_edges = graph.tree_edges(successors, weight, reverse=True).tolist()
+    edge_sources, edge_targets = graph.edge_sources.tolist(), graph._indices
+
+    distance = graph.attributes['distance'].astype(np.float64)
+    shortest = tree_path(parent_edges, edge_sources, target, source)[::-1]
+    paths = [(float(forward_cost[target]), shortest)]
+    kept_edges = [set(shortest)]
+
+    via_cost = forward_cost + backward_cost
+    candidates = np.flatnonzero(via_cost <= forward_cost[target] * max_stretch)
+    candidates = candidates[np.argsort(via_cost[candidates], kind='stable')].tolist()
+
+    tried = np.zeros(graph.node_count, dtype=bool)
+    tried[graph.indices[shortest]] = True
+
+    for via in candidates:
+        if len(paths) >= k:
+            break
+        if tried[via]:
+            continue
+
+        path_edges = tree_path(parent_edges, edge_sources, via, source)[::-1] + \
+            tree_path(next_edges, edge_targets, via, target)
+        nodes = np.concatenate(([source], graph.indices[path_edges]))
+        tried[nodes] = True
+        if len(np.unique(nodes)) < len(nodes):
+            # The paths to and from the via node cross each other
+            continue
+
+        path_distance = distance[path_edges].sum()
+        edges = set(path_edges)
+        if all(distance[list(edges & kept)].sum() <= max_overlap * path_distance for kept in kept_edges):
+            paths.append((float(via_cost[via]), path_edges))
+            kept_edges.append(edges)
+
+    return paths
+
+
+def alternative_routes(graph, source, target, weight='distance', k=2, max_overlap=0.6, max_stretch=1.4):
+    """
+    Alternative routes between two RoadJunction ids, with the same result of routing_path:
+    the execution time followed by the description of every route
+    """
+    start_time = time.time()
+
+    source_index, target_index = graph.index_of(source), graph.index_of(target)
+    if source_index is None or target_index is None:
+        return {'error': 'No path found'}
+
+    paths = alternative_paths(graph, source_index, target_index, weight, k, max_overlap, max_stretch)
+    if len(paths) == 0:
+        return {'error': 'No path found'}
+
+    return [time.time() - start_time] + [graph.path_result(source, target, cost, path_edges)
+                                         for cost, path_edges in paths]
@@ -0,0 +1,218 @@
+import sys
+import json
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from graph_bridge import combined_weight_ratios
+from routing_engine import RoutingGraph
+from spatial_index import SpatialIndex
+from geojson_writer import GeoJSONWriter
+
+# Graph of the worker processes, sent once when the pool starts
+_worker_graph = None
+
+
+def _init_worker(graph):
+    global _worker_graph
+    _worker_graph = graph
+
+
+def tree_paths(graph, predecessors, source, targets, weight='distance'):
+    """
+    Distance, PM10 exposure and edges of the paths from the source to the targets in the shortest path tree
+    rooted in source. Each node of the tree is visited once for all the targets: the walk back from a target
+    stops at the first node already reached from another target.
+    Returns a dictionary target -> (distance, pm10_metre, parent edge) for the reachable targets.
+    """
+    distance, pm10_metre = graph.attributes['distance'], graph.attributes['pm10_metre']
+    totals = {source: (0.0, 0.0, -1)}
+
+    for target in targets:
+        chain = []
+        node = target
+        while node not in totals and predecessors[node] >= 0:
+            chain.append(node)
+            node = predecessors[node]
+        if node not in totals:
+            # Not reachable from the source
+            continue
+
+        total_distance, total_pm10_metre, _ = totals[node]
+        for node in reversed(chain):
+            edge = graph.lightest_edge(predecessors[node], node, weight)
+            total_distance += float(distance[edge])
+            total_pm10_metre += float(pm10_metre[edge])
+            totals[node] = (total_distance, total_pm10_metre, edge)
+
+    return totals
+
+
+def tree_path_edges(graph, totals, source, target):
+    """
+    Edges of the path from source to target, following the parent edges found by tree_paths
+    """
+    path_edges = []
+    node = target
+    while node != source:
+        edge = totals[node][2]
+        path_edges.append(edge)
+        node = int(graph.edge_sources[edge])
+    path_edges.reverse()
+    return path_edges
+
+
+def source_rows(graph, sources, targets, weight='distance', with_paths=False):
+    """
+    Rows of the cost, distance and PM10 exposure matrices for the given source node indices,
+    with a single one-to-all search for each source
+    """
+    costs, predecessors = graph.one_to_all(sources, weight)
+    costs, predecessors = np.atleast_2d(costs), np.atleast_2d(predecessors)
+    target_indices = [target for target in targets if target is not None]
+
+    cost_rows = np.full((len(sources), len(targets)), np.inf)
+    distance_rows = np.full((len(sources), len(targets)), np.nan)
+    pm10_rows = np.full((len(sources), len(targets)), np.nan)
+    path_rows = []
+
+    for i, source in enumerate(sources):
+        totals = tree_paths(graph, predecessors[i].tolist(), source, target_indices, weight)
+
+        paths = []
+        for j, target in enumerate(targets):
+            if target is None or target not in totals:
+                paths.append(None)
+                continue
+
+            cost_rows[i, j] = costs[i, target]
+            distance_rows[i, j], pm10_rows[i, j], _ = totals[target]
+            if with_paths:
+                path_edges = tree_path_edges(graph, totals, source, target)
+                paths.append(graph.path_result(graph.node_ids[source], graph.node_ids[target], costs[i, target],
+                                               path_edges))
+        path_rows.append(paths if with_paths else None)
+
+    return cost_rows, distance_rows, pm10_rows, path_rows
+
+
+def _source_rows_chunk(sources, targets, weight, with_paths):
+    return source_rows(_worker_graph, sources, targets, weight, with_paths)
+
+
+def route_matrix(graph, source_ids, target_ids, weight='distance', with_paths=False, workers=1, chunk_size=64):
+    """
+    Many-to-many routing between lists of RoadJunction ids: one shortest path tree is computed for every distinct
+    source and used for all the targets. Returns the cost, distance and PM10 exposure (pm10_metre) matrices,
+    with a row for every source and a column for every target, and optionally the paths (with the fields of the
+    paths returned by routing_path). Unreachable or unknown pairs have an infinite cost and no distance.
+    The sources are split in chunks of chunk_size searches, spread across processes when workers > 1.
+    """
+    start_time = time.time()
+
+    source_indices = [graph.index_of(source_id) for source_id in source_ids]
+    target_indices = [graph.index_of(target_id) for target_id in target_ids]
+    distinct_sources = sorted({source for source in source_indices if source is not None})
+    chunks = [distinct_sources[start:start + chunk_size] for start in range(0, len(distinct_sources), chunk_size)]
+
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(graph,)) as executor:
+            futures = [executor.submit(_source_rows_chunk, chunk, target_indices, weight, with_paths)
+                       for chunk in chunks]
+            results = [future.result() for future in futures]
+    else:
+        results = [source_rows(graph, chunk, target_indices, weight, with_paths) for chunk in chunks]
+
+    # Rows of the distinct sources, then one row for every requested source
+    row_of = {}
+    for chunk, result in zip(chunks, results):
+        for i, source in enumerate(chunk):
+            row_of[source] = (result, i)
+
+    cost = np.full((len(source_ids), len(target_ids)), np.inf)
+    distance = np.full((len(source_ids), len(target_ids)), np.nan)
+    pm10_metre = np.full((len(source_ids), len(target_ids)), np.nan)
+    paths = [] if with_paths else None
+    for k, source in enumerate(source_indices):
+        if source is None:
+            if with_paths:
+                paths.append([None] * len(target_ids))
+            continue
+        (cost_rows, distance_rows, pm10_rows, path_rows), i = row_of[source]
+        cost[k], distance[k], pm10_metre[k] = cost_rows[i], distance_rows[i], pm10_rows[i]
+        if with_paths:
+            paths.append(path_rows[i])
+
+    return {'sources': list(source_ids), 'targets': list(target_ids), 'weight': weight, 'cost': cost,
+            'distance': distance, 'pm10_metre': pm10_metre, 'paths': paths,
+            'searches': len(distinct_sources), 'elapsed_time': time.time() - start_time}
+
+
+def save_matrix(result, file_name):
+    """
+    Save the matrices of route_matrix in a npz file, with the ids of the sources and of the targets
+    """
+    np.savez(file_name, sources=np.asarray(result['sources'], dtype=str),
+             targets=np.asarray(result['targets'], dtype=str), cost=result['cost'], distance=result['distance'],
+             pm10_metre=result['pm10_metre'])
+    print(f"Routing matrices saved at {file_name}")
+
+
+def save_paths(result, file_name, precision=6, tolerance=0.0, ndjson=False):
+    """
+    Save the paths of route_matrix in a single GeoJSON file, streamed one feature at a time,
+    with the row and the column of every path in the matrices
+    """
+    found = [(row, column) for row, paths in enumerate(result['paths'])
+             for column, path in enumerate(paths) if path is not None]
+    with GeoJSONWriter(file_name, precision, tolerance, ndjson) as writer:
+        writer.write_paths([result['paths'][row][column] for row, column in found], result['weight'],
+                           [{'row': row, 'column': column} for row, column in found])
+    print(f"{writer.count} paths saved at {file_name}")
+
+
+def main(config, routing_query):
+    batch = routing_query['batch']
+
+    # Neo4j is read only without a graph snapshot
+    graph = RoutingGraph.load(config)
+
+    weight = routing_query['weight']
+    if weight == 'combined_weight':
+        weight = graph.combined_weight(**combined_weight_ratios(routing_query['combined_weight']))
+
+    ids = {'source': batch.get('source_ids', []), 'destination': batch.get('destination_ids', [])}
+    if 'source_coordinates' in batch or 'destination_coordinates' in batch:
+        # Points given as [lon, lat], snapped all together; the ones without a junction near them are unreachable
+        index = SpatialIndex.from_graph(graph)
+        for field in ids:
+            if f'{field}_coordinates' in batch:
+                points = np.asarray(batch[f'{field}_coordinates'], dtype=np.float64).reshape(-1, 2)
+                ids[field] = index.snap(points[:, 0], points[:, 1], routing_query.get('snap', 'node'),
+                                        routing_query.get('snap_max_distance') or np.inf).tolist()
+
+    result = route_matrix(graph, ids['source'], ids['destination'], weight,
+                          batch.get('paths', False), batch.get('workers', 1))
+    print(f"{result['searches']} searches for {len(result['sources'])}x{len(result['targets'])} pairs "
+          f"in {result['elapsed_time']:.2f} s")
+
+    suffix = f"{routing_query['weight']}_{routing_query['path_file_suffix']}"
+    save_matrix(result, f"output/routing/matrix_{suffix}.npz")
+    if result['paths'] is not None:
+        geojson = routing_query.get('geojson', {})
+        extension = 'ndjson' if geojson.get('ndjson', False) else 'geojson'
+        save_paths(result, f"output/routing/matrix_paths_{suffix}.{extension}", geojson.get('precision', 6),
+                   geojson.get('simplify_tolerance', 0.0), geojson.get('ndjson', False))
+    return result
+
+
+if __name__ == "__main__":
+    with open("data/config.json", "r") as file:
+        config_file = json.load(file)
+    with open("data/routing_query.json", "r") as file:
+        query = json.load(file)
+
+    try:
+        main(config_file, query)
+    except Exception as e:
+        print(e)
+        sys.exit(1)
@@ -0,0 +1,375 @@
+import os
+import copy
+import time
+import hashlib
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from routing_engine import WEIGHT_PROPERTIES
+
+# Arrays of the metric independent part of the hierarchy, saved to disk
+TOPOLOGY_ARRAYS = ['rank', 'parent', 'arc_ptr', 'arc_tail', 'arc_head', 'triangle_vu', 'triangle_vw', 'triangle_uw',
+                   'level_ptr', 'triangle_order', 'triangle_ptr', 'edge_arc', 'edge_forward']
+
+
+def topology_key(graph):
+    """
+    Hash of the nodes and of the edges of the graph, the hierarchy is valid as long as it does not change
+    """
+    digest = hashlib.sha1()
+    digest.update('\n'.join(map(str, graph.node_ids.tolist())).encode())
+    digest.update(np.ascontiguousarray(graph.indptr).tobytes())
+    digest.update(np.ascontiguousarray(graph.indices).tobytes())
+    return digest.hexdigest()
+
+
+def undirected_adjacency(graph):
+    """
+    Symmetric adjacency matrix of the graph, without self loops and parallel edges
+    """
+    n = graph.node_count
+    adjacency = sparse.coo_matrix((np.ones(graph.edge_count, dtype=np.int8), (graph.edge_sources, graph.indices)),
+                                  shape=(n, n)).tocsr()
+    adjacency = ((adjacency + adjacency.T) > 0).astype(np.int8).tolil()
+    adjacency.setdiag(0)
+    adjacency = adjacency.tocsr()
+    adjacency.eliminate_zeros()
+    return adjacency
+
+
+def nested_dissection_order(graph, adjacency, leaf_size=32):
+    """
+    Metric independent order of the nodes by geometric nested dissection: every cell is split in two halves at
+    the median longitude or latitude, and the nodes separating the halves come after all the nodes of both halves.
+    Cells with at most leaf_size nodes are ordered by degree.
+    """
+    x = np.nan_to_num(graph.lon * np.cos(np.radians(np.nan_to_num(graph.lat))))
+    y = np.nan_to_num(graph.lat)
+    degree = np.diff(adjacency.indptr)
+    label = np.zeros(graph.node_count, dtype=np.int8)
+    order = []
+
+    def dissect(nodes):
+        if len(nodes) > leaf_size:
+            coordinates = x[nodes] if np.ptp(x[nodes]) >= np.ptp(y[nodes]) else y[nodes]
+        if len(nodes) <= leaf_size or np.ptp(coordinates) == 0:
+            order.extend(nodes[np.argsort(degree[nodes], kind='stable')].tolist())
+            return
+
+        nodes = nodes[np.argsort(coordinates, kind='stable')]
+        part_a, part_b = nodes[:len(nodes) // 2], nodes[len(nodes) // 2:]
+
+        # Edges between the two halves, the other nodes of the graph are already ordered
+        label[part_b] = 1
+        rows = adjacency[part_a]
+        tails = np.repeat(part_a, np.diff(rows.indptr))
+        cut = label[rows.indices] == 1
+        label[part_b] = 0
+
+        # The smaller set of endpoints of the cut edges separates the halves
+        separator_a, separator_b = np.unique(tails[cut]), np.unique(rows.indices[cut])
+        if len(separator_a) <= len(separator_b):
+            separator, part_a = separator_a, np.setdiff1d(part_a, separator_a, assume_unique=True)
+        else:
+            separator, part_b = separator_b, np.setdiff1d(part_b, separator_b, assume_unique=True)
+
+        dissect(part_a)
+        dissect(part_b)
+        order.extend(separator.tolist())
+
+    dissect(np.arange(graph.node_count))
+    return np.asarray(order, dtype=np.int64)
+
+
+def build_topology(graph, leaf_size=32):
+    """
+    Metric independent part of the customizable contraction hierarchy: the node order, the upward arcs of the
+    chordal supergraph (arcs go from lower to higher rank, in rank space), the elimination tree, the lower
+    triangles of every arc grouped by level for the customization, and the arc of every edge of the graph
+    """
+    n = graph.node_count
+    adjacency = undirected_adjacency(graph)
+    order = nested_dissection_order(graph, adjacency, leaf_size)
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+
+    # Chordal completion along the elimination order, the parent in the elimination tree is the lowest upper neighbour
+    pairs = adjacency.tocoo()
+    tails, heads = rank[pairs.row], rank[pairs.col]
+    upper = tails < heads
+    up = [set() for _ in range(n)]
+    for tail, head in zip(tails[upper].tolist(), heads[upper].tolist()):
+        up[tail].add(head)
+
+    parent = np.full(n, -1, dtype=np.int64)
+    for v in range(n):
+        if up[v]:
+            p = min(up[v])
+            parent[v] = p
+            up[p].update(up[v])
+            up[p].discard(p)
+
+    arc_ptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum([len(neighbours) for neighbours in up], out=arc_ptr[1:])
+    arc_head = np.fromiter((head for neighbours in up for head in sorted(neighbours)), dtype=np.int64,
+                           count=arc_ptr[-1])
+    arc_tail = np.repeat(np.arange(n), np.diff(arc_ptr))
+    arc_keys = arc_tail * n + arc_head
+
+    # Lower triangles: v < u < w with arcs (v, u), (v, w) and (u, w)
+    triangle_vu, triangle_vw, triangle_uw = [], [], []
+    for v in range(n):
+        start, stop = arc_ptr[v], arc_ptr[v + 1]
+        if stop - start < 2:
+            continue
+        i, j = np.triu_indices(stop - start, 1)
+        triangle_vu.append(start + i)
+        triangle_vw.append(start + j)
+        triangle_uw.append(np.searchsorted(arc_keys, arc_head[start + i] * n + arc_head[start + j]))
+    triangle_vu, triangle_vw, triangle_uw = [np.concatenate(t).astype(np.int32) if t else np.zeros(0, dtype=np.int32)
+                                             for t in (triangle_vu, triangle_vw, triangle_uw)]
+
+    # Height in the elimination tree: the arcs of a node only depend on triangles of lower levels
+    height = np.zeros(n, dtype=np.int64)
+    for v in range(n):
+        if parent[v] >= 0:
+            height[parent[v]] = max(height[parent[v]], height[v] + 1)
+    levels = height[arc_tail[triangle_vu]]
+    by_level = np.argsort(levels, kind='stable')
+    triangle_vu, triangle_vw, triangle_uw = triangle_vu[by_level], triangle_vw[by_level], triangle_uw[by_level]
+    level_ptr = np.zeros(height.max() + 2 if n else 1, dtype=np.int64)
+    np.cumsum(np.bincount(levels, minlength=len(level_ptr) - 1), out=level_ptr[1:])
+
+    # Lower triangles of every arc, to unpack the paths
+    triangle_order = np.argsort(triangle_uw, kind='stable').astype(np.int32)
+    triangle_ptr = np.zeros(len(arc_head) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(triangle_uw, minlength=len(arc_head)), out=triangle_ptr[1:])
+
+    # Arc of every edge of the graph, and whether the edge goes from the lower to the higher rank
+    source_rank, target_rank = rank[graph.edge_sources], rank[graph.indices]
+    low, high = np.minimum(source_rank, target_rank), np.maximum(source_rank, target_rank)
+    edge_arc = np.searchsorted(arc_keys, low * n + high)
+    edge_arc[source_rank == target_rank] = -1
+
+    return {'rank': rank, 'parent': parent, 'arc_ptr': arc_ptr, 'arc_tail': arc_tail, 'arc_head': arc_head,
+            'triangle_vu': triangle_vu, 'triangle_vw': triangle_vw, 'triangle_uw': triangle_uw,
+            'level_ptr': level_ptr, 'triangle_order': triangle_order, 'triangle_ptr': triangle_ptr,
+            'edge_arc': edge_arc, 'edge_forward': source_rank < target_rank}
+
+
+def load_topology(graph, hierarchy_dir='./output/contraction_hierarchy'):
+    """
+    Load the metric independent part of the hierarchy of the graph from the disk, building and saving it the first
+    time. The file is keyed by the hash of the graph topology, so new weights never require a new one.
+    """
+    topology_path = os.path.join(hierarchy_dir, f"topology_{topology_key(graph)}.npz")
+
+    if os.path.exists(topology_path):
+        with np.load(topology_path) as saved:
+            return {name: saved[name] for name in TOPOLOGY_ARRAYS}
+
+    print("Building the contraction hierarchy topology for the current graph...")
+    topology = build_topology(graph)
+
+    os.makedirs(hierarchy_dir, exist_ok=True)
+    np.savez(topology_path, **topology)
+    print(f"Contraction hierarchy topology saved at {topology_path}")
+
+    return topology
+
+
+class ContractionHierarchy:
+    """
+    Customizable contraction hierarchy of a RoutingGraph.
+    The topology (node order and shortcuts) depends only on the nodes and edges of the graph, the customization
+    computes the shortcut weights for a weight property and has to run again when the weight values change.
+    """
+    def __init__(self, graph, topology):
+        self.graph = graph
+        self.topology = topology
+        self.metrics = {}
+
+        # Plain lists for the walks along the elimination tree
+        self._rank = topology['rank'].tolist()
+        self._parent = topology['parent'].tolist()
+        self._arc_ptr = topology['arc_ptr'].tolist()
+        self._arc_tail = topology['arc_tail'].tolist()
+        self._arc_head = topology['arc_head'].tolist()
+
+        # Depth of the nodes in the elimination tree, the parent of a node always has a higher rank
+        depth = np.zeros(len(self._parent), dtype=np.int64)
+        for node in range(len(self._parent) - 1, -1, -1):
+            if self._parent[node] >= 0:
+                depth[node] = depth[self._parent[node]] + 1
+        self._depth = depth
+        self._head_depth = depth[topology['arc_head']]
+        self._arc_keys = topology['arc_tail'] * len(self._parent) + topology['arc_head']
+
+    @classmethod
+    def load(cls, graph, hierarchy_dir='./output/contraction_hierarchy'):
+        return cls(graph, load_topology(graph, hierarchy_dir))
+
+    def refreshed(self, graph):
+        """
+        Hierarchy of a copy of the graph with new weights (see RoutingGraph.with_attributes): the topology and
+        the metrics of the unchanged weights are shared, the other metrics are customized again
+        """
+        changed = set(graph.changed_weights(self.graph))
+        hierarchy = copy.copy(self)
+        hierarchy.graph = graph
+        hierarchy.metrics = {weight: metric for weight, metric in self.metrics.items() if weight not in changed}
+        hierarchy.customize([weight for weight in self.metrics if weight not in hierarchy.metrics])
+        return hierarchy
+
+    def customize(self, weights=None):
+        """
+        Compute the weights of the arcs, in both directions, for the given weight properties (all of them by
+        default): the weights of the edges first, then the lower triangles relaxed level by level.
+        Returns the customization time.
+        """
+        start_time = time.time()
+        topology = self.topology
+        edge_arc, edge_forward = topology['edge_arc'], topology['edge_forward']
+        arc_count = len(topology['arc_head'])
+        edges = np.arange(self.graph.edge_count)
+
+        for weight in WEIGHT_PROPERTIES if weights is None else weights:
+            values = self.graph.weight_array(weight)
+            forward_cost = np.full(arc_count, np.inf)
+            backward_cost = np.full(arc_count, np.inf)
+            forward_edge = np.full(arc_count, -1, dtype=np.int64)
+            backward_edge = np.full(arc_count, -1, dtype=np.int64)
+
+            for cost, arc_edge, mask in ((forward_cost, forward_edge, (edge_arc >= 0) & edge_forward),
+                                         (backward_cost, backward_edge, (edge_arc >= 0) & ~edge_forward)):
+                np.minimum.at(cost, edge_arc[mask], values[mask])
+                lightest = mask.copy()
+                lightest[mask] = values[mask] == cost[edge_arc[mask]]
+                arc_edge[edge_arc[lightest]] = edges[lightest]
+
+            for start, stop in zip(topology['level_ptr'][:-1], topology['level_ptr'][1:]):
+                vu = topology['triangle_vu'][start:stop]
+                vw = topology['triangle_vw'][start:stop]
+                uw = topology['triangle_uw'][start:stop]
+                np.minimum.at(forward_cost, uw, backward_cost[vu] + forward_cost[vw])
+                np.minimum.at(backward_cost, uw, backward_cost[vw] + forward_cost[vu])
+
+            self.metrics[weight] = {'forward_cost': forward_cost, 'backward_cost': backward_cost,
+                                    'forward_edge': forward_edge, 'backward_edge': backward_edge, 'values': values}
+
+        return time.time() - start_time
+
+    def _search(self, start, costs):
+        """
+        Upward search from the start node. All the upper neighbours of a node are its ancestors in the elimination
+        tree, so the search only needs the arcs leaving the chain of ancestors, indexed by their distance from the
+        start node, and runs as a single sparse search of that small graph.
+        Returns the chain and the cost and last arc of the paths to its nodes.
+        """
+        chain = []
+        node = start
+        while node >= 0:
+            chain.append(node)
+            node = self._parent[node]
+        chain = np.asarray(chain, dtype=np.int64)
+
+        first_arc, counts = self.topology['arc_ptr'][chain], np.diff(self.topology['arc_ptr'])[chain]
+        arcs = np.repeat(first_arc - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        tails = np.repeat(np.arange(len(chain)), counts)
+        heads = self._depth[start] - self._head_depth[arcs]
+
+        chain_graph = sparse.csr_matrix((costs[arcs], (tails, heads)), shape=(len(chain), len(chain)))
+        dist, predecessors = csgraph.dijkstra(chain_graph, indices=0, return_predecessors=True)
+
+        # Arcs of the chain graph are unique, the last arc of a path follows from the predecessor
+        previous_arc = np.full(len(chain), -1, dtype=np.int64)
+        reached = predecessors >= 0
+        previous_arc[reached] = np.searchsorted(self._arc_keys,
+                                                chain[predecessors[reached]] * len(self._parent) + chain[reached])
+        return chain.tolist(), dist, previous_arc
+
+    def _unpack(self, arc, forward, metric):
+        """
+        Edges of the graph behind an arc, in the given direction: the lightest edge if it gives the arc weight,
+        otherwise the two arcs of a lower triangle that does
+        """
+        topology = self.topology
+        forward_cost, backward_cost = metric['forward_cost'], metric['backward_cost']
+        forward_edge, backward_edge, values = metric['forward_edge'], metric['backward_edge'], metric['values']
+        path_edges = []
+        stack = [(arc, forward)]
+        while stack:
+            arc, forward = stack.pop()
+            cost = forward_cost[arc] if forward else backward_cost[arc]
+            edge = forward_edge[arc] if forward else backward_edge[arc]
+            if edge >= 0 and values[edge] == cost:
+                path_edges.append(edge)
+                continue
+
+            triangles = topology['triangle_order'][topology['triangle_ptr'][arc]:topology['triangle_ptr'][arc + 1]]
+            vu, vw = topology['triangle_vu'][triangles], topology['triangle_vw'][triangles]
+            if forward:
+                # u -> v -> w
+                i = np.flatnonzero(backward_cost[vu] + forward_cost[vw] == cost)[0]
+                stack.extend(((int(vw[i]), True), (int(vu[i]), False)))
+            else:
+                # w -> v -> u
+                i = np.flatnonzero(backward_cost[vw] + forward_cost[vu] == cost)[0]
+                stack.extend(((int(vu[i]), True), (int(vw[i]), False)))
+        return path_edges
+
+    def shortest_path(self, source, target, weight='distance'):
+        """
+        Cost and edges of the shortest path between two dense node indices, or None if the target is not reachable
+        """
+        metric = self.metrics[weight]
+        source_rank, target_rank = self._rank[source], self._rank[target]
+        forward_chain, forward_dist, forward_arcs = self._search(source_rank, metric['forward_cost'])
+        backward_chain, backward_dist, backward_arcs = self._search(target_rank, metric['backward_cost'])
+
+        # The two chains share the ancestors of the lowest common ancestor, where the paths meet
+        length = min(len(forward_chain), len(backward_chain))
+        common = int(np.count_nonzero(np.asarray(forward_chain[-length:]) == np.asarray(backward_chain[-length:])))
+        if common == 0:
+            return None
+        totals = forward_dist[-common:] + backward_dist[-common:]
+        meeting = int(np.argmin(totals))
+        if totals[meeting] == np.inf:
+            return None
+
+        up_arcs = []
+        position = len(forward_chain) - common + meeting
+        while position != 0:
+            up_arcs.append(int(forward_arcs[position]))
+            position = self._depth[source_rank] - self._depth[self._arc_tail[up_arcs[-1]]]
+        path_edges = []
+        for arc in reversed(up_arcs):
+            path_edges.extend(self._unpack(arc, True, metric))
+
+        position = len(backward_chain) - common + meeting
+        while position != 0:
+            arc = int(backward_arcs[position])
+            path_edges.extend(self._unpack(arc, False, metric))
+            position = self._depth[target_rank] - self._depth[self._arc_tail[arc]]
+
+        return float(totals[meeting]), path_edges
+
+    def route(self, source, target, weight='distance', algorithm='cch'):
+        """
+        Path between two RoadJunction ids, with the same result of RoutingGraph.route.
+        The weight has to be customized first.
+        """
+        start_time = time.time()
+
+        source_index, target_index = self.graph.index_of(source), self.graph.index_of(target)
+        if source_index is None or target_index is None:
+            return {'error': 'No path found'}
+        if weight not in self.metrics:
+            return {'error': f'Weight {weight} not customized'}
+
+        found = self.shortest_path(source_index, target_index, weight)
+        if found is None:
+            return {'error': 'No path found'}
+
+        path = self.graph.path_result(source, target, *found)
+        return [time.time() - start_time, path]
@@ -1,8 +1,10 @@
 import csv
 import sys
+import time
 import pandas as pd
 import json
 from graph_bridge import App
+from routing_engine import RoutingGraph
 import matplotlib
 matplotlib.use('TkAgg')
 import matplotlib.pyplot as plt
@@ -64,6 +66,21 @@ def export_road_junctions_to_csv(greeter):
     print(f"Road junctions exported to {file_path}")
 
 
+def export_graph_snapshot(greeter, snapshot_dir='./output/graph_snapshot'):
+    """
+    Export the graph as a binary snapshot: the node ids (int64) in the order of their dense indices, float32
+    coordinates, CSR adjacency and float32 edge attributes, one .npy file each, that RoutingGraph.from_snapshot
+    memory maps without reading Neo4j.
+    """
+    start_time = time.time()
+    data_version = greeter.get_data_version()
+    graph = RoutingGraph.from_neo4j(greeter)
+    graph.save_snapshot(snapshot_dir, data_version)
+
+    print(f"Graph snapshot of {graph.node_count} nodes and {graph.edge_count} edges (data version {data_version}) "
+          f"exported to {snapshot_dir} in {time.time() - start_time:.2f} s")
+
+
 def plot_route_pm10_values():
     """
     Plot route PM10 values.
@@ -103,6 +120,8 @@ if __name__ == "__main__":
         #plot_route_pm10_values()
         export_edges_to_csv(greeter_app, config['measures_path'])
         export_road_junctions_to_csv(greeter_app)
+        export_graph_snapshot(greeter_app, config.get('graph_snapshot', {}).get('snapshot_dir',
+                                                                                 './output/graph_snapshot'))
     except Exception as e:
         print(e)
         sys.exit(1)
@@ -1,75 +1,43 @@
 import time
 import json
 import numpy as np
-from graph_bridge import App
-
-
-def coordinates_to_geojson(coordinates, weight, value, tot_distance, tot_green_area, avg_pm10, total_pm10_metre,
-                           total_inv_ga_metre, total_green_area_distance, index):
-    """
-    Convert a list of coordinates to a GeoJSON file
+from graph_bridge import App, combined_weight_ratios
+from routing_engine import RoutingGraph
+from contraction_hierarchy import ContractionHierarchy
+from landmarks import Landmarks
+from spatial_index import SpatialIndex, snap_query
+from time_profiles import TIME_DEPENDENT_WEIGHTS, TimeDependentRouter, load_profiles
+from geojson_writer import save_paths_geojson
+from pareto_routing import PARETO_OBJECTIVES, PARETO_EPSILON, pareto_route
+from alternative_routes import alternative_routes
+
+
+def save_geojson(paths, weight, geojson=None):
     """
-    geojson_data = {
-        "type": "FeatureCollection",
-        "features": [
-            {
-                "type": "Feature",
-                "geometry": {
-                    "type": "LineString",
-                    "coordinates": coordinates
-                },
-                "properties": {
-                    "total_cost": value,
-                    "total_distance": tot_distance,
-                    "total_green_area": tot_green_area,
-                    "avg_pm10": avg_pm10,
-                    "total_pm10_metre": total_pm10_metre,
-                    "total_inv_ga_metre": total_inv_ga_metre,
-                    "avg_pm10_metre": total_pm10_metre / tot_distance,
-                    "total_ga_distance": total_green_area_distance
-                }
-            }
-        ]
-    }
-
-    # save the GeoJSON file
-    file_name = f"output/routing/path_{weight}_{index}_{routing_query['path_file_suffix']}.geojson"
-    with open(file_name, "w") as f:
-        json.dump(geojson_data, f)
-        print(f"GeoJSON file saved at {file_name}")
-
-
-def create_multiple_weights_propriety(greeter, combined_weight_config):
+    Save the paths in a single GeoJSON file. geojson sets the file_name, the coordinate precision
+    (decimals), the simplify_tolerance in metres and ndjson for newline-delimited features.
     """
-    Create a combined weight property for the edges of the footway graph
-    """
-
-    # Get parameters for the combined weight
-    parameters = {
-        'pm10_ratio': combined_weight_config['eff_pm10']['ratio'],
-        'inv_green_area_ratio': combined_weight_config['inv_green_area']['ratio']
-    }
-
-    greeter.add_combined_property(parameters)
+    geojson = geojson or {}
+    file_name = geojson.get('file_name', f"output/routing/path_{weight}.geojson")
+    save_paths_geojson(paths, weight, file_name, geojson.get('precision', 6), geojson.get('simplify_tolerance', 0.0),
+                       geojson.get('ndjson', False))
 
 
-def routing_path(greeter, source, target, weight, algorithm, k=2, bool_map=True):
+def routing_path(greeter, source, target, weight, algorithm, k=2, bool_map=True, ratios=None, geojson=None):
     """
-    Find the path(s) between two nodes in the footway graph
+    Find the path(s) between two nodes in the footway graph.
+    The combined weight is computed at query time with the given ratios.
+    With bool_map the paths are saved in a GeoJSON file, as set by geojson (see save_geojson).
     """
     start_time = time.time()
 
-    greeter.drop_all_projections()
-
     paths = []
     if algorithm == 'dijkstra':
-        paths = greeter.dijkstra_path(source, target, weight)
+        paths = greeter.dijkstra_path(source, target, weight, ratios)
     elif algorithm == 'a_star':
-        paths = greeter.a_star_path(source, target, weight)
+        paths = greeter.a_star_path(source, target, weight, ratios)
     elif algorithm == 'top_k':
-        paths = greeter.top_k_paths(source, target, weight, k)
-
-    greeter.drop_all_projections()
+        paths = greeter.top_k_paths(source, target, weight, k, ratios)
 
     if len(paths) == 0:
         return {'error': 'No path found'}
@@ -77,47 +45,129 @@ def routing_path(greeter, source, target, weight, algorithm, k=2, bool_map=True)
     path_data = [time.time() - start_time]
 
     for index, r in enumerate(paths):
-        path, totalCost, total_distance, total_green_area, avg_pm10, total_pm10_metre, total_inv_ga_metre, total_green_area_distance = r
+        path, totalCost, total_distance, total_green_area, avg_pm10, total_pm10_metre, total_inv_ga_metre, \
+            total_green_area_distance, coordinates, edges = r
 
         # Remove duplicates from the path
-        final_path = [path[0]] + [p for prev, p in zip(path, path[1:]) if p != prev]
-
-        if bool_map:
-            # Node coordinates of the path
-            coordinates = greeter.get_coordinates(final_path=final_path)
-            if len(coordinates[0][0]) == 0:
-                print('\nNo result for query')
-            else:
-                # Save the path in a GeoJSON file
-                coordinates_to_geojson(
-                    coordinates[0][0], weight, totalCost, total_distance, total_green_area, avg_pm10, total_pm10_metre,
-                    total_inv_ga_metre, total_green_area_distance, index)
+        kept = [0] + [i for i in range(1, len(path)) if path[i] != path[i - 1]]
+        final_path = [path[i] for i in kept]
+        coordinates = [coordinates[i] for i in kept]
+
+        if bool_map and len(coordinates) == 0:
+            print('\nNo result for query')
 
         path_data.append({'hops': len(final_path), 'source': source, 'target': target, 'cost': totalCost,
                           'distance': total_distance, 'pm10': avg_pm10, 'green_area': total_green_area,
                           'pm10_metre': total_pm10_metre, 'inv_ga_metre': total_inv_ga_metre,
-                          'green_area_distance': total_green_area_distance})
+                          'green_area_distance': total_green_area_distance,
+                          'nodes': final_path, 'coordinates': coordinates, 'edges': edges})
+
+    if bool_map:
+        save_geojson(path_data[1:], weight, geojson)
 
     return path_data
 
 
-def main():
-    greeter = App(config['neo4j_URL'], config['neo4j_user'], config['neo4j_pwd'])
+def memory_routing_path(router, source, target, weight, algorithm, bool_map=True, epsilon=PARETO_EPSILON, k=2,
+                        alternatives_config=None, geojson=None):
+    """
+    Find the path(s) between two nodes with the in-memory copy of the footway graph,
+    a RoutingGraph, its ContractionHierarchy or its Landmarks. The pareto algorithm finds the Pareto optimal routes
+    over distance, pm10_metre and inv_ga_metre, pruning the ones within a relative epsilon of a better one;
+    the alternatives algorithm finds up to k routes sharing at most max_overlap of their distance.
+    """
+    if algorithm == 'pareto':
+        weight = 'pareto'
+        result = pareto_route(router, source, target, PARETO_OBJECTIVES, epsilon)
+    elif algorithm == 'alternatives':
+        alternatives_config = alternatives_config or {}
+        result = alternative_routes(router, source, target, weight, k, alternatives_config.get('max_overlap', 0.6),
+                                    alternatives_config.get('max_stretch', 1.4))
+    else:
+        result = router.route(source, target, weight, algorithm)
+    if 'error' in result:
+        return result
 
-    if routing_query['update_graph_properties']:
-        print("Updating graph properties as weights for path finding algorithm...")
-        greeter.add_inv_green_area_metre()
-        greeter.add_pm10_metre()
-        #greeter.add_green_area_distance()  # only for results visualization
+    if bool_map:
+        save_geojson(result[1:], weight, geojson)
 
+    return result
+
+
+def main():
     w = routing_query['weight']  # "distance", "pm10_metre, "inv_ga_metre", "combined_weight"
+    ratios = combined_weight_ratios(routing_query['combined_weight'])
+    memory = routing_query.get('backend', 'neo4j') == 'memory'
 
-    if w == 'combined_weight':
-        create_multiple_weights_propriety(greeter, routing_query['combined_weight'])
+    # The memory backend opens the graph snapshot, if enabled, without connecting to Neo4j
+    greeter = None
+    if routing_query['update_graph_properties'] or not memory:
+        greeter = App(config['neo4j_URL'], config['neo4j_user'], config['neo4j_pwd'])
 
-    result = routing_path(
-        greeter, routing_query['source_id'], routing_query['destination_id'],
-        w, routing_query['algorithm'], routing_query['top_k'], True)
+    try:
+        return route_query(greeter, w, ratios, memory)
+    finally:
+        if greeter is not None:
+            greeter.close()
+
+
+def route_query(greeter, w, ratios, memory):
+    if routing_query['algorithm'] == 'departure' and w not in TIME_DEPENDENT_WEIGHTS:
+        print(f"The departure algorithm needs the weight pm10_metre or combined_weight, not {w}")
+        return 1
+
+    if routing_query['update_graph_properties']:
+        print("Updating graph properties as weights for path finding algorithm...")
+        summary = greeter.update_derived_edge_properties()
+        print(f"Graph properties updated on {summary['relationships']} relationships "
+              f"in {summary['elapsed_time']:.2f} s")
+
+    # All the paths of the query in a single file
+    geojson = dict(routing_query.get('geojson', {}))
+    extension = 'ndjson' if geojson.get('ndjson', False) else 'geojson'
+    geojson['file_name'] = f"output/routing/path_{w}_{routing_query['path_file_suffix']}.{extension}"
+
+    coordinates = 'source_coordinates' in routing_query or 'destination_coordinates' in routing_query
+
+    if memory:
+        # Load the graph once and search it in-process
+        router = RoutingGraph.load(config, greeter)
+        if coordinates:
+            routing_query.update(snap_query(SpatialIndex.from_graph(router), routing_query))
+        weight = router.combined_weight(**ratios) if w == 'combined_weight' else w
+        if routing_query['algorithm'] == 'cch':
+            # The topology is read from the disk, only the weights of the query are customized
+            router = ContractionHierarchy.load(router, config.get('contraction_hierarchy_dir',
+                                                                  './output/contraction_hierarchy'))
+            router.customize([weight])
+        elif routing_query['algorithm'] == 'alt':
+            # A* with the landmark bounds, computed for the weight of the query
+            router = Landmarks(router, routing_query.get('landmarks', 16), weights=[weight])
+        elif routing_query['algorithm'] == 'departure':
+            # pm10_metre at the time each edge is reached, from the profiles built by time_profiles.py
+            profile_config = config.get('time_profiles', {})
+            profiles = load_profiles(router, profile_config.get('profile_dir', './output/time_profiles'),
+                                     profile_config.get('slots', 24))
+            if profiles is None:
+                print("No PM10 profiles for the current graph, run time_profiles.py first")
+                return 1
+            router = TimeDependentRouter(router, profiles, routing_query.get('departure_time'),
+                                         profile_config.get('walking_speed', 1.3))
+        result = memory_routing_path(
+            router, routing_query['source_id'], routing_query['destination_id'], weight, routing_query['algorithm'],
+            True, routing_query.get('pareto_epsilon', PARETO_EPSILON), routing_query['top_k'],
+            routing_query.get('alternatives'), geojson)
+    else:
+        if coordinates:
+            index = SpatialIndex.from_neo4j(greeter, routing_query.get('snap', 'node') == 'edge')
+            routing_query.update(snap_query(index, routing_query))
+        result = routing_path(
+            greeter, routing_query['source_id'], routing_query['destination_id'],
+            w, routing_query['algorithm'], routing_query['top_k'], True, ratios, geojson)
+
+    if 'error' in result:
+        print(result['error'])
+        return 1
 
     print("\n-- Routing results --")
     print("execution time: " + str(result[0]))
@@ -140,7 +190,6 @@ def main():
             print("avg pm10 per metre: " + str(r['pm10_metre']/r['distance']))
             print("total green area distance: " + str(r['green_area_distance']))
 
-    greeter.close()
     return 0
 
 
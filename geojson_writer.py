@@ -0,0 +1,172 @@
+import json
+import math
+import numpy as np
+from routing_engine import EARTH_RADIUS
+
+
+def simplify_lines(lines, tolerance):
+    """
+    Douglas-Peucker simplification of lines of [lon, lat] points, with the tolerance in metres, all the lines
+    together. Returns for every line the mask of the points kept, always including the first and the last one.
+    """
+    lines = [np.asarray(line, dtype=np.float64).reshape(-1, 2) for line in lines]
+    sizes = np.array([len(line) for line in lines], dtype=np.int64)
+    ends = np.cumsum(sizes)
+    keep = np.ones(ends[-1] if len(ends) else 0, dtype=bool)
+    if tolerance <= 0 or len(keep) == 0:
+        return np.split(keep, ends[:-1])
+
+    # Equirectangular projection of every line in metres, enough for the deviations of a walking route
+    points = np.concatenate(lines)
+    scale = np.radians(1.0) * EARTH_RADIUS
+    mean_lat = np.repeat([np.mean(line[:, 1]) if len(line) else 0.0 for line in lines], sizes)
+    xy = np.column_stack((points[:, 0] * scale * np.cos(np.radians(mean_lat)), points[:, 1] * scale))
+
+    # Every round splits each pending segment at its farthest point, if it deviates more than the tolerance
+    first, last = ends - sizes, ends - 1
+    keep[:] = False
+    keep[first[sizes > 0]] = True
+    keep[last[sizes > 0]] = True
+    pending = last - first >= 2
+    first, last = first[pending], last[pending]
+    while len(first):
+        interior = last - first - 1
+        segment = np.repeat(np.arange(len(first)), interior)
+        middle = np.arange(interior.sum()) - np.repeat(np.cumsum(interior) - interior, interior) + \
+            np.repeat(first + 1, interior)
+
+        start, end = xy[first[segment]], xy[last[segment]]
+        direction, offsets = end - start, xy[middle] - start
+        length = np.hypot(direction[:, 0], direction[:, 1])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            deviation = np.where(length > 0,
+                                 np.abs(direction[:, 0] * offsets[:, 1] - direction[:, 1] * offsets[:, 0]) / length,
+                                 np.hypot(offsets[:, 0], offsets[:, 1]))
+
+        # Farthest point of every segment: the first of its points sorted by decreasing deviation
+        order = np.lexsort((-deviation, segment))
+        farthest = order[np.searchsorted(segment[order], np.arange(len(first)))]
+        split = deviation[farthest] > tolerance
+        keep[middle[farthest[split]]] = True
+
+        first, last = np.concatenate((first[split], middle[farthest[split]])), \
+            np.concatenate((middle[farthest[split]], last[split]))
+        pending = last - first >= 2
+        first, last = first[pending], last[pending]
+
+    return np.split(keep, ends[:-1])
+
+
+def simplify_line(coordinates, tolerance):
+    """
+    Mask of the points of a line kept by simplify_lines
+    """
+    return simplify_lines([coordinates], tolerance)[0]
+
+
+def _number(value):
+    # NaN and infinity are not valid JSON
+    return None if value is None or not math.isfinite(value) else value
+
+
+def path_properties(path, weight, index=None):
+    """
+    Properties of the GeoJSON feature of a path returned by routing_path
+    """
+    distance = path['distance']
+    properties = {"total_cost": _number(path['cost']),
+                  "total_distance": _number(distance),
+                  "total_green_area": _number(path['green_area']),
+                  "avg_pm10": _number(path['pm10']),
+                  "total_pm10_metre": _number(path['pm10_metre']),
+                  "total_inv_ga_metre": _number(path['inv_ga_metre']),
+                  "avg_pm10_metre": _number(path['pm10_metre'] / distance) if distance else None,
+                  "total_ga_distance": _number(path['green_area_distance']),
+                  "weight": weight}
+    if index is not None:
+        properties["index"] = index
+    return properties
+
+
+class GeoJSONWriter:
+    """
+    Writer of many routes in a single file, as one FeatureCollection or as newline-delimited GeoJSON features,
+    streamed feature by feature. The coordinates are written with the given number of decimals (6 is about
+    10 cm) and the lines can be simplified within a tolerance in metres.
+    """
+    def __init__(self, file_name, precision=6, tolerance=0.0, ndjson=False):
+        self.file_name = file_name
+        self.precision = precision
+        self.tolerance = tolerance
+        self.ndjson = ndjson
+        self.count = 0
+        self.file = None
+        self._point = f"[%.{precision}f,%.{precision}f]"
+
+    def __enter__(self):
+        self.file = open(self.file_name, "w")
+        if not self.ndjson:
+            self.file.write('{"type":"FeatureCollection","features":[\n')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.file is None:
+            return
+        if not self.ndjson:
+            self.file.write(']}\n')
+        self.file.close()
+        self.file = None
+
+    def line_string(self, coordinates, keep=None):
+        """
+        Text of the coordinates of a LineString, rounded and simplified (or reduced to the points of keep)
+        """
+        points = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        points = points[simplify_line(points, self.tolerance) if keep is None else keep]
+        point = self._point
+        return '[' + ','.join([point % (lon, lat) for lon, lat in points.tolist()]) + ']'
+
+    def write_feature(self, coordinates, properties, keep=None):
+        """
+        Write a LineString feature with the given properties
+        """
+        feature = '{"type":"Feature","geometry":{"type":"LineString","coordinates":' + \
+            self.line_string(coordinates, keep) + '},"properties":' + \
+            json.dumps(properties, separators=(',', ':')) + '}'
+        if self.ndjson:
+            self.file.write(feature + '\n')
+        else:
+            self.file.write((',\n' if self.count else '') + feature)
+        self.count += 1
+
+    def write_path(self, path, weight, index=None, **properties):
+        """
+        Write a path returned by routing_path, with the properties of path_properties and the given ones
+        """
+        self.write_feature(path['coordinates'], dict(path_properties(path, weight, index), **properties))
+
+    def write_paths(self, paths, weight, properties=None, chunk_size=1024):
+        """
+        Write many paths, simplified chunk by chunk all together, with the properties of path_properties and
+        the ones in the list properties (by default the index of the path in the list)
+        """
+        for start in range(0, len(paths), chunk_size):
+            chunk = paths[start:start + chunk_size]
+            masks = simplify_lines([path['coordinates'] for path in chunk], self.tolerance)
+            for index, (path, keep) in enumerate(zip(chunk, masks), start):
+                extra = {'index': index} if properties is None else properties[index]
+                self.write_feature(path['coordinates'], dict(path_properties(path, weight), **extra), keep)
+
+
+def save_paths_geojson(paths, weight, file_name, precision=6, tolerance=0.0, ndjson=False):
+    """
+    Save the paths returned by routing_path in a single GeoJSON file, one feature for every path with its index
+    """
+    with GeoJSONWriter(file_name, precision, tolerance, ndjson) as writer:
+        indexed = [(index, path) for index, path in enumerate(paths) if len(path['coordinates']) > 0]
+        writer.write_paths([path for _, path in indexed], weight, [{'index': index} for index, _ in indexed])
+    print(f"GeoJSON file saved at {file_name}")
+    return writer.count
@@ -1,20 +1,206 @@
 import sys
-from neo4j import GraphDatabase
+import time
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from neo4j import GraphDatabase, AsyncGraphDatabase, READ_ACCESS, WRITE_ACCESS
+
+# Prefix of the in-memory projections used for routing, and the edge properties they hold
+ROUTING_PROJECTION = 'routing'
+WEIGHT_PROPERTIES = ['distance', 'pm10_metre', 'inv_ga_metre', 'green_area_distance']
+
+# Combined weight projections kept by a process, the least recently used one beyond them is dropped
+MAX_COMBINED_PROJECTIONS = 8
+
+# Combined weight of a relationship r, computed at query time: pm10_metre and inv_ga_metre normalized with their
+# ranges in the current data version, weighted by the ratios of the request. A property with the same value on
+# every relationship adds nothing (still null where the property is missing).
+COMBINED_WEIGHT_EXPRESSION = """
+                (CASE WHEN $max_pm10_metre > $min_pm10_metre
+                    THEN $pm10_ratio * (r.pm10_metre - $min_pm10_metre) / ($max_pm10_metre - $min_pm10_metre)
+                    ELSE 0.0 * r.pm10_metre END) +
+                (CASE WHEN $max_inv_ga_metre > $min_inv_ga_metre
+                    THEN $inv_green_area_ratio * (r.inv_ga_metre - $min_inv_ga_metre) /
+                        ($max_inv_ga_metre - $min_inv_ga_metre)
+                    ELSE 0.0 * r.inv_ga_metre END)"""
+
+# Parameters of the route queries that do not use the combined weight
+NO_COMBINED_WEIGHT = {'pm10_ratio': None, 'inv_green_area_ratio': None, 'min_pm10_metre': None,
+                      'max_pm10_metre': None, 'min_inv_ga_metre': None, 'max_inv_ga_metre': None}
+
+# Second part of the route queries: from the nodes of every path yielded by the algorithm, it gets the ROUTE
+# relationships between consecutive nodes (the one with the lowest weight, if more), the totals of the path,
+# the coordinates of the nodes and the attributes of the edges
+PATH_RESULT_QUERY = """
+        WITH index, totalCost, [nodeId IN nodeIds | gds.util.asNode(nodeId)] AS path_nodes
+        UNWIND range(0, size(path_nodes) - 2) AS i
+        WITH index, totalCost, path_nodes, i, path_nodes[i] AS a, path_nodes[i + 1] AS b
+        CALL {
+            WITH a, b
+            MATCH (a)-[r:ROUTE]->(b)
+            RETURN r ORDER BY CASE WHEN $weight_property = 'combined_weight' THEN """ + COMBINED_WEIGHT_EXPRESSION + """
+                ELSE r[$weight_property] END LIMIT 1
+        }
+        WITH index, totalCost, path_nodes, i, r ORDER BY index, i
+        WITH index, totalCost, path_nodes, collect(r) AS path_edges, 
+            sum(r.distance) AS total_distance, sum(r.green_area) AS total_green_area, avg(r.pm10) AS avg_pm10, 
+            sum(r.pm10_metre) AS total_pm10_metre, sum(r.inv_ga_metre) AS total_inv_ga_metre, 
+            sum(r.green_area_distance) AS total_green_area_distance
+        RETURN [n IN path_nodes | n.id] AS nodes_path, totalCost, total_distance, total_green_area, avg_pm10, 
+            total_pm10_metre, total_inv_ga_metre, total_green_area_distance,
+            [n IN path_nodes | [n.lon, n.lat]] AS coordinates,
+            [r IN path_edges | {distance: r.distance, green_area: r.green_area, pm10: r.pm10, 
+                pm10_metre: r.pm10_metre, inv_ga_metre: r.inv_ga_metre, 
+                green_area_distance: r.green_area_distance}] AS edges
+        ORDER BY index
+        """
+
+ROUTING_PROJECTION_EXISTS_QUERY = "CALL gds.graph.exists($graph_name) YIELD exists RETURN exists"
+
+DROP_PROJECTION_QUERY = "CALL gds.graph.drop($graph_name, false) YIELD graphName RETURN graphName"
+
+# Drop the routing projections of the previous data versions, the ones of the current version start with its name
+DROP_STALE_PROJECTIONS_QUERY = """
+        CALL gds.graph.list() YIELD graphName
+        WITH graphName WHERE graphName STARTS WITH $prefix AND graphName <> $graph_name 
+            AND NOT graphName STARTS WITH $graph_name + '_'
+        CALL gds.graph.drop(graphName) YIELD database
+        RETURN graphName
+        """
+
+PROJECT_ROUTING_QUERY = """
+        CALL gds.graph.project($graph_name, 
+            ['RoadJunction'], ['ROUTE'], 
+            {nodeProperties: ['lat', 'lon'], 
+            relationshipProperties: $weight_properties})
+        """
+
+# Projection with the combined weight for the ratios of a request
+PROJECT_COMBINED_ROUTING_QUERY = """
+        MATCH (s:RoadJunction)-[r:ROUTE]->(t:RoadJunction)
+        WITH gds.graph.project($graph_name, s, t, {
+            sourceNodeProperties: s {.lat, .lon},
+            targetNodeProperties: t {.lat, .lon},
+            relationshipType: 'ROUTE',
+            relationshipProperties: {combined_weight: coalesce(""" + COMBINED_WEIGHT_EXPRESSION + """, 
+                toFloat('NaN'))}
+        }) AS g
+        RETURN g.graphName
+        """
+
+# Ranges used to normalize the combined weight
+COMBINED_WEIGHT_STATS_QUERY = """
+        MATCH (:RoadJunction)-[r:ROUTE]->(:RoadJunction)
+        RETURN min(r.pm10_metre) AS min_pm10_metre, max(r.pm10_metre) AS max_pm10_metre,
+            min(r.inv_ga_metre) AS min_inv_ga_metre, max(r.inv_ga_metre) AS max_inv_ga_metre
+        """
+
+DATA_VERSION_QUERY = """
+        OPTIONAL MATCH (m:GraphMetadata {name: 'routing'})
+        RETURN coalesce(m.data_version, 0)
+        """
+
+DIJKSTRA_QUERY = """
+        MATCH (s:RoadJunction {id: $source})
+        MATCH (t:RoadJunction {id: $target})
+        CALL gds.shortestPath.dijkstra.stream($graph_name, {
+            sourceNode: s, 
+            targetNode: t,
+            relationshipWeightProperty: $weight_property
+        })
+        YIELD index, totalCost, nodeIds
+        """ + PATH_RESULT_QUERY
+
+A_STAR_QUERY = """
+        MATCH (s:RoadJunction {id: $source})
+        MATCH (t:RoadJunction {id: $target})
+        CALL gds.shortestPath.astar.stream($graph_name, {
+            sourceNode: s,
+            targetNode: t,
+            latitudeProperty: 'lat',
+            longitudeProperty: 'lon',
+            relationshipWeightProperty: $weight_property
+        })
+        YIELD index, totalCost, nodeIds
+        """ + PATH_RESULT_QUERY
+
+TOP_K_QUERY = """
+        MATCH (s:RoadJunction {id: $source})
+        MATCH (t:RoadJunction {id: $target})
+        CALL gds.shortestPath.yens.stream($graph_name, {
+            sourceNode: s, 
+            targetNode: t,
+            k: $k,
+            relationshipWeightProperty: $weight_property
+        })
+        YIELD index, totalCost, nodeIds
+        """ + PATH_RESULT_QUERY
+
+EDGES_ENDPOINTS_QUERY = """
+        MATCH (s:RoadJunction)-[r:ROUTE]->(d:RoadJunction)
+        WHERE s.id < d.id
+        RETURN s.id AS source, d.id AS destination, 
+        s.lon AS source_lon, s.lat AS source_lat, 
+        d.lon AS destination_lon, d.lat AS destination_lat
+        """
+
+ROAD_JUNCTION_NODES_QUERY = """
+        MATCH (n:RoadJunction)
+        RETURN n.id as id, n.lon as lon, n.lat as lat
+        """
+
+ROAD_EDGES_QUERY = """
+        MATCH (s:RoadJunction)-[r:ROUTE]->(d:RoadJunction)
+        RETURN s.id AS source, d.id AS target, 
+        s.lon AS source_lon, s.lat AS source_lat, 
+            d.lon AS target_lon, d.lat AS target_lat, 
+            r.name AS name,
+            r.distance AS distance, r.green_area AS green_area, r.pm10 AS pm10,
+            r.pm10_metre AS pm10_metre, r.inv_ga_metre AS inv_ga_metre, r.combined_weight AS combined_weight
+        """
+
+DISTANCES_QUERY = """
+        MATCH (s:RoadJunction)-[r:ROUTE]->(d:RoadJunction)
+        WHERE s.id < d.id
+        RETURN r.distance
+        """
+
+
+def combined_weight_ratios(combined_weight_config):
+    """
+    Ratios of the combined weight from the combined_weight field of routing_query.json
+    """
+    return {
+        'pm10_ratio': combined_weight_config['eff_pm10']['ratio'],
+        'inv_green_area_ratio': combined_weight_config['inv_green_area']['ratio']
+    }
+
+
+def combined_projection_name(graph_name, ratios):
+    """
+    Name of the projection with the combined weight for the given ratios, in the data version of graph_name
+    """
+    return f"{graph_name}_combined_{ratios['pm10_ratio']}_{ratios['inv_green_area_ratio']}"
 
 
 class App:
     """
     Class that contains the methods to interact with the neo4j database
     """
-    def __init__(self, uri, user, password):
+    def __init__(self, uri, user, password, exit_on_failure=True):
         self.driver = GraphDatabase.driver(uri, auth=(user, password))
+        self.routing_projection = None
+        self.combined_projections = OrderedDict()
+        self.combined_weight_stats = {}
 
-        # Check if the connection is successful
+        # Check if the connection is successful, a process that can go on without Neo4j gets a ConnectionError
         try:
             with self.driver:
                 self.driver.verify_connectivity()
         except Exception as e:
             print(f"Connection failed: {e}")
+            if not exit_on_failure:
+                raise ConnectionError(f"Connection to Neo4j failed: {e}")
             sys.exit(1)
 
     def close(self):
@@ -22,7 +208,7 @@ class App:
 
     def get_coordinates(self, final_path):
         with self.driver.session() as session:
-            result = session.write_transaction(self._get_coordinates, final_path)
+            result = session.read_transaction(self._get_coordinates, final_path)
             return result
 
     @staticmethod
@@ -31,13 +217,15 @@ class App:
         Query to get the list of coordinates of the path nodes
         """
         query = """
-        UNWIND %s as p
+        UNWIND $final_path as p
         MATCH (n:RoadJunction {id: p})
-        RETURN collect([n.lon, n.lat])""" % final_path
-        result = tx.run(query)
+        RETURN collect([n.lon, n.lat])"""
+        result = tx.run(query, final_path=final_path)
         return result.values()
 
     def drop_all_projections(self):
+        self.routing_projection = None
+        self.combined_projections = OrderedDict()
         with self.driver.session() as session:
             result = session.write_transaction(self._drop_all_projections)
             return result
@@ -53,167 +241,262 @@ class App:
                     RETURN 'dropped ' + graphName""")
         return result.values()
 
-    def dijkstra_path(self, source, target, weight_property):
+    def get_data_version(self):
         with self.driver.session() as session:
-            result = session.write_transaction(self._dijkstra_path, source, target, weight_property)
+            result = session.read_transaction(self._get_data_version)
             return result
 
     @staticmethod
-    def _dijkstra_path(tx, source, target, weight_property):
-        sub_graph_query = ("""
-            CALL gds.graph.project('subgraph_routing', 
-                ['RoadJunction'], ['ROUTE'], 
-                {nodeProperties: ['lat', 'lon'], 
-                relationshipProperties: ['%s']});
-        """) % weight_property
+    def _get_data_version(tx):
+        """
+        Query to get the version of the edge data, bumped every time the weights of the edges change
+        """
+        query = DATA_VERSION_QUERY
+        result = tx.run(query)
+        return result.single()[0]
 
-        tx.run(sub_graph_query)
+    def bump_data_version(self):
+        with self.driver.session() as session:
+            result = session.write_transaction(self._bump_data_version)
+            return result
 
+    @staticmethod
+    def _bump_data_version(tx):
+        """
+        Query to increment the version of the edge data, so the projections of the previous version are not used
+        """
         query = """
-        MATCH (s:RoadJunction {id: $source})
-        MATCH (t:RoadJunction {id: $target})
-        CALL gds.shortestPath.dijkstra.stream('subgraph_routing', {
-            sourceNode: s, 
-            targetNode: t,
-            relationshipWeightProperty: $weight_property
-        })
-        YIELD index, sourceNode, targetNode, totalCost, nodeIds, path
-        with  [nodeId IN nodeIds | gds.util.asNode(nodeId).id] AS nodes_path, totalCost,path as p
-        unwind relationships(p) as n with startNode(n).id as start_node,endNode(n).id as end_node,nodes_path,totalCost
-        match (fn:RoadJunction{id:start_node})-[r:ROUTE]->(fn2:RoadJunction{id:end_node})
-        return nodes_path, totalCost, sum(r.distance) as total_distance, sum(r.green_area) as total_green_area, 
-        avg(r.pm10), sum(r.pm10_metre) as total_pm10_metre, sum(r.inv_ga_metre) as total_inv_ga_metre, 
-        sum(r.green_area_distance) as total_green_area_distance
+        MERGE (m:GraphMetadata {name: 'routing'})
+        SET m.data_version = coalesce(m.data_version, 0) + 1
+        RETURN m.data_version
         """
+        result = tx.run(query)
+        return result.single()[0]
 
-        result = tx.run(query, source=source, target=target, weight_property=weight_property)
+    def ensure_routing_projection(self, data_version=None, combined_parameters=None):
+        """
+        Name of the in-memory projection of the graph for the current data version, with all the weight properties
+        or, given the combined weight parameters, with the combined weight for their ratios.
+        The projection is created only when missing, and reused by all the route queries of the same version
+        (and ratios).
+        """
+        if data_version is None:
+            data_version = self.get_data_version()
+        graph_name = f"{ROUTING_PROJECTION}_v{data_version}"
+        if combined_parameters is not None:
+            graph_name = combined_projection_name(graph_name, combined_parameters)
+        if graph_name == self.routing_projection:
+            return graph_name
+        if graph_name in self.combined_projections:
+            self.combined_projections.move_to_end(graph_name)
+            return graph_name
 
-        tx.run("""call gds.graph.drop('subgraph_routing')""")
+        with self.driver.session() as session:
+            try:
+                session.write_transaction(self._ensure_routing_projection, graph_name,
+                                          f"{ROUTING_PROJECTION}_v{data_version}", combined_parameters)
+            except Exception as e:
+                # Another process can create the same projection at the same time
+                if not session.write_transaction(self._routing_projection_exists, graph_name):
+                    raise e
+
+        if combined_parameters is None:
+            self.routing_projection = graph_name
+        else:
+            # The projections of the previous data versions have been dropped
+            self.combined_projections = OrderedDict(
+                (name, None) for name in self.combined_projections
+                if name.startswith(f"{ROUTING_PROJECTION}_v{data_version}_"))
+            self.combined_projections[graph_name] = None
+            while len(self.combined_projections) > MAX_COMBINED_PROJECTIONS:
+                evicted, _ = self.combined_projections.popitem(last=False)
+                with self.driver.session() as session:
+                    session.write_transaction(self._drop_projection, evicted)
+        return graph_name
 
-        return result.values()
+    @staticmethod
+    def _drop_projection(tx, graph_name):
+        tx.run(DROP_PROJECTION_QUERY, graph_name=graph_name).consume()
 
-    def a_star_path(self, source, target, weight_property):
-        with self.driver.session() as session:
-            result = session.write_transaction(self._a_star_path, source, target, weight_property)
-            return result
+    @staticmethod
+    def _routing_projection_exists(tx, graph_name):
+        result = tx.run(ROUTING_PROJECTION_EXISTS_QUERY, graph_name=graph_name)
+        return result.single()[0]
 
     @staticmethod
-    def _a_star_path(tx, source, target, weight_property):
-        sub_graph_query = ("""
-            CALL gds.graph.project('subgraph_routing', 
-                ['RoadJunction'], ['ROUTE'], 
-                {nodeProperties: ['lat', 'lon'], 
-                relationshipProperties: ['%s']});
-        """) % weight_property
+    def _ensure_routing_projection(tx, graph_name, version_name, combined_parameters):
+        """
+        Query to create the routing projection, if missing, dropping the ones of the previous data versions
+        """
+        if App._routing_projection_exists(tx, graph_name):
+            return
 
-        tx.run(sub_graph_query)
+        tx.run(DROP_STALE_PROJECTIONS_QUERY, prefix=ROUTING_PROJECTION + "_v", graph_name=version_name)
+        if combined_parameters is None:
+            tx.run(PROJECT_ROUTING_QUERY, graph_name=graph_name, weight_properties=WEIGHT_PROPERTIES)
+        else:
+            tx.run(PROJECT_COMBINED_ROUTING_QUERY, dict(combined_parameters, graph_name=graph_name))
 
-        query = """        
-        MATCH (s:RoadJunction {id: $source})
-        MATCH (t:RoadJunction {id: $target})
-        CALL gds.shortestPath.astar.stream('subgraph_routing', {
-            sourceNode: s,
-            targetNode: t,
-            latitudeProperty: 'lat',
-            longitudeProperty: 'lon',
-            relationshipWeightProperty: $weight_property
-        })
-        YIELD index, sourceNode, targetNode, totalCost, nodeIds, path
-        with  [nodeId IN nodeIds | gds.util.asNode(nodeId).id] AS nodes_path, totalCost,path as p
-        unwind relationships(p) as n with startNode(n).id as start_node,endNode(n).id as end_node,nodes_path,totalCost
-        match (fn:RoadJunction{id:start_node})-[r:ROUTE]->(fn2:RoadJunction{id:end_node})
-        return nodes_path, totalCost, sum(r.distance) as total_distance, sum(r.green_area) as total_green_area, 
-        avg(r.pm10), sum(r.pm10_metre) as total_pm10_metre, sum(r.inv_ga_metre) as total_inv_ga_metre,
-        sum(r.green_area_distance) as total_green_area_distance
+    def get_combined_weight_stats(self, data_version):
+        """
+        Ranges of pm10_metre and inv_ga_metre used to normalize the combined weight, cached for the data version
         """
+        if data_version not in self.combined_weight_stats:
+            with self.driver.session() as session:
+                stats = session.read_transaction(self._get_combined_weight_stats)
+            self.combined_weight_stats = {data_version: stats}
+        return self.combined_weight_stats[data_version]
 
-        result = tx.run(query, source=source, target=target, weight_property=weight_property)
+    @staticmethod
+    def _get_combined_weight_stats(tx):
+        result = tx.run(COMBINED_WEIGHT_STATS_QUERY)
+        return result.single().data()
 
-        tx.run("""call gds.graph.drop('subgraph_routing')""")
+    def routing_parameters(self, weight_property, ratios=None):
+        """
+        Projection and combined weight parameters of a route query. The combined weight is computed at query time
+        from the ratios of the request, nothing is written in the graph.
+        """
+        data_version = self.get_data_version()
+        if weight_property != 'combined_weight':
+            return self.ensure_routing_projection(data_version), NO_COMBINED_WEIGHT
+        if ratios is None:
+            raise ValueError("The combined weight needs the pm10 and inverse green area ratios")
+
+        parameters = dict(ratios, **self.get_combined_weight_stats(data_version))
+        return self.ensure_routing_projection(data_version, parameters), parameters
+
+    # The route queries run in write transactions, like the creation of the projection: a projection lives only
+    # in the memory of the member that created it, the leader of a cluster
+    def dijkstra_path(self, source, target, weight_property, ratios=None):
+        graph_name, parameters = self.routing_parameters(weight_property, ratios)
+        with self.driver.session() as session:
+            result = session.write_transaction(self._dijkstra_path, graph_name, source, target, weight_property,
+                                               parameters)
+            return result
+
+    @staticmethod
+    def _dijkstra_path(tx, graph_name, source, target, weight_property, parameters):
+        query = DIJKSTRA_QUERY
+
+        result = tx.run(query, dict(parameters, graph_name=graph_name, source=source, target=target,
+                                    weight_property=weight_property))
 
         return result.values()
 
-    def top_k_paths(self, source, target, weight_property, k):
+    def a_star_path(self, source, target, weight_property, ratios=None):
+        graph_name, parameters = self.routing_parameters(weight_property, ratios)
         with self.driver.session() as session:
-            result = session.write_transaction(self._top_k_paths, source, target, weight_property, k)
+            result = session.write_transaction(self._a_star_path, graph_name, source, target, weight_property,
+                                               parameters)
             return result
 
     @staticmethod
-    def _top_k_paths(tx, source, target, weight_property, k):
-        sub_graph_query = ("""
-            CALL gds.graph.project('subgraph_routing', 
-                ['RoadJunction'], ['ROUTE'], 
-                {nodeProperties: ['lat', 'lon'], 
-                relationshipProperties: ['%s']});
-        """) % weight_property
+    def _a_star_path(tx, graph_name, source, target, weight_property, parameters):
+        query = A_STAR_QUERY
 
-        tx.run(sub_graph_query)
+        result = tx.run(query, dict(parameters, graph_name=graph_name, source=source, target=target,
+                                    weight_property=weight_property))
 
-        query = """
-        MATCH (s:RoadJunction {id: $source})
-        MATCH (t:RoadJunction {id: $target})
-        CALL gds.shortestPath.yens.stream('subgraph_routing', {
-            sourceNode: s, 
-            targetNode: t,
-            k: $k,
-            relationshipWeightProperty: $weight_property
-        })
-        YIELD index, sourceNode, targetNode, totalCost, nodeIds, path
-        with  [nodeId IN nodeIds | gds.util.asNode(nodeId).id] AS nodes_path, totalCost,path as p
-        unwind relationships(p) as n with startNode(n).id as start_node,endNode(n).id as end_node,nodes_path,totalCost
-        match (fn:RoadJunction{id:start_node})-[r:ROUTE]->(fn2:RoadJunction{id:end_node})
-        return nodes_path, totalCost, sum(r.distance) as total_distance, sum(r.green_area) as total_green_area, 
-        avg(r.pm10), sum(r.pm10_metre) as total_pm10_metre, sum(r.inv_ga_metre) as total_inv_ga_metre,
-        sum(r.green_area_distance) as total_green_area_distance
-        """
+        return result.values()
 
-        result = tx.run(query, source=source, target=target, weight_property=weight_property, k=k)
+    def top_k_paths(self, source, target, weight_property, k, ratios=None):
+        graph_name, parameters = self.routing_parameters(weight_property, ratios)
+        with self.driver.session() as session:
+            result = session.write_transaction(self._top_k_paths, graph_name, source, target, weight_property, k,
+                                               parameters)
+            return result
 
-        tx.run("""call gds.graph.drop('subgraph_routing')""")
+    @staticmethod
+    def _top_k_paths(tx, graph_name, source, target, weight_property, k, parameters):
+        query = TOP_K_QUERY
+
+        result = tx.run(query, dict(parameters, graph_name=graph_name, source=source, target=target,
+                                    weight_property=weight_property, k=k))
 
         return result.values()
 
     def get_edges_endpoints(self):
         with self.driver.session() as session:
-            result = session.write_transaction(self._get_edges_endpoints)
+            result = session.read_transaction(self._get_edges_endpoints)
             return result
 
     @staticmethod
     def _get_edges_endpoints(tx):
-        query = """
-        MATCH (s:RoadJunction)-[r:ROUTE]->(d:RoadJunction)
-        WHERE s.id < d.id
-        RETURN s.id AS source, d.id AS destination, 
-        s.lon AS source_lon, s.lat AS source_lat, 
-        d.lon AS destination_lon, d.lat AS destination_lat
-        """
+        query = EDGES_ENDPOINTS_QUERY
         result = tx.run(query)
         return result.values()
 
-    def add_edge_air_quality_in_bulk(self, id_pairs, mean_air_quality_values):
+    def create_road_junction_index(self):
         with self.driver.session() as session:
-            result = session.write_transaction(self._add_edge_air_quality_in_bulk, id_pairs, mean_air_quality_values)
-            return result
+            session.run("CREATE INDEX road_junction_id IF NOT EXISTS FOR (n:RoadJunction) ON (n.id)").consume()
+
+    def add_edge_air_quality_in_bulk(self, id_pairs, mean_air_quality_values, batch_size=10000, concurrency=1):
+        """
+        Write the air quality of the edges, and their pm10_metre, in batches of batch_size edges, each batch in its
+        own transaction, running up to concurrency batches at the same time on separate sessions.
+        Returns the number of updated relationships, the number of batches and the elapsed time.
+        """
+        start_time = time.time()
+        self.create_road_junction_index()
+
+        def write_batch(start):
+            pairs = [{'source': pair[0], 'destination': pair[1], 'mean_air_quality': mean_air_quality}
+                     for pair, mean_air_quality in zip(id_pairs[start:start + batch_size],
+                                                       mean_air_quality_values[start:start + batch_size])]
+            with self.driver.session() as session:
+                return session.write_transaction(self._add_edge_air_quality_in_bulk, pairs)
+
+        starts = range(0, len(id_pairs), batch_size)
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+            updated = sum(executor.map(write_batch, starts))
+        self.bump_data_version()
+
+        return {'updated_relationships': updated, 'batches': len(starts), 'elapsed_time': time.time() - start_time}
 
     @staticmethod
-    def _add_edge_air_quality_in_bulk(tx, id_pairs, mean_air_quality_values):
+    def _add_edge_air_quality_in_bulk(tx, pairs):
+        """
+        Query to set the air quality and pm10_metre of a batch of edges, in both directions, finding the endpoints
+        through the index
+        """
         query = """
         UNWIND $pairs AS pair
-        MATCH (s:RoadJunction)-[r:ROUTE]->(d:RoadJunction)
-        WHERE s.id < d.id AND s.id = pair.source AND d.id = pair.destination
-        SET r.pm10 = pair.mean_air_quality
-        WITH s, d, pair
-        MATCH (d)-[r2:ROUTE]->(s)
-        SET r2.pm10 = pair.mean_air_quality
-        RETURN pair.mean_air_quality
-        """
-        result = tx.run(query, pairs=[{'source': pair[0], 'destination': pair[1], 'mean_air_quality': mean_air_quality}
-                                      for pair, mean_air_quality in zip(id_pairs, mean_air_quality_values)])
-        return result.values()
+        MATCH (s:RoadJunction {id: pair.source})
+        MATCH (d:RoadJunction {id: pair.destination})
+        MATCH (s)-[r:ROUTE]-(d)
+        SET r.pm10 = pair.mean_air_quality, r.pm10_metre = pair.mean_air_quality * r.distance
+        RETURN count(r)
+        """
+        result = tx.run(query, pairs=pairs)
+        return result.single()[0]
+
+    def update_edge_air_quality(self, id_pairs, mean_air_quality_values):
+        with self.driver.session() as session:
+            result = session.write_transaction(self._update_edge_air_quality, id_pairs, mean_air_quality_values)
+        self.bump_data_version()
+        return result
+
+    @staticmethod
+    def _update_edge_air_quality(tx, id_pairs, mean_air_quality_values):
+        """
+        Query to update pm10 and pm10_metre of some edges (in both directions)
+        """
+        pairs = [{'source': pair[0], 'destination': pair[1], 'mean_air_quality': mean_air_quality}
+                 for pair, mean_air_quality in zip(id_pairs, mean_air_quality_values)]
+
+        query = """
+        UNWIND $pairs AS pair
+        MATCH (s:RoadJunction {id: pair.source})-[r:ROUTE]-(d:RoadJunction {id: pair.destination})
+        SET r.pm10 = pair.mean_air_quality, r.pm10_metre = pair.mean_air_quality * r.distance
+        RETURN count(r)
+        """
+        result = tx.run(query, pairs=pairs).values()
+        return result
 
     def get_extreme_lon_lat(self):
         with self.driver.session() as session:
-            result = session.write_transaction(self._get_extreme_lon_lat)
+            result = session.read_transaction(self._get_extreme_lon_lat)
             return result
 
     @staticmethod
@@ -227,55 +510,40 @@ class App:
 
     def get_road_junction_nodes(self):
         with self.driver.session() as session:
-            result = session.write_transaction(self._get_road_junction_nodes)
+            result = session.read_transaction(self._get_road_junction_nodes)
             return result
 
     @staticmethod
     def _get_road_junction_nodes(tx):
-        query = """
-        MATCH (n:RoadJunction)
-        RETURN n.id as id, n.lon as lon, n.lat as lat
-        """
+        query = ROAD_JUNCTION_NODES_QUERY
         result = tx.run(query)
         return result.values()
 
     def get_road_edges(self):
         with self.driver.session() as session:
-            result = session.write_transaction(self._get_road_edges)
+            result = session.read_transaction(self._get_road_edges)
             return result
 
     @staticmethod
     def _get_road_edges(tx):
-        query = """
-        MATCH (s:RoadJunction)-[r:ROUTE]->(d:RoadJunction)
-        RETURN s.id AS source, d.id AS target, 
-        s.lon AS source_lon, s.lat AS source_lat, 
-            d.lon AS target_lon, d.lat AS target_lat, 
-            r.name AS name,
-            r.distance AS distance, r.green_area AS green_area, r.pm10 AS pm10,
-            r.pm10_metre AS pm10_metre, r.inv_ga_metre AS inv_ga_metre, r.combined_weight AS combined_weight
-        """
+        query = ROAD_EDGES_QUERY
         result = tx.run(query)
         return result.values()
 
     def get_distances(self):
         with self.driver.session() as session:
-            result = session.write_transaction(self._get_distances)
+            result = session.read_transaction(self._get_distances)
             return result
 
     @staticmethod
     def _get_distances(tx):
-        query = """
-        MATCH (s:RoadJunction)-[r:ROUTE]->(d:RoadJunction)
-        WHERE s.id < d.id
-        RETURN r.distance
-        """
+        query = DISTANCES_QUERY
         result = tx.run(query)
         return result.values()
 
     def get_pm10_route(self):
         with self.driver.session() as session:
-            result = session.write_transaction(self._get_pm10_route)
+            result = session.read_transaction(self._get_pm10_route)
             return result
 
     @staticmethod
@@ -290,7 +558,7 @@ class App:
 
     def get_inv_ga_route(self):
         with self.driver.session() as session:
-            result = session.write_transaction(self._get_inv_ga_route)
+            result = session.read_transaction(self._get_inv_ga_route)
             return result
 
     @staticmethod
@@ -303,117 +571,232 @@ class App:
         result = tx.run(query)
         return result.values()
 
-    def add_combined_property(self, weight):
+    def update_derived_edge_properties(self, batch_size=10000):
+        """
+        Compute in a single pass over the ROUTE relationships the properties derived from distance, green_area
+        and pm10: pm10_metre, inv_ga_metre and green_area_distance (the combined weight is computed at query time
+        from them). The pass is committed every batch_size relationships.
+        Returns the number of relationships, the ranges of the derived properties and the elapsed time.
+        """
+        start_time = time.time()
         with self.driver.session() as session:
-            result = session.write_transaction(self._add_combined_property, weight)
-            return result
+            stats = session.read_transaction(self._get_derived_edge_properties_stats)
+            session.run(self._derived_edge_properties_query(), dict(batch_size=batch_size)).consume()
+        self.bump_data_version()
+
+        return dict(stats, elapsed_time=time.time() - start_time)
 
     @staticmethod
-    def _add_combined_property(tx, parameters):
-        query = """    
-        CALL {
-            MATCH (s:RoadJunction)-[r:ROUTE]->(d:RoadJunction)
-            RETURN 
-                max(r.pm10_metre) AS max_pm10_metre, 
-                max(r.inv_ga_metre) AS max_inv_ga_metre,
-                min(r.pm10_metre) AS min_pm10,
-                min(r.inv_ga_metre) AS min_inv_ga
-        }
-        
+    def _get_derived_edge_properties_stats(tx):
+        """
+        Query to get the number of relationships and the ranges of the derived properties, before writing them
+        """
+        query = """
         MATCH (s:RoadJunction)-[r:ROUTE]->(d:RoadJunction)
-        WHERE s.id < d.id        
-        WITH 
-            r, s, d, max_pm10_metre, max_inv_ga_metre, min_pm10, min_inv_ga,
-            (r.pm10_metre - min_pm10) / (max_pm10_metre - min_pm10) AS normalized_pm10,
-            (r.inv_ga_metre - min_inv_ga) / (max_inv_ga_metre - min_inv_ga) AS normalized_inv_ga
-                        
         WITH 
-            r, s, d,
-           ($pm10_ratio * normalized_pm10) + ($inv_green_area_ratio * normalized_inv_ga) AS weighted_average
-        
-        SET r.combined_weight = weighted_average
-        
-        WITH r, s, d, weighted_average
-        MATCH (d)-[r2:ROUTE]->(s)  
-        SET r2.combined_weight = weighted_average
-        
-        RETURN r, r.combined_weight
-        """
-
-        result = tx.run(query, parameters=parameters)
-        return result.values()
-
-    def add_pm10_metre(self):
-        with self.driver.session() as session:
-            result = session.write_transaction(self._add_pm10_metre)
-            return result
+            r.pm10 * r.distance AS pm10_metre,
+            r.distance / ((r.green_area/100) + 1) AS inv_ga_metre,
+            r.distance * ((r.green_area+0.0)/100) AS green_area_distance
+        RETURN 
+            count(*) AS relationships,
+            min(pm10_metre) AS min_pm10_metre, max(pm10_metre) AS max_pm10_metre,
+            min(inv_ga_metre) AS min_inv_ga_metre, max(inv_ga_metre) AS max_inv_ga_metre,
+            min(green_area_distance) AS min_green_area_distance, max(green_area_distance) AS max_green_area_distance
+        """
+        result = tx.run(query)
+        return result.single().data()
 
     @staticmethod
-    def _add_pm10_metre(tx):
-        query = """
+    def _derived_edge_properties_query():
+        """
+        Query to write the derived properties on every relationship, in transactions of $batch_size rows
+        """
+        return """
         MATCH (s:RoadJunction)-[r:ROUTE]->(d:RoadJunction)
-        WHERE s.id < d.id
-        WITH r, s, d,
-            (r.pm10) * (r.distance) AS pm10_per_metre
-        
-        SET r.pm10_metre = pm10_per_metre
-    
-        WITH r, s, d, pm10_per_metre
-        MATCH (d)-[r2:ROUTE]->(s)  
-        SET r2.pm10_metre = pm10_per_metre
-    
-        RETURN r, r.pm10_metre
+        CALL {
+            WITH r
+            SET 
+                r.pm10_metre = r.pm10 * r.distance,
+                r.inv_ga_metre = r.distance / ((r.green_area/100) + 1),
+                r.green_area_distance = r.distance * ((r.green_area+0.0)/100)
+        } IN TRANSACTIONS OF $batch_size ROWS
         """
 
-        result = tx.run(query)
-        return result.values()
 
-    def add_inv_green_area_metre(self):
-        with self.driver.session() as session:
-            result = session.write_transaction(self._add_inv_green_area_metre)
-            return result
+class AsyncApp:
+    """
+    Asynchronous version of App, built on the async neo4j driver: many route and export queries
+    can run at the same time over a single connection pool, reads in read transactions
+    (that a cluster can route to the read replicas) and writes in write transactions.
+    The queries on the routing projections run on the writer, as in App.
+    """
+    def __init__(self, uri, user, password, max_connection_pool_size=50, connection_acquisition_timeout=60.0):
+        self.driver = AsyncGraphDatabase.driver(uri, auth=(user, password),
+                                                max_connection_pool_size=max_connection_pool_size,
+                                                connection_acquisition_timeout=connection_acquisition_timeout)
+        self.routing_projection = None
+        self.combined_projections = OrderedDict()
+        self.combined_weight_stats = {}
+        self.projection_lock = asyncio.Lock()
+
+        # Queries waiting for a connection are limited to the size of the pool
+        self.semaphore = asyncio.Semaphore(max_connection_pool_size)
+
+    async def verify_connectivity(self):
+        await self.driver.verify_connectivity()
+
+    async def close(self):
+        await self.driver.close()
 
     @staticmethod
-    def _add_inv_green_area_metre(tx):
-        query = """
-        MATCH (s:RoadJunction)-[r:ROUTE]->(d:RoadJunction)
-        WHERE s.id < d.id
-        WITH r, s, d,
-            r.distance / ((r.green_area/100) + 1)  AS inverse_green_area_metre
-        
-        SET r.inv_ga_metre = inverse_green_area_metre
-    
-        WITH r, s, d, inverse_green_area_metre
-        MATCH (d)-[r2:ROUTE]->(s)  
-        SET r2.inv_ga_metre = inverse_green_area_metre
-    
-        RETURN r, r.inv_ga_metre
+    async def _values(tx, query, parameters):
+        result = await tx.run(query, parameters)
+        return await result.values()
+
+    async def _read(self, query, **parameters):
+        async with self.semaphore:
+            async with self.driver.session(default_access_mode=READ_ACCESS) as session:
+                return await session.execute_read(self._values, query, parameters)
+
+    async def _write(self, query, **parameters):
+        async with self.semaphore:
+            async with self.driver.session(default_access_mode=WRITE_ACCESS) as session:
+                return await session.execute_write(self._values, query, parameters)
+
+    async def _read_projection(self, query, **parameters):
+        # A projection lives in the memory of the member that created it, with a write transaction
+        return await self._write(query, **parameters)
+
+    async def _projection_exists(self, graph_name):
+        return (await self._read_projection(ROUTING_PROJECTION_EXISTS_QUERY, graph_name=graph_name))[0][0]
+
+    async def get_data_version(self):
+        result = await self._read(DATA_VERSION_QUERY)
+        return result[0][0]
+
+    async def ensure_routing_projection(self, data_version=None, combined_parameters=None):
+        """
+        Name of the in-memory projection of the graph for the current data version (and ratios of the combined
+        weight parameters), as App.ensure_routing_projection.
+        The lock makes the concurrent queries wait for a single creation of the projection.
+        """
+        if data_version is None:
+            data_version = await self.get_data_version()
+        version_name = f"{ROUTING_PROJECTION}_v{data_version}"
+        graph_name = version_name
+        if combined_parameters is not None:
+            graph_name = combined_projection_name(version_name, combined_parameters)
+
+        async with self.projection_lock:
+            if graph_name == self.routing_projection:
+                return graph_name
+            if graph_name in self.combined_projections:
+                self.combined_projections.move_to_end(graph_name)
+                return graph_name
+
+            if not await self._projection_exists(graph_name):
+                try:
+                    await self._write(DROP_STALE_PROJECTIONS_QUERY, prefix=ROUTING_PROJECTION + "_v",
+                                      graph_name=version_name)
+                    if combined_parameters is None:
+                        await self._write(PROJECT_ROUTING_QUERY, graph_name=graph_name,
+                                          weight_properties=WEIGHT_PROPERTIES)
+                    else:
+                        await self._write(PROJECT_COMBINED_ROUTING_QUERY, graph_name=graph_name,
+                                          **combined_parameters)
+                except Exception as e:
+                    # Another process can create the same projection at the same time
+                    if not await self._projection_exists(graph_name):
+                        raise e
+
+            if combined_parameters is None:
+                self.routing_projection = graph_name
+            else:
+                self.combined_projections = OrderedDict((name, None) for name in self.combined_projections
+                                                        if name.startswith(version_name + "_"))
+                self.combined_projections[graph_name] = None
+                while len(self.combined_projections) > MAX_COMBINED_PROJECTIONS:
+                    evicted, _ = self.combined_projections.popitem(last=False)
+                    await self._write(DROP_PROJECTION_QUERY, graph_name=evicted)
+            return graph_name
+
+    async def get_combined_weight_stats(self, data_version):
         """
+        Ranges used to normalize the combined weight, cached for the data version
+        """
+        if data_version not in self.combined_weight_stats:
+            result = await self._read(COMBINED_WEIGHT_STATS_QUERY)
+            self.combined_weight_stats = {data_version: dict(zip(
+                ['min_pm10_metre', 'max_pm10_metre', 'min_inv_ga_metre', 'max_inv_ga_metre'], result[0]))}
+        return self.combined_weight_stats[data_version]
 
-        result = tx.run(query)
-        return result.values()
+    async def routing_parameters(self, weight_property, ratios=None):
+        """
+        Projection and combined weight parameters of a route query, as App.routing_parameters
+        """
+        data_version = await self.get_data_version()
+        if weight_property != 'combined_weight':
+            return await self.ensure_routing_projection(data_version), NO_COMBINED_WEIGHT
+        if ratios is None:
+            raise ValueError("The combined weight needs the pm10 and inverse green area ratios")
+
+        parameters = dict(ratios, **(await self.get_combined_weight_stats(data_version)))
+        return await self.ensure_routing_projection(data_version, parameters), parameters
+
+    async def dijkstra_path(self, source, target, weight_property, ratios=None):
+        graph_name, parameters = await self.routing_parameters(weight_property, ratios)
+        return await self._read_projection(DIJKSTRA_QUERY, graph_name=graph_name, source=source, target=target,
+                                           weight_property=weight_property, **parameters)
+
+    async def a_star_path(self, source, target, weight_property, ratios=None):
+        graph_name, parameters = await self.routing_parameters(weight_property, ratios)
+        return await self._read_projection(A_STAR_QUERY, graph_name=graph_name, source=source, target=target,
+                                           weight_property=weight_property, **parameters)
+
+    async def top_k_paths(self, source, target, weight_property, k, ratios=None):
+        graph_name, parameters = await self.routing_parameters(weight_property, ratios)
+        return await self._read_projection(TOP_K_QUERY, graph_name=graph_name, source=source, target=target,
+                                           weight_property=weight_property, k=k, **parameters)
+
+    async def route(self, source, target, weight_property, algorithm, k=2, ratios=None):
+        """
+        Paths between two nodes with one of the algorithms of routing_path, the ratios are needed only for the
+        combined weight
+        """
+        if algorithm == 'dijkstra':
+            return await self.dijkstra_path(source, target, weight_property, ratios)
+        elif algorithm == 'a_star':
+            return await self.a_star_path(source, target, weight_property, ratios)
+        elif algorithm == 'top_k':
+            return await self.top_k_paths(source, target, weight_property, k, ratios)
+        return []
 
-    def add_green_area_distance(self):
-        with self.driver.session() as session:
-            result = session.write_transaction(self._add_green_area_distance)
-            return result
+    async def get_edges_endpoints(self):
+        return await self._read(EDGES_ENDPOINTS_QUERY)
 
-    @staticmethod
-    def _add_green_area_distance(tx):
-        query = """
-        MATCH (s:RoadJunction)-[r:ROUTE]->(d:RoadJunction)
-        WHERE s.id < d.id
-        WITH r, s, d,
-            r.distance * ((r.green_area+0.0)/100) AS green_area_distance
-        
-        SET r.green_area_distance = green_area_distance
-    
-        WITH r, s, d, green_area_distance
-        MATCH (d)-[r2:ROUTE]->(s)  
-        SET r2.green_area_distance = green_area_distance
-    
-        RETURN r, r.green_area_distance
+    async def get_road_junction_nodes(self):
+        return await self._read(ROAD_JUNCTION_NODES_QUERY)
+
+    async def get_road_edges(self):
+        return await self._read(ROAD_EDGES_QUERY)
+
+    async def get_distances(self):
+        return await self._read(DISTANCES_QUERY)
+
+    async def gather(self, *queries):
         """
+        Run the given coroutines (route or export queries of this class) at the same time over the connection pool,
+        returning their results in the same order
+        """
+        return await asyncio.gather(*queries)
 
-        result = tx.run(query)
-        return result.values()
+    async def route_many(self, requests):
+        """
+        Run many route requests at the same time. Each request is a dictionary with the fields of routing_query.json:
+        source_id, destination_id, weight, algorithm and, optionally, top_k and combined_weight.
+        """
+        return await self.gather(*[self.route(request['source_id'], request['destination_id'], request['weight'],
+                                              request['algorithm'], request.get('top_k', 2),
+                                              combined_weight_ratios(request['combined_weight'])
+                                              if 'combined_weight' in request else None)
+                                   for request in requests])
@@ -0,0 +1,166 @@
+import sys
+import json
+import time
+import numpy as np
+from scipy.sparse import csgraph
+from osgeo import gdal, osr
+from graph_bridge import combined_weight_ratios
+from routing_engine import RoutingGraph
+
+# Value of the raster cells not reached within the budget
+NO_DATA = -1.0
+
+
+def isochrones(graph, sources, budget, weight='distance', chunk_size=64):
+    """
+    Nodes reachable from every source node index with a cost within the budget, with a Dijkstra search that
+    stops at the budget. The searches run in chunks of sources, each chunk in a single call to csgraph.
+    Returns for every source the arrays of the reached node indices and of their costs, sorted by cost.
+    """
+    matrix = graph.weight_matrix(weight)
+    reached = []
+    for start in range(0, len(sources), chunk_size):
+        costs = np.atleast_2d(csgraph.dijkstra(matrix, indices=sources[start:start + chunk_size], limit=budget))
+        for row in costs:
+            nodes = np.flatnonzero(row <= budget)
+            order = np.argsort(row[nodes], kind='stable')
+            reached.append((nodes[order], row[nodes[order]]))
+    return reached
+
+
+def reached_edges(graph, nodes, costs, budget, weight='distance'):
+    """
+    Edges leaving the reached nodes and the fraction of each that is within the budget, assuming the cost
+    grows linearly along the edge
+    """
+    node_cost = np.full(graph.node_count, np.inf)
+    node_cost[nodes] = costs
+    edges = np.flatnonzero(np.isfinite(node_cost[graph.edge_sources]))
+    values = graph.weight_array(weight)[edges]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.where(values > 0, (budget - node_cost[graph.edge_sources[edges]]) / values, 1.0)
+    # An edge also reached from its target is covered by the other direction
+    keep = np.isfinite(values) & (fraction > 0)
+    return edges[keep], np.clip(fraction[keep], 0.0, 1.0)
+
+
+def isochrone_geojson(graph, source, nodes, costs, budget, weight='distance'):
+    """
+    GeoJSON feature of an isochrone: the reached part of the edges as a MultiLineString
+    """
+    edges, fraction = reached_edges(graph, nodes, costs, budget, weight)
+    start = np.column_stack((graph.lon[graph.edge_sources[edges]], graph.lat[graph.edge_sources[edges]]))
+    end = np.column_stack((graph.lon[graph.indices[edges]], graph.lat[graph.indices[edges]]))
+    end = start + fraction[:, None] * (end - start)
+
+    return {"type": "Feature",
+            "geometry": {"type": "MultiLineString", "coordinates": np.stack((start, end), axis=1).tolist()},
+            "properties": {"source": str(graph.node_ids[source]), "weight": weight, "budget": budget,
+                           "nodes": len(nodes), "max_cost": float(costs.max()) if len(costs) else 0.0}}
+
+
+def save_isochrones_geojson(features, file_name):
+    with open(file_name, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+    print(f"GeoJSON file saved at {file_name}")
+
+
+def isochrone_grid(graph, nodes, costs, budget, weight='distance', cell_size=0.0001, spacing=5.0):
+    """
+    Raster of an isochrone in longitude and latitude: every cell crossed by a reached edge has the lowest cost
+    of the points sampled every spacing metres along the reached part of the edges, NO_DATA elsewhere.
+    Returns the grid and its GDAL geotransform.
+    """
+    edges, fraction = reached_edges(graph, nodes, costs, budget, weight)
+    sources, targets = graph.edge_sources[edges], graph.indices[edges]
+    node_cost = np.full(graph.node_count, np.inf)
+    node_cost[nodes] = costs
+
+    # Points along the edges, with the cost growing linearly from the source to the target
+    length = graph.attributes['distance'][edges].astype(np.float64) * fraction
+    samples = np.ceil(np.nan_to_num(length) / spacing).astype(np.int64) + 1
+    point_edges = np.repeat(np.arange(len(edges)), samples)
+    first = np.cumsum(samples) - samples
+    position = (np.arange(len(point_edges)) - np.repeat(first, samples)) / np.repeat(np.maximum(samples - 1, 1),
+                                                                                     samples)
+    position *= fraction[point_edges]
+    lon = graph.lon[sources][point_edges] + position * (graph.lon[targets] - graph.lon[sources])[point_edges]
+    lat = graph.lat[sources][point_edges] + position * (graph.lat[targets] - graph.lat[sources])[point_edges]
+    values = graph.weight_array(weight)[edges]
+    point_cost = node_cost[sources][point_edges] + position * np.nan_to_num(values[point_edges], posinf=0.0)
+
+    lon_min, lat_max = np.min(lon, initial=np.inf), np.max(lat, initial=-np.inf)
+    if not np.isfinite(lon_min):
+        return np.full((1, 1), NO_DATA), (0.0, cell_size, 0.0, 0.0, 0.0, -cell_size)
+    columns = np.floor((lon - lon_min) / cell_size).astype(np.int64)
+    rows = np.floor((lat_max - lat) / cell_size).astype(np.int64)
+
+    grid = np.full((rows.max() + 1, columns.max() + 1), np.inf)
+    np.minimum.at(grid, (rows, columns), point_cost)
+    grid[np.isinf(grid)] = NO_DATA
+    return grid, (lon_min, cell_size, 0.0, lat_max, 0.0, -cell_size)
+
+
+def save_isochrone_raster(grid, transform, file_name):
+    """
+    Save the grid of isochrone_grid as a GeoTIFF in WGS84
+    """
+    raster = gdal.GetDriverByName('GTiff').Create(file_name, grid.shape[1], grid.shape[0], 1, gdal.GDT_Float32)
+    raster.SetGeoTransform(transform)
+    reference = osr.SpatialReference()
+    reference.ImportFromEPSG(4326)
+    raster.SetProjection(reference.ExportToWkt())
+    band = raster.GetRasterBand(1)
+    band.WriteArray(grid.astype(np.float32))
+    band.SetNoDataValue(NO_DATA)
+    raster.FlushCache()
+    print(f"Raster file saved at {file_name}")
+
+
+def main(config, routing_query):
+    gdal.UseExceptions()
+    isochrone_query = routing_query['isochrone']
+
+    # Neo4j is read only without a graph snapshot
+    graph = RoutingGraph.load(config)
+
+    weight = routing_query['weight']
+    if weight == 'combined_weight':
+        weight = graph.combined_weight(**combined_weight_ratios(routing_query['combined_weight']))
+
+    source_ids = isochrone_query.get('source_ids', [routing_query['source_id']])
+    sources = [graph.index_of(source_id) for source_id in source_ids]
+    unknown = [source_id for source_id, source in zip(source_ids, sources) if source is None]
+    if unknown:
+        print(f"Unknown road junctions: {unknown}")
+    sources = np.array([source for source in sources if source is not None], dtype=np.int64)
+
+    start_time = time.time()
+    budget = isochrone_query['budget']
+    reached = isochrones(graph, sources, budget, weight)
+    print(f"{len(sources)} isochrones in {time.time() - start_time:.3f} s")
+
+    suffix = f"{routing_query['weight']}_{budget}_{routing_query['path_file_suffix']}"
+    save_isochrones_geojson([isochrone_geojson(graph, source, nodes, costs, budget, weight)
+                             for source, (nodes, costs) in zip(sources, reached)],
+                            f"output/routing/isochrones_{suffix}.geojson")
+    if isochrone_query.get('raster', False):
+        for source, (nodes, costs) in zip(sources, reached):
+            grid, transform = isochrone_grid(graph, nodes, costs, budget, weight,
+                                             isochrone_query.get('cell_size', 0.0001))
+            save_isochrone_raster(grid, transform, f"output/routing/isochrone_{graph.node_ids[source]}_{suffix}.tif")
+
+    return reached
+
+
+if __name__ == "__main__":
+    with open("data/config.json", "r") as file:
+        config_file = json.load(file)
+    with open("data/routing_query.json", "r") as file:
+        query = json.load(file)
+
+    try:
+        main(config_file, query)
+    except Exception as e:
+        print(e)
+        sys.exit(1)
@@ -0,0 +1,152 @@
+import copy
+import time
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from routing_engine import WEIGHT_PROPERTIES
+
+# Tables of the combined weight: pm10_metre and inv_ga_metre shifted by their minimum, so that the combined weight
+# of any ratios is a non negative linear combination of them
+SHIFTED_WEIGHTS = {'pm10_metre_shifted': ('pm10_metre', 'min_pm10_metre'),
+                   'inv_ga_metre_shifted': ('inv_ga_metre', 'min_inv_ga_metre')}
+
+# Margin on the lower bounds relative to the float32 landmark costs they are the difference of, which covers the
+# rounding of both costs (at most 2 ** -24 of each)
+FLOAT32_MARGIN = 1e-6
+
+
+def _difference_bound(minuend, subtrahend):
+    """
+    Difference of two float32 landmark costs in float64, lowered by the margin relative to the larger cost so that
+    it stays a lower bound whatever their rounding; an infinite difference is kept as it is
+    """
+    minuend = minuend.astype(np.float64)
+    subtrahend = subtrahend.astype(np.float64)
+    difference = minuend - subtrahend
+    margin = FLOAT32_MARGIN * np.fmax(np.abs(minuend), np.abs(subtrahend))
+    return np.where(np.isinf(difference), difference, difference - margin)
+
+
+class Landmarks:
+    """
+    ALT heuristics for A* on the in-memory graph: the costs from and to a few landmark nodes, stored in float32
+    tables for every weight, give by the triangle inequality a lower bound of the cost between any two nodes.
+    The tables have to be rebuilt when the weights change.
+    """
+    def __init__(self, graph, count=16, active=4, weights=None, seed=0):
+        self.graph = graph
+        self.count = count
+        self.active = active
+        self.landmarks = self.select_landmarks(count, seed)
+        self.tables = {}
+        self.build(weights)
+
+    def select_landmarks(self, count, seed=0):
+        """
+        Farthest landmarks: every new landmark is the node whose distance from the ones already chosen is the largest
+        """
+        n = self.graph.node_count
+        matrix = self.graph.weight_matrix('distance')
+        start = int(np.random.default_rng(seed).integers(n))
+        nearest = csgraph.dijkstra(matrix, indices=start, directed=False)
+
+        landmarks = []
+        for _ in range(min(count, n)):
+            # Nodes not reachable from the chosen landmarks come first, so every component gets one
+            candidates = np.where(np.isfinite(nearest), nearest, np.finfo(np.float64).max)
+            candidates[landmarks] = -1
+            landmark = int(np.argmax(candidates))
+            landmarks.append(landmark)
+            nearest = np.fmin(nearest, csgraph.dijkstra(matrix, indices=landmark, directed=False))
+        return np.asarray(landmarks, dtype=np.int64)
+
+    def _matrix(self, weight):
+        if weight in SHIFTED_WEIGHTS:
+            name, minimum = SHIFTED_WEIGHTS[weight]
+            values = self.graph.weight_array(name) - self.graph.combined_weight_stats()[minimum]
+            return sparse.csr_matrix((values, self.graph.indices, self.graph.indptr),
+                                     shape=(self.graph.node_count, self.graph.node_count))
+        return self.graph.weight_matrix(weight)
+
+    def build(self, weights=None):
+        """
+        Compute the tables of the costs from and to the landmarks for the given weights (by default all the weight
+        properties and the shifted ones used by every combined weight). Returns the elapsed time.
+        """
+        start_time = time.time()
+        names = []
+        for weight in WEIGHT_PROPERTIES + list(SHIFTED_WEIGHTS) if weights is None else weights:
+            names += [name for name in self.table_names(weight) if name not in names]
+
+        for weight in names:
+            matrix = self._matrix(weight)
+            from_landmarks = csgraph.dijkstra(matrix, indices=self.landmarks)
+            to_landmarks = csgraph.dijkstra(matrix.T.tocsr(), indices=self.landmarks)
+            self.tables[weight] = (from_landmarks.astype(np.float32), to_landmarks.astype(np.float32))
+        return time.time() - start_time
+
+    def refreshed(self, graph):
+        """
+        Landmarks of a copy of the graph with new weights (see RoutingGraph.with_attributes): the landmark nodes
+        and the tables of the unchanged weights are shared, the other tables are built again
+        """
+        changed = set(graph.changed_weights(self.graph))
+        landmarks = copy.copy(self)
+        landmarks.graph = graph
+        landmarks.tables = {name: tables for name, tables in self.tables.items()
+                            if name not in changed and SHIFTED_WEIGHTS.get(name, (name,))[0] not in changed}
+        landmarks.build([name for name in self.tables if name not in landmarks.tables])
+        return landmarks
+
+    def table_names(self, weight):
+        """
+        Tables used by the heuristic of the weight
+        """
+        return list(SHIFTED_WEIGHTS) if weight in self.graph.combined_weights else [weight]
+
+    def _bounds(self, weight, target, landmarks, nodes=slice(None)):
+        """
+        Lower bounds of the cost from the nodes (all by default) to the target given by the landmarks, from the
+        triangle inequality on the costs from the landmarks and on the costs to them
+        """
+        from_landmarks, to_landmarks = self.tables[weight]
+        with np.errstate(invalid='ignore'):
+            bounds = np.fmax(
+                _difference_bound(from_landmarks[landmarks, target][:, None], from_landmarks[landmarks][:, nodes]),
+                _difference_bound(to_landmarks[landmarks][:, nodes], to_landmarks[landmarks, target][:, None]))
+        # A landmark reaching neither node gives no bound
+        return np.nan_to_num(bounds, nan=0.0, posinf=np.inf, neginf=0.0)
+
+    def heuristic(self, weight, source, target):
+        """
+        Lower bound of the cost from every node to the target, with the active landmarks giving the best bounds
+        from the source. A combined weight uses the bounds of its two components.
+        """
+        if weight in self.graph.combined_weights:
+            pm10_scale, inv_ga_scale = self.graph.combined_weight_scales(*self.graph.combined_weights[weight])
+            return pm10_scale * self.heuristic('pm10_metre_shifted', source, target) + \
+                inv_ga_scale * self.heuristic('inv_ga_metre_shifted', source, target)
+
+        every_landmark = np.arange(len(self.landmarks))
+        best = np.argsort(-self._bounds(weight, target, every_landmark, [source])[:, 0], kind='stable')
+        bounds = self._bounds(weight, target, best[:self.active])
+        return np.maximum(bounds.max(axis=0), 0.0)
+
+    def route(self, source, target, weight='distance', algorithm='alt'):
+        """
+        Path between two RoadJunction ids with A* and the landmark heuristic, with the same result of
+        RoutingGraph.route. The weight, or the components of a combined weight, need their tables.
+        """
+        start_time = time.time()
+
+        source_index, target_index = self.graph.index_of(source), self.graph.index_of(target)
+        if source_index is None or target_index is None:
+            return {'error': 'No path found'}
+
+        heuristic = self.heuristic(weight, source_index, target_index).tolist()
+        found = self.graph.shortest_path(source_index, target_index, weight, heuristic)
+        if found is None:
+            return {'error': 'No path found'}
+
+        path = self.graph.path_result(source, target, *found)
+        return [time.time() - start_time, path]
@@ -0,0 +1,99 @@
+import time
+import threading
+from contextlib import contextmanager
+
+
+class WeightBuffer:
+    """
+    One version of the edge weights: a RoutingGraph sharing the topology with the other versions and the routers
+    built on it (hierarchy, landmarks), with the number of queries still reading it
+    """
+    def __init__(self, graph, version, routers=None):
+        self.graph = graph
+        self.version = version
+        self.routers = routers or {}
+        self.readers = 0
+        self.published_at = time.time()
+
+
+class LiveRoutingGraph:
+    """
+    In-memory graph whose edge weights can be replaced while it is queried. Each query reads the buffer that was
+    current when it started until it ends; a new set of weights is prepared aside, with the routers of the
+    previous buffer refreshed on it, and then becomes current with a single assignment, so new queries switch
+    to it atomically and the previous buffer is released when its last query ends.
+    """
+    def __init__(self, graph, version=0):
+        self.current = WeightBuffer(graph, version)
+        self.lock = threading.Lock()
+        # Held while publishing and while weights are added to a buffer, re-entrant for router inside preparing
+        self.publish_lock = threading.RLock()
+        self.previous = []
+
+    @contextmanager
+    def reading(self):
+        """
+        Buffer to use for a whole query
+        """
+        with self.lock:
+            buffer = self.current
+            buffer.readers += 1
+        try:
+            yield buffer
+        finally:
+            with self.lock:
+                buffer.readers -= 1
+                self.previous = [old for old in self.previous if old.readers > 0]
+
+    @contextmanager
+    def preparing(self):
+        """
+        Lock to hold while adding weights to a buffer (combined weights of its graph, landmark tables, hierarchy
+        metrics): publishing copies and refreshes them, so they must not change meanwhile
+        """
+        with self.publish_lock:
+            yield
+
+    def router(self, buffer, name, create):
+        """
+        Router of the buffer with the given name, created by create(graph) at its first use
+        """
+        with self.publish_lock:
+            if name not in buffer.routers:
+                buffer.routers[name] = create(buffer.graph)
+            return buffer.routers[name]
+
+    def publish(self, graph, version=None):
+        """
+        Make current a copy of the graph with new weights (see RoutingGraph.with_attributes), after refreshing
+        on it the routers of the current buffer. Returns the new buffer.
+        """
+        with self.publish_lock:
+            return self._publish(graph, version)
+
+    def _publish(self, graph, version):
+        current = self.current
+        routers = {name: router.refreshed(graph) for name, router in current.routers.items()}
+        buffer = WeightBuffer(graph, current.version + 1 if version is None else version, routers)
+
+        with self.lock:
+            self.current = buffer
+            if current.readers > 0:
+                self.previous.append(current)
+        return buffer
+
+    def publish_air_quality(self, id_pairs, mean_air_quality_values, version=None):
+        """
+        Publish the pm10 values of the air quality merge (the edges as pairs of RoadJunction ids, in both
+        directions), with the topology and the other weights unchanged. Returns the elapsed time.
+        """
+        start_time = time.time()
+        with self.publish_lock:
+            graph = self.current.graph.with_air_quality(id_pairs, mean_air_quality_values)
+            self._publish(graph, version)
+        return time.time() - start_time
+
+    def stats(self):
+        with self.lock:
+            return {'version': self.current.version, 'readers': self.current.readers,
+                    'previous_readers': {old.version: old.readers for old in self.previous}}
@@ -2,10 +2,16 @@ import sys
 import json
 import time
 import os
+import hashlib
+import tempfile
+import urllib.request
+import urllib.error
+from concurrent.futures import ProcessPoolExecutor
 from osgeo import gdal
 import numpy as np
 from graph_bridge import App
-from scipy.ndimage import map_coordinates
+from scipy import sparse
+from scipy.ndimage import map_coordinates, binary_dilation
 from export_to_csv import export_edges_to_csv, export_road_junctions_to_csv
 
 
@@ -33,6 +39,63 @@ def sample_with_window(raster, x_vals, y_vals, buffer_size=3):
     return np.array(sampled_values)
 
 
+def window_grid(vals, buffer_size=3):
+    """
+    Window coordinates along one axis for every value, built as np.arange(v - half_w, v + half_w + 1)
+    builds them in sample_with_window. The floating point rounding of arange can make a window one
+    element longer, so the windows are padded to the longest size and returned with a mask of the valid ones.
+    """
+    half_w = buffer_size // 2  # Dimension of the buffer
+
+    start = vals - half_w
+    delta = (start + 1) - start
+    length = np.ceil((vals + half_w + 1) - start)
+
+    steps = np.arange(2 * half_w + 2)
+    grid = start[:, np.newaxis] + steps * delta[:, np.newaxis]
+    mask = steps < length[:, np.newaxis]
+    return grid, mask
+
+
+def window_points(x_vals, y_vals, buffer_size=3):
+    """
+    Grid of the window around every point, with shape (points, window rows, window columns),
+    and the mask of the grid points that belong to the window
+    """
+    x_grid, x_mask = window_grid(x_vals, buffer_size)
+    y_grid, y_mask = window_grid(y_vals, buffer_size)
+
+    x_grid, y_grid = np.broadcast_arrays(x_grid[:, np.newaxis, :], y_grid[:, :, np.newaxis])
+    mask = y_mask[:, :, np.newaxis] & x_mask[:, np.newaxis, :]
+    return x_grid, y_grid, mask
+
+
+def sample_points_with_window(raster, x_vals, y_vals, buffer_size=3, origin=(0, 0)):
+    """
+    Vectorized version of sample_with_window: all the windows of all the points are
+    extracted with a single map_coordinates call. The raster can be a window of the full raster,
+    whose first pixel is at the (row, column) origin.
+    """
+    # Generate the grid around every point
+    x_grid, y_grid, mask = window_points(x_vals, y_vals, buffer_size)
+
+    # Extract the values from the raster using a bilinear interpolation (order=1)
+    values = map_coordinates(raster, [y_grid.ravel() - origin[0], x_grid.ravel() - origin[1]],
+                             order=1).reshape(mask.shape)
+
+    # Mean value of the window around every segment point
+    return np.where(mask, values, 0).sum(axis=(1, 2), dtype=np.float64) / mask.sum(axis=(1, 2))
+
+
+def segment_mean(values, counts):
+    """
+    Mean of consecutive groups of values, where the i-th group is counts[i] values long
+    """
+    counts = np.asarray(counts)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return np.add.reduceat(values, starts) / counts
+
+
 def world_to_pixel(transform, lon, lat):
     """
     Convert world coordinates to pixel coordinates
@@ -72,8 +135,583 @@ def sample_raster_along_line(config, raster_path, coordinate_pair):
     return mean_value
 
 
+def load_raster(raster_path):
+    """
+    Open the raster and read its first band, returning the data and the geotransform
+    """
+    raster = gdal.Open(raster_path)
+    if raster is None:
+        print("Error: raster not found")
+        return None, None
+
+    band = raster.GetRasterBand(1)
+    transform = raster.GetGeoTransform()
+
+    data = band.ReadAsArray(0, 0, raster.RasterXSize, raster.RasterYSize)
+    return data, transform
+
+
+def edges_to_pixel(transform, edges):
+    """
+    Convert the endpoints of the edges returned by get_edges_endpoints to pixel coordinates
+    """
+    coordinates = np.array([edge[2:6] for edge in edges], dtype=np.float64).reshape(-1, 4)
+
+    px0, py0 = world_to_pixel(transform, coordinates[:, 0], coordinates[:, 1])
+    px1, py1 = world_to_pixel(transform, coordinates[:, 2], coordinates[:, 3])
+
+    return px0, py0, px1, py1
+
+
+def haversine(lon0, lat0, lon1, lat1):
+    """
+    Distance in metres between points given in degrees of longitude and latitude
+    """
+    lon0, lat0, lon1, lat1 = map(np.radians, (lon0, lat0, lon1, lat1))
+    a = np.sin((lat1 - lat0) / 2) ** 2 + np.cos(lat0) * np.cos(lat1) * np.sin((lon1 - lon0) / 2) ** 2
+    return 2 * 6371008.8 * np.arcsin(np.sqrt(a))
+
+
+def edge_num_points(air_quality_config, edges, px0, py0, px1, py1, num_points=50):
+    """
+    Number of points sampled along every edge. In the "fixed" sampling mode every edge has num_points points,
+    in the "spacing" mode the points are spaced by the configured distance (in metres or pixels)
+    and their number is kept between min_points and max_points.
+    """
+    if air_quality_config.get('sampling_mode', 'fixed') != 'spacing':
+        return np.full(len(px0), num_points)
+
+    spacing = air_quality_config['spacing']
+    if spacing.get('unit', 'metre') == 'pixel':
+        length = np.hypot(px1 - px0, py1 - py0)
+    else:
+        coordinates = np.array([edge[2:6] for edge in edges], dtype=np.float64).reshape(-1, 4)
+        length = haversine(coordinates[:, 0], coordinates[:, 1], coordinates[:, 2], coordinates[:, 3])
+
+    counts = np.ceil(length / spacing['value']).astype(np.int64) + 1
+    return np.clip(counts, spacing.get('min_points', 2), spacing.get('max_points', 200))
+
+
+def edge_sample_points(px0, py0, px1, py1, counts):
+    """
+    Points evenly spaced along every segment, counts[i] points for the i-th one, in the same way np.linspace
+    computes them
+    """
+    edge_index = np.repeat(np.arange(len(counts)), counts)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    steps = np.arange(len(edge_index)) - starts[edge_index]
+    last = steps == counts[edge_index] - 1
+
+    div = np.maximum(counts - 1, 1)[edge_index]
+    x_vals = steps * ((px1 - px0)[edge_index] / div) + px0[edge_index]
+    y_vals = steps * ((py1 - py0)[edge_index] / div) + py0[edge_index]
+
+    # The last point is exactly the end of the segment
+    x_vals[last & (steps > 0)] = px1[edge_index][last & (steps > 0)]
+    y_vals[last & (steps > 0)] = py1[edge_index][last & (steps > 0)]
+
+    return x_vals, y_vals
+
+
+def window_mean_raster(raster, buffer_size=3):
+    """
+    Mean of the buffer_size x buffer_size window around every pixel, computed from the integral image
+    (summed-area table) of the raster, so the cost does not depend on the window size. Pixels outside
+    the raster count as 0. Sampling this raster with a bilinear interpolation approximates the window mean
+    of sample_points_with_window with a single value per point: it is the same (away from the raster border)
+    for the windows of exactly buffer_size points, but the arange rounding of window_grid makes about 1% of them
+    one point wider. On a 0-40 raster the edge means differ by about 0.002 (smooth raster) to 0.01 (noise)
+    on average, and by a few tenths at most.
+    """
+    half_w = buffer_size // 2  # Dimension of the buffer
+    n_rows, n_cols = raster.shape
+
+    integral = np.zeros((n_rows + 1, n_cols + 1), dtype=np.float64)
+    integral[1:, 1:] = raster.astype(np.float64).cumsum(axis=0).cumsum(axis=1)
+
+    row_start = np.clip(np.arange(n_rows) - half_w, 0, n_rows)[:, np.newaxis]
+    row_stop = np.clip(np.arange(n_rows) + half_w + 1, 0, n_rows)[:, np.newaxis]
+    col_start = np.clip(np.arange(n_cols) - half_w, 0, n_cols)[np.newaxis, :]
+    col_stop = np.clip(np.arange(n_cols) + half_w + 1, 0, n_cols)[np.newaxis, :]
+
+    window_sum = (integral[row_stop, col_stop] - integral[row_start, col_stop]
+                  - integral[row_stop, col_start] + integral[row_start, col_start])
+    return window_sum / (2 * half_w + 1) ** 2
+
+
+def sample_segments(raster, px0, py0, px1, py1, counts, buffer_size=3, integral=False, batch_size=4096,
+                    origin=(0, 0)):
+    """
+    Mean air quality along the segments given in pixel coordinates, sampling the points of a whole batch of segments
+    together. With integral=True the raster is expected to be already filtered by window_mean_raster.
+    The raster can be a window of the full raster, whose first pixel is at the (row, column) origin.
+    """
+    mean_values = np.empty(len(px0), dtype=np.float64)
+    for start in range(0, len(px0), batch_size):
+        stop = start + batch_size
+
+        # Generate the x and y values for the segments
+        x_vals, y_vals = edge_sample_points(px0[start:stop], py0[start:stop], px1[start:stop], py1[start:stop],
+                                            counts[start:stop])
+
+        if integral:
+            air_qualities = map_coordinates(raster, [y_vals - origin[0], x_vals - origin[1]],
+                                            order=1).astype(np.float64)
+        else:
+            air_qualities = sample_points_with_window(raster, x_vals, y_vals, buffer_size=buffer_size, origin=origin)
+
+        mean_values[start:stop] = segment_mean(air_qualities, counts[start:stop])
+
+    return mean_values
+
+
+def _sample_segments_chunk(raster_path, *args):
+    """
+    Worker of sample_segments_parallel: the raster is memory-mapped from the file written by the main process
+    """
+    raster = np.load(raster_path, mmap_mode='r')
+    return sample_segments(raster, *args)
+
+
+def sample_segments_parallel(raster, px0, py0, px1, py1, counts, buffer_size=3, integral=False, batch_size=4096,
+                             origin=(0, 0), workers=2):
+    """
+    Parallel version of sample_segments: the segments are split in chunks sampled by a pool of processes.
+    The raster is written once to a memory-mapped file shared by the workers instead of being sent to each of them.
+    The result is the same, and in the same order, of the serial sampling.
+    """
+    # A few chunks per worker, to balance the load
+    bounds = np.linspace(0, len(px0), workers * 4 + 1).astype(np.int64)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raster_path = os.path.join(tmp_dir, "raster.npy")
+        np.save(raster_path, np.ascontiguousarray(raster))
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_sample_segments_chunk, raster_path,
+                                       px0[start:stop], py0[start:stop], px1[start:stop], py1[start:stop],
+                                       counts[start:stop], buffer_size, integral, batch_size, origin)
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            return np.concatenate([future.result() for future in futures])
+
+
+def sample_pixel_segments(air_quality_config, raster, px0, py0, px1, py1, counts, origin=(0, 0)):
+    """
+    Mean air quality along the segments given in pixel coordinates, with the configured window mean,
+    in parallel when more than one worker is configured. The raster can be a window of the full raster,
+    whose first pixel is at the (row, column) origin.
+    """
+    buffer_size = air_quality_config['buffer_size']
+    batch_size = air_quality_config.get('batch_size', 4096)
+    integral = air_quality_config.get('window_mean', 'grid') == 'integral'
+    workers = air_quality_config.get('workers', 1)
+
+    if integral:
+        # The window mean of every pixel is computed once, then each point needs a single value
+        raster = window_mean_raster(raster, buffer_size)
+
+    if workers > 1 and len(px0) > 0:
+        return sample_segments_parallel(raster, px0, py0, px1, py1, counts, buffer_size, integral, batch_size,
+                                        origin, workers)
+    return sample_segments(raster, px0, py0, px1, py1, counts, buffer_size, integral, batch_size, origin)
+
+
+def sample_edges(config, data, transform, edges, num_points=50):
+    """
+    Mean air quality along every edge of the graph
+    """
+    px0, py0, px1, py1 = edges_to_pixel(transform, edges)
+    counts = edge_num_points(config['air_quality_in_footpath'], edges, px0, py0, px1, py1, num_points)
+
+    return sample_pixel_segments(config['air_quality_in_footpath'], data, px0, py0, px1, py1, counts)
+
+
+def tile_shape(band, tile_budget_mb, margin=0):
+    """
+    Size (columns, rows) of the tiles read from the raster: a multiple of the native block size of the band
+    whose pixels, as 8 bytes values, fit in the memory budget together with the margin read around them
+    (unless a single block with its margin is larger than the budget)
+    """
+    block_cols, block_rows = band.GetBlockSize()
+    budget_pixels = int(tile_budget_mb * 1024 * 1024) // 8
+
+    side = min(band.XSize, int(np.sqrt(budget_pixels)) - 2 * margin)
+    tile_cols = max(block_cols, side // block_cols * block_cols)
+    rows = budget_pixels // (tile_cols + 2 * margin) - 2 * margin
+    tile_rows = max(block_rows, rows // block_rows * block_rows)
+
+    return tile_cols, tile_rows
+
+
+def sample_raster_in_tiles(config, raster_path, edges, num_points=50):
+    """
+    Sample a raster along all the edges without loading the whole band: the raster is split in tiles aligned
+    to its native blocks and sized by the tile_budget_mb of the config, and only the tiles the edges reach are
+    read, once each, with the fixed margin the window mean of their points needs. Every edge is assigned to the
+    tile of its first endpoint; an edge leaving the margin of that tile is sampled point by point instead,
+    every point with the tile it falls in, and its mean is taken over all of them.
+    """
+    air_quality_config = config['air_quality_in_footpath']
+
+    raster = gdal.Open(raster_path)
+    if raster is None:
+        print("Error: raster not found")
+        return
+
+    band = raster.GetRasterBand(1)
+    transform = raster.GetGeoTransform()
+    n_cols, n_rows = raster.RasterXSize, raster.RasterYSize
+
+    px0, py0, px1, py1 = edges_to_pixel(transform, edges)
+    counts = edge_num_points(air_quality_config, edges, px0, py0, px1, py1, num_points)
+
+    # Pixels the points need around them, for the buffer window and the bilinear interpolation
+    margin = 2 * (air_quality_config['buffer_size'] // 2) + 3
+    tile_cols, tile_rows = tile_shape(band, air_quality_config['tile_budget_mb'], margin)
+    n_tile_cols = -(-n_cols // tile_cols)
+    n_tile_rows = -(-n_rows // tile_rows)
+
+    def tile_of(x_vals, y_vals):
+        tile_x = np.clip(np.floor(x_vals) // tile_cols, 0, n_tile_cols - 1).astype(np.int64)
+        tile_y = np.clip(np.floor(y_vals) // tile_rows, 0, n_tile_rows - 1).astype(np.int64)
+        return tile_y * n_tile_cols + tile_x
+
+    def tile_window(tiles):
+        column, row = tiles % n_tile_cols, tiles // n_tile_cols
+        return (np.maximum(column * tile_cols - margin, 0), np.maximum(row * tile_rows - margin, 0),
+                np.minimum((column + 1) * tile_cols + margin, n_cols),
+                np.minimum((row + 1) * tile_rows + margin, n_rows))
+
+    # The edges whose points and margin stay in the window of the tile of their first endpoint
+    edge_tiles = tile_of(px0, py0)
+    x_off, y_off, x_end, y_end = tile_window(edge_tiles)
+    inside = (np.clip(np.floor(np.minimum(px0, px1)) - margin, 0, n_cols) >= x_off) & \
+             (np.clip(np.ceil(np.maximum(px0, px1)) + margin, 0, n_cols) <= x_end) & \
+             (np.clip(np.floor(np.minimum(py0, py1)) - margin, 0, n_rows) >= y_off) & \
+             (np.clip(np.ceil(np.maximum(py0, py1)) + margin, 0, n_rows) <= y_end)
+    short_edges = np.flatnonzero(inside)
+
+    # The points of the other edges, each with its own tile
+    long_edges = np.flatnonzero(~inside)
+    x_points, y_points = edge_sample_points(px0[long_edges], py0[long_edges], px1[long_edges], py1[long_edges],
+                                            counts[long_edges])
+    point_tiles = tile_of(x_points, y_points)
+
+    tiles = np.union1d(edge_tiles[short_edges], point_tiles)
+    print(f"Sampling {len(tiles)} tiles of {tile_cols}x{tile_rows} pixels, "
+          f"{len(long_edges)} edges across tiles sampled by point...")
+    mean_values = np.empty(len(edges), dtype=np.float64)
+    point_values = np.empty(len(x_points), dtype=np.float64)
+    for tile in tiles:
+        selected = short_edges[edge_tiles[short_edges] == tile]
+        points = np.flatnonzero(point_tiles == tile)
+
+        x_off, y_off, x_end, y_end = tile_window(tile)
+        data = band.ReadAsArray(int(x_off), int(y_off), int(x_end - x_off), int(y_end - y_off))
+
+        # A point is sampled as a segment of a single point, all of them with the edges of the tile. The points
+        # keep the coordinates of the full raster, so they are sampled as in the full read.
+        values = sample_pixel_segments(air_quality_config, data,
+                                       np.concatenate((px0[selected], x_points[points])),
+                                       np.concatenate((py0[selected], y_points[points])),
+                                       np.concatenate((px1[selected], x_points[points])),
+                                       np.concatenate((py1[selected], y_points[points])),
+                                       np.concatenate((counts[selected], np.ones(len(points), dtype=np.int64))),
+                                       origin=(y_off, x_off))
+        mean_values[selected] = values[:len(selected)]
+        point_values[points] = values[len(selected):]
+
+    if len(long_edges):
+        mean_values[long_edges] = segment_mean(point_values, counts[long_edges])
+    return mean_values
+
+
+def sample_raster_along_lines(config, raster_path, edges, num_points=50):
+    """
+    Sample a raster along all the edges at once, the batch counterpart of sample_raster_along_line.
+    The raster is read once (or tile by tile when tile_budget_mb is set) and the segment points
+    of a whole batch of edges are sampled together.
+    """
+    if config['air_quality_in_footpath'].get('tile_budget_mb'):
+        mean_values = sample_raster_in_tiles(config, raster_path, edges, num_points)
+        return None if mean_values is None else mean_values.tolist()
+
+    data, transform = load_raster(raster_path)
+    if data is None:
+        return
+
+    return sample_edges(config, data, transform, edges, num_points).tolist()
+
+
+def graph_hash(edges):
+    """
+    Hash of the ids and coordinates of the edges returned by get_edges_endpoints
+    """
+    return hashlib.sha1(repr([tuple(edge) for edge in edges]).encode()).hexdigest()
+
+
+def operator_block(x_vals, y_vals, counts, shape, buffer_size=3):
+    """
+    Rows of the sampling operator for a group of edges, whose segment points are x_vals, y_vals
+    (counts[i] consecutive points for the i-th edge). It reproduces the bilinear interpolation of
+    map_coordinates (order=1, points outside the raster are 0), the window mean and the segment mean.
+    """
+    n_rows, n_cols = shape
+    x_grid, y_grid, mask = window_points(x_vals, y_vals, buffer_size)
+
+    # Weight of every window point in the mean of its edge
+    edge_index = np.repeat(np.arange(len(counts)), counts)
+    point_weight = mask / mask.sum(axis=(1, 2), keepdims=True) / np.asarray(counts)[edge_index, np.newaxis, np.newaxis]
+
+    inside = mask & (x_grid >= 0) & (x_grid <= n_cols - 1) & (y_grid >= 0) & (y_grid <= n_rows - 1)
+    x0 = np.floor(x_grid)
+    y0 = np.floor(y_grid)
+    fx = x_grid - x0
+    fy = y_grid - y0
+    x0 = x0.astype(np.int64)
+    y0 = y0.astype(np.int64)
+    edge_index = np.broadcast_to(edge_index[:, np.newaxis, np.newaxis], mask.shape)
+
+    rows, cols, weights = [], [], []
+    for dy, wy in ((0, 1 - fy), (1, fy)):
+        for dx, wx in ((0, 1 - fx), (1, fx)):
+            weight = point_weight * wy * wx
+            keep = inside & (weight != 0)
+            pixel = np.minimum(y0 + dy, n_rows - 1) * n_cols + np.minimum(x0 + dx, n_cols - 1)
+            rows.append(edge_index[keep])
+            cols.append(pixel[keep])
+            weights.append(weight[keep])
+
+    # Duplicate entries (the same pixel used by several points of an edge) are summed by tocsr
+    return sparse.coo_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(len(counts), n_rows * n_cols)).tocsr()
+
+
+def build_sampling_operator(config, transform, shape, edges, num_points=50):
+    """
+    Build the sparse matrix (edges x raster pixels) that maps the flattened raster
+    to the mean air quality of every edge, as sample_raster_along_lines computes it
+    """
+    air_quality_config = config['air_quality_in_footpath']
+    batch_size = air_quality_config.get('batch_size', 4096)
+
+    px0, py0, px1, py1 = edges_to_pixel(transform, edges)
+    counts = edge_num_points(air_quality_config, edges, px0, py0, px1, py1, num_points)
+
+    blocks = []
+    for start in range(0, len(edges), batch_size):
+        stop = start + batch_size
+
+        x_vals, y_vals = edge_sample_points(px0[start:stop], py0[start:stop], px1[start:stop], py1[start:stop],
+                                            counts[start:stop])
+
+        blocks.append(operator_block(x_vals, y_vals, counts[start:stop], shape, air_quality_config['buffer_size']))
+
+    return sparse.vstack(blocks, format='csr')
+
+
+def load_sampling_operator(config, transform, shape, edges, num_points=50):
+    """
+    Load the sampling operator of the graph and raster grid from the disk, building and saving it the first time.
+    The operator is keyed by the geotransform and shape of the raster, the sampling parameters and the graph hash.
+    """
+    air_quality_config = config['air_quality_in_footpath']
+    buffer_size = air_quality_config['buffer_size']
+    operator_dir = air_quality_config.get('operator_dir', './output/sampling_operator')
+
+    key = hashlib.sha1(json.dumps({
+        'transform': list(transform),
+        'shape': list(shape),
+        'buffer_size': buffer_size,
+        'num_points': num_points,
+        'sampling_mode': air_quality_config.get('sampling_mode', 'fixed'),
+        'spacing': air_quality_config.get('spacing') if air_quality_config.get('sampling_mode') == 'spacing' else None,
+        'graph': graph_hash(edges)
+    }).encode()).hexdigest()
+    operator_path = os.path.join(operator_dir, f"operator_{key}.npz")
+
+    if os.path.exists(operator_path):
+        return sparse.load_npz(operator_path)
+
+    print("Building the sampling operator for the current graph and raster grid...")
+    operator = build_sampling_operator(config, transform, shape, edges, num_points)
+
+    os.makedirs(operator_dir, exist_ok=True)
+    sparse.save_npz(operator_path, operator)
+    print(f"Sampling operator saved at {operator_path}")
+
+    return operator
+
+
+def sample_raster_with_operator(config, raster_path, edges, num_points=50):
+    """
+    Mean air quality along the edges as a single product between the sampling operator and the raster
+    """
+    data, transform = load_raster(raster_path)
+    if data is None:
+        return
+
+    operator = load_sampling_operator(config, transform, data.shape, edges, num_points)
+    return (operator @ data.ravel().astype(np.float64)).tolist()
+
+
+def write_air_quality(config, greeter, id_pairs, mean_air_quality_values):
+    """
+    Write the air quality of the edges in the graph, in batches as configured in the config file
+    """
+    air_quality_config = config['air_quality_in_footpath']
+    summary = greeter.add_edge_air_quality_in_bulk(id_pairs, mean_air_quality_values,
+                                                   air_quality_config.get('write_batch_size', 10000),
+                                                   air_quality_config.get('write_concurrency', 1))
+    print(f"Air quality added to {summary['updated_relationships']} relationships "
+          f"in {summary['batches']} batches, in {summary['elapsed_time']:.2f} seconds.")
+
+
+def notify_routing_service(config, greeter, id_pairs, mean_air_quality_values):
+    """
+    Tell the routing service, if configured, that the edge weights changed, so it empties its result cache.
+    With publish_air_quality the values written are sent too, and the service swaps them in its in-memory graph
+    instead of loading it again.
+    """
+    service_config = config.get('routing_service')
+    if not service_config:
+        return
+
+    url = f"http://{service_config.get('host', '127.0.0.1')}:{service_config.get('port', 8080)}"
+    body = {}
+    if service_config.get('publish_air_quality', False) and id_pairs:
+        url += '/air_quality'
+        body = {'id_pairs': [list(pair) for pair in id_pairs],
+                'pm10': np.asarray(mean_air_quality_values, dtype=np.float64).tolist(),
+                'data_version': greeter.get_data_version()}
+    else:
+        url += '/invalidate'
+
+    try:
+        request = urllib.request.Request(url, data=json.dumps(body).encode(), method='POST',
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=60) as response:
+            print(f"Routing service updated, data version {json.load(response)['data_version']}")
+    except urllib.error.HTTPError as e:
+        print(f"Routing service at {url} refused the update with status {e.code}: "
+              f"{e.read().decode(errors='replace')}")
+    except (urllib.error.URLError, OSError):
+        # The service checks the data version by itself, it only answers from the old cache a little longer
+        print(f"Routing service not reachable at {url}")
+
+
+def changed_edges(config, previous, data, transform, edges, num_points=50):
+    """
+    Mask of the edges sampling at least one pixel that differs between the previous and the new raster
+    """
+    air_quality_config = config['air_quality_in_footpath']
+    batch_size = air_quality_config.get('batch_size', 4096)
+    n_rows, n_cols = data.shape
+
+    # A nodata pixel is NaN in both rasters, which is not a change
+    changed = (previous != data) & ~(np.isnan(previous) & np.isnan(data))
+    if not changed.any():
+        return np.zeros(len(edges), dtype=bool)
+
+    rows, cols = np.nonzero(changed)
+    print(f"{len(rows)} pixels changed, in rows {rows.min()}-{rows.max()} and columns {cols.min()}-{cols.max()}")
+
+    # Extend the changed region to the sample points it reaches through the buffer window and the interpolation
+    radius = air_quality_config['buffer_size'] // 2 + 2
+    changed = binary_dilation(changed, structure=np.ones((2 * radius + 1, 2 * radius + 1), dtype=bool))
+
+    px0, py0, px1, py1 = edges_to_pixel(transform, edges)
+    counts = edge_num_points(air_quality_config, edges, px0, py0, px1, py1, num_points)
+
+    affected = np.empty(len(edges), dtype=bool)
+    for start in range(0, len(edges), batch_size):
+        stop = start + batch_size
+
+        x_vals, y_vals = edge_sample_points(px0[start:stop], py0[start:stop], px1[start:stop], py1[start:stop],
+                                            counts[start:stop])
+        hit = changed[np.clip(np.floor(y_vals), 0, n_rows - 1).astype(np.int64),
+                      np.clip(np.floor(x_vals), 0, n_cols - 1).astype(np.int64)]
+
+        starts = np.concatenate(([0], np.cumsum(counts[start:stop])[:-1]))
+        affected[start:stop] = np.logical_or.reduceat(hit, starts)
+
+    return affected
+
+
+def incremental_update(config, greeter, edges):
+    """
+    Update the air quality of the graph comparing the raster with the one of the previous run: only the edges
+    touching the changed pixels are sampled again, and only the ones whose value moved more than epsilon are written,
+    together with their pm10_metre. Without a previous run on the same graph and raster grid,
+    all the edges are sampled and written.
+    Returns the pairs of RoadJunction ids and the values written.
+    """
+    incremental_config = config['air_quality_in_footpath']['incremental']
+    state_path = incremental_config.get('state_path', './output/air_quality_state/state.npz')
+    epsilon = incremental_config.get('epsilon', 0.0)
+
+    data, transform = load_raster(config['raster_path'])
+    if data is None:
+        return [], []
+
+    id_pairs = [[edge[0], edge[1]] for edge in edges]
+    current_hash = graph_hash(edges)
+
+    previous = np.load(state_path) if os.path.exists(state_path) else None
+    if previous is None or str(previous['graph']) != current_hash or previous['raster'].shape != data.shape \
+            or not np.array_equal(previous['transform'], transform):
+        print("No previous air quality state for this graph and raster grid, updating all the edges...")
+        values = sample_edges(config, data, transform, edges)
+        write_air_quality(config, greeter, id_pairs, values.tolist())
+        written = id_pairs, values.tolist()
+    else:
+        values = previous['values'].copy()
+
+        affected = np.flatnonzero(changed_edges(config, previous['raster'], data, transform, edges))
+        new_values = sample_edges(config, data, transform, [edges[i] for i in affected])
+
+        # Only the edges whose value moved more than epsilon are written
+        moved = np.abs(new_values - values[affected]) > epsilon
+        updated = affected[moved]
+        values[updated] = new_values[moved]
+        print(f"{len(affected)} edges sampled again, {len(updated)} of them changed more than {epsilon}")
+
+        written = [id_pairs[i] for i in updated], values[updated].tolist()
+        if len(updated) > 0:
+            greeter.update_edge_air_quality(*written)
+
+    # The state keeps the values written in the graph, so changes under epsilon do not accumulate
+    os.makedirs(os.path.dirname(state_path) or '.', exist_ok=True)
+    np.savez(state_path, raster=data, transform=np.array(transform), graph=current_hash, values=values)
+    return written
+
+
+def check_sampling_config(air_quality_config):
+    """
+    Raise a ValueError for a sampling_mode or window_mean that the configured sampling would ignore: the edge by
+    edge sampling has 50 points per edge and a grid window, the sampling operator a grid window
+    """
+    incremental = air_quality_config.get('incremental', {}).get('enabled', False)
+    operator = air_quality_config.get('sampling_operator', False)
+    batch = air_quality_config.get('batch_sampling', False)
+    sampling_mode = air_quality_config.get('sampling_mode', 'fixed')
+    window_mean = air_quality_config.get('window_mean', 'grid')
+
+    if sampling_mode not in ('fixed', 'spacing'):
+        raise ValueError(f"Unknown sampling_mode {sampling_mode}, it has to be fixed or spacing")
+    if window_mean not in ('grid', 'integral'):
+        raise ValueError(f"Unknown window_mean {window_mean}, it has to be grid or integral")
+    if sampling_mode == 'spacing' and not (incremental or operator or batch):
+        raise ValueError("sampling_mode spacing needs batch_sampling, sampling_operator or incremental, "
+                         "the edge by edge sampling takes 50 points along every edge")
+    if window_mean == 'integral' and not (incremental or batch and not operator):
+        raise ValueError("window_mean integral needs batch_sampling or incremental, the edge by edge sampling "
+                         "and the sampling operator use the grid window")
+
+
 def main(config):
     gdal.UseExceptions()
+    check_sampling_config(config['air_quality_in_footpath'])
     greeter = App(config['neo4j_URL'], config['neo4j_user'], config['neo4j_pwd'])
 
     # Get the coordinates of the node pairs from edges in the graph
@@ -82,24 +720,37 @@ def main(config):
     mean_air_quality_values = []
 
     print(f"Start sampling raster along {len(edges)} edges (this operation may take a while)...")
-    i = 0
     start_time = time.time()
-    for edge in edges:
-        i += 1
-        source_id, destination_id, source_lon, source_lat, destination_lon, destination_lat = edge
+    raster_file = config['raster_path']
+    if config['air_quality_in_footpath'].get('incremental', {}).get('enabled', False):
+        # Sort the edges, so the previous state does not depend on the order the database returns them
+        edges = sorted(edges, key=lambda edge: (edge[0], edge[1]))
+        id_pairs, mean_air_quality_values = incremental_update(config, greeter, edges)
+    elif config['air_quality_in_footpath'].get('sampling_operator', False):
+        # Sort the edges, so the operator does not depend on the order the database returns them
+        edges = sorted(edges, key=lambda edge: (edge[0], edge[1]))
+        id_pairs = [[edge[0], edge[1]] for edge in edges]
+        mean_air_quality_values = sample_raster_with_operator(config, raster_file, edges)
+    elif config['air_quality_in_footpath'].get('batch_sampling', False):
+        # Read the raster once and sample all the edges together
+        id_pairs = [[edge[0], edge[1]] for edge in edges]
+        mean_air_quality_values = sample_raster_along_lines(config, raster_file, edges)
+    else:
+        for edge in edges:
+            source_id, destination_id, source_lon, source_lat, destination_lon, destination_lat = edge
 
-        raster_file = config['raster_path']
-        # Find the mean air quality along the segment
-        mean_air_quality = sample_raster_along_line(config, raster_file, [(source_lon, source_lat), (destination_lon, destination_lat)])
+            # Find the mean air quality along the segment
+            mean_air_quality = sample_raster_along_line(config, raster_file,
+                                                        [(source_lon, source_lat), (destination_lon, destination_lat)])
 
-        id_pairs.append([source_id, destination_id])
-        mean_air_quality_values.append(mean_air_quality)
+            id_pairs.append([source_id, destination_id])
+            mean_air_quality_values.append(mean_air_quality)
 
     print("Time to sample raster: ", time.time() - start_time)
 
-    result = greeter.add_edge_air_quality_in_bulk(id_pairs, mean_air_quality_values)
-    if result == mean_air_quality_values:
-        print("All air quality values have been added to the graph.")
+    if id_pairs and not config['air_quality_in_footpath'].get('incremental', {}).get('enabled', False):
+        write_air_quality(config, greeter, id_pairs, mean_air_quality_values)
+    notify_routing_service(config, greeter, id_pairs, mean_air_quality_values)
 
     # Check if road junctions csv file exists
     if not os.path.exists("output/exported_graph/road_junctions.csv"):
@@ -0,0 +1,112 @@
+import time
+import heapq
+
+# Criteria of the Pareto search
+PARETO_OBJECTIVES = ['distance', 'pm10_metre', 'inv_ga_metre']
+
+# Default relative tolerance: the exact search, without a limit of labels, does not end in a reasonable time
+# on a city graph
+PARETO_EPSILON = 0.01
+
+
+def dominated(costs, labels, scale):
+    """
+    Whether the costs are dominated by one of the labels, with a tolerance of (scale - 1) on every criterion
+    """
+    c0, c1, c2 = costs[0] * scale, costs[1] * scale, costs[2] * scale
+    for l0, l1, l2 in labels:
+        if l0 <= c0 and l1 <= c1 and l2 <= c2:
+            return True
+    return False
+
+
+def pareto_search(graph, source, target, objectives=PARETO_OBJECTIVES, epsilon=PARETO_EPSILON, max_labels=None):
+    """
+    Multi-objective label setting search (NAMOA*) between two dense node indices over three edge weights.
+    The labels are expanded in lexicographic order of cost plus lower bound, where the lower bounds are the exact
+    costs to the target of every single criterion, so a label is pruned as soon as its bound is dominated by a route
+    already found or its cost by a label already settled at the same node. With epsilon > 0, labels within a
+    relative epsilon of a dominating one are pruned too, giving a smaller, approximate Pareto set;
+    max_labels limits the labels settled at every node (and can leave out some of the optimal routes), the exact
+    search with epsilon 0 has no bound on the labels without it and raises a ValueError.
+    Returns the costs and the edges of the Pareto optimal routes, sorted by the first criterion.
+    """
+    if epsilon < 0 or (epsilon == 0 and max_labels is None):
+        raise ValueError(f"Pareto epsilon {epsilon} has to be positive, or 0 with max_labels set")
+
+    weights = [graph.edge_weights(objective) for objective in objectives]
+    bounds = [graph.one_to_all(target, objective, reverse=True)[0].tolist() for objective in objectives]
+    if bounds[0][source] == float('inf'):
+        return []
+
+    indptr, indices = graph._indptr, graph._indices
+    w0, w1, w2 = weights
+    b0, b1, b2 = bounds
+    scale = 1.0 + epsilon
+
+    # Labels: costs, parent label and edge from the parent
+    label_costs, label_parent, label_edge = [(0.0, 0.0, 0.0)], [-1], [-1]
+    settled = {}
+    solutions, solution_labels = [], []
+    heap = [((b0[source], b1[source], b2[source]), 0, source)]
+
+    while heap:
+        bound, label, node = heapq.heappop(heap)
+        if dominated(bound, solutions, scale):
+            continue
+        costs = label_costs[label]
+        node_labels = settled.setdefault(node, [])
+        if dominated(costs, node_labels, scale) or (max_labels is not None and len(node_labels) >= max_labels):
+            continue
+        node_labels.append(costs)
+
+        if node == target:
+            solutions.append(costs)
+            solution_labels.append(label)
+            continue
+
+        for edge in range(indptr[node], indptr[node + 1]):
+            next_node = indices[edge]
+            next_costs = (costs[0] + w0[edge], costs[1] + w1[edge], costs[2] + w2[edge])
+            next_bound = (next_costs[0] + b0[next_node], next_costs[1] + b1[next_node],
+                          next_costs[2] + b2[next_node])
+            if next_bound[0] == float('inf') or next_bound[1] == float('inf') or next_bound[2] == float('inf'):
+                continue
+            if dominated(next_bound, solutions, scale) or dominated(next_costs, settled.get(next_node, ()), scale):
+                continue
+
+            label_costs.append(next_costs)
+            label_parent.append(label)
+            label_edge.append(edge)
+            heapq.heappush(heap, (next_bound, len(label_costs) - 1, next_node))
+
+    # The edges of every route, following the parents of the labels that reached the target
+    routes = []
+    for costs, label in zip(solutions, solution_labels):
+        path_edges = []
+        while label_parent[label] >= 0:
+            path_edges.append(label_edge[label])
+            label = label_parent[label]
+        path_edges.reverse()
+        routes.append((costs, path_edges))
+
+    return sorted(routes, key=lambda route: route[0])
+
+
+def pareto_route(graph, source, target, objectives=PARETO_OBJECTIVES, epsilon=PARETO_EPSILON, max_labels=None):
+    """
+    Pareto optimal routes between two RoadJunction ids, with the same result of routing_path: the execution time
+    followed by the description of every route, whose cost is its total of the first criterion
+    """
+    start_time = time.time()
+
+    source_index, target_index = graph.index_of(source), graph.index_of(target)
+    if source_index is None or target_index is None:
+        return {'error': 'No path found'}
+
+    routes = pareto_search(graph, source_index, target_index, objectives, epsilon, max_labels)
+    if len(routes) == 0:
+        return {'error': 'No path found'}
+
+    return [time.time() - start_time] + [graph.path_result(source, target, costs[0], path_edges)
+                                         for costs, path_edges in routes]
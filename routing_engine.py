@@ -0,0 +1,560 @@
+import os
+import copy
+import json
+import time
+import heapq
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+from graph_bridge import App
+
+# Edge attributes kept by the engine, the ones used as weights and the ones listed for every edge of a path
+EDGE_ATTRIBUTES = ['distance', 'green_area', 'pm10', 'pm10_metre', 'inv_ga_metre', 'green_area_distance',
+                   'combined_weight']
+WEIGHT_PROPERTIES = ['distance', 'pm10_metre', 'inv_ga_metre', 'green_area_distance']
+EDGE_PROPERTIES = ['distance', 'green_area', 'pm10', 'pm10_metre', 'inv_ga_metre', 'green_area_distance']
+
+EARTH_RADIUS = 6371008.8
+
+# A point to point Dijkstra settling more than 1 / SEARCH_SETTLED_FRACTION of the nodes goes on with csgraph
+SEARCH_SETTLED_FRACTION = 64
+
+# Version of the layout of the graph snapshots, a snapshot of another version has to be written again
+SNAPSHOT_VERSION = 1
+
+
+def haversine(lon0, lat0, lon1, lat1):
+    """
+    Distance in metres between points given in degrees of longitude and latitude
+    """
+    lon0, lat0, lon1, lat1 = map(np.radians, (lon0, lat0, lon1, lat1))
+    a = np.sin((lat1 - lat0) / 2) ** 2 + np.cos(lat0) * np.cos(lat1) * np.sin((lon1 - lon0) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def read_snapshot_manifest(snapshot_dir):
+    """
+    Manifest of a graph snapshot written by RoutingGraph.save_snapshot, checking its version
+    """
+    with open(os.path.join(snapshot_dir, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    if manifest.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f"Graph snapshot {snapshot_dir} has version {manifest.get('version')}, "
+                         f"version {SNAPSHOT_VERSION} is needed: export it again")
+    return manifest
+
+
+class RoutingGraph:
+    """
+    In-memory copy of the footway graph, to find paths without Neo4j.
+    The ROUTE relationships are stored in CSR form (the edges leaving node i are edges indptr[i]:indptr[i + 1],
+    going to the nodes indices[indptr[i]:indptr[i + 1]]) with a float32 column for every edge attribute.
+    """
+    def __init__(self, node_ids, lon, lat, sources, targets, attributes):
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        order = np.argsort(sources, kind='stable')
+
+        self.node_ids = np.asarray(node_ids)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.lat = np.asarray(lat, dtype=np.float64)
+
+        self.indptr = np.zeros(len(self.node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(self.node_ids)), out=self.indptr[1:])
+        self.indices = targets[order].astype(np.int32)
+        self.edge_sources = sources[order].astype(np.int32)
+        self.attributes = {name: np.asarray(attributes[name], dtype=np.float32)[order] for name in EDGE_ATTRIBUTES}
+        self._init_caches()
+
+    def _init_caches(self):
+        # Index of the ids and plain lists of the CSR arrays (faster than arrays in the search loops),
+        # built at the first use
+        self._node_index = None
+        self._indptr_list = None
+        self._indices_list = None
+        self._weights = {}
+        self._weight_arrays = {}
+        self._heuristic_scales = {}
+        self._matrices = {}
+        self._combined_weight_stats = None
+
+        # Ratios of the combined weights computed so far, by attribute name
+        self.combined_weights = {}
+
+    @property
+    def node_index(self):
+        if self._node_index is None:
+            self._node_index = {str(node_id): i for i, node_id in enumerate(self.node_ids.tolist())}
+        return self._node_index
+
+    @property
+    def _indptr(self):
+        if self._indptr_list is None:
+            self._indptr_list = self.indptr.tolist()
+        return self._indptr_list
+
+    @property
+    def _indices(self):
+        if self._indices_list is None:
+            self._indices_list = self.indices.tolist()
+        return self._indices_list
+
+    @property
+    def node_count(self):
+        return len(self.node_ids)
+
+    @property
+    def edge_count(self):
+        return len(self.indices)
+
+    @classmethod
+    def from_records(cls, edges, nodes=None):
+        """
+        Build the graph from the records of App.get_road_edges and, optionally, App.get_road_junction_nodes
+        (to include also the nodes without edges)
+        """
+        columns = ['source', 'target', 'source_lon', 'source_lat', 'target_lon', 'target_lat', 'name',
+                   'distance', 'green_area', 'pm10', 'pm10_metre', 'inv_ga_metre', 'combined_weight']
+        edges = pd.DataFrame([list(edge) for edge in edges], columns=columns)
+        nodes = None if nodes is None else pd.DataFrame([list(node) for node in nodes], columns=['id', 'lon', 'lat'])
+        return cls.from_frames(edges, nodes)
+
+    @classmethod
+    def from_neo4j(cls, greeter):
+        """
+        Build the graph reading the nodes and the edges from Neo4j
+        """
+        return cls.from_records(greeter.get_road_edges(), greeter.get_road_junction_nodes())
+
+    @classmethod
+    def from_csv(cls, edges_path, junctions_path=None):
+        """
+        Build the graph from the csv files written by export_to_csv.py (edges_*.csv and road_junctions.csv)
+        """
+        edges = pd.read_csv(edges_path, dtype={'source': str, 'target': str})
+        nodes = None
+        if junctions_path is not None:
+            nodes = pd.read_csv(junctions_path, dtype={'id': str}).dropna()
+        return cls.from_frames(edges, nodes)
+
+    @classmethod
+    def from_frames(cls, edges, nodes=None):
+        """
+        Build the graph from a DataFrame with the columns of the edges csv file
+        and an optional DataFrame with the columns of the road junctions csv file
+        """
+        # Nodes and their coordinates, from the junctions and from the endpoints of the edges
+        endpoints = [edges[['source', 'source_lon', 'source_lat']].set_axis(['id', 'lon', 'lat'], axis=1),
+                     edges[['target', 'target_lon', 'target_lat']].set_axis(['id', 'lon', 'lat'], axis=1)]
+        if nodes is not None:
+            endpoints.insert(0, nodes[['id', 'lon', 'lat']])
+        all_nodes = pd.concat(endpoints, ignore_index=True)
+        all_nodes = all_nodes[all_nodes['id'].notna()].drop_duplicates('id')
+
+        node_ids = all_nodes['id'].to_numpy()
+        index = pd.Index(node_ids)
+
+        attributes = {name: pd.to_numeric(edges[name], errors='coerce').to_numpy(dtype=np.float64)
+                      for name in ['distance', 'green_area', 'pm10', 'pm10_metre', 'inv_ga_metre', 'combined_weight']}
+        attributes['green_area_distance'] = attributes['distance'] * (attributes['green_area'] / 100)
+
+        return cls(node_ids, all_nodes['lon'].to_numpy(dtype=np.float64), all_nodes['lat'].to_numpy(dtype=np.float64),
+                   index.get_indexer(edges['source']), index.get_indexer(edges['target']), attributes)
+
+    @classmethod
+    def load(cls, config, greeter=None, data_version=None):
+        """
+        The graph of the snapshot of the graph_snapshot settings of config when enabled, otherwise read from Neo4j.
+        Without greeter the snapshot is opened without connecting to Neo4j, and a driver is created only to read
+        the graph when there is no snapshot. With greeter the snapshot has to be of the current data version
+        (or of data_version, if given), otherwise the graph is read again from Neo4j.
+        """
+        snapshot_config = config.get('graph_snapshot') or {}
+        if snapshot_config.get('enabled', False):
+            snapshot_dir = snapshot_config.get('snapshot_dir', './output/graph_snapshot')
+            try:
+                if greeter is not None and data_version is None:
+                    data_version = greeter.get_data_version()
+                return cls.from_snapshot(snapshot_dir, data_version=data_version)
+            except (OSError, ValueError) as e:
+                print(f"{e}, the graph is read from Neo4j")
+
+        if greeter is not None:
+            return cls.from_neo4j(greeter)
+        greeter = App(config['neo4j_URL'], config['neo4j_user'], config['neo4j_pwd'])
+        try:
+            return cls.from_neo4j(greeter)
+        finally:
+            greeter.close()
+
+    @classmethod
+    def from_snapshot(cls, snapshot_dir, mmap=True, data_version=None):
+        """
+        Open a snapshot written by save_snapshot. The CSR arrays and the edge attributes are memory mapped
+        (read from the disk only when used, and shared by the processes opening the same snapshot) unless mmap is
+        False, so the graph is ready in a few milliseconds. With data_version the snapshot has to be of that
+        data version of Neo4j.
+        """
+        manifest = read_snapshot_manifest(snapshot_dir)
+        if data_version is not None and manifest.get('data_version') != data_version:
+            raise ValueError(f"Graph snapshot {snapshot_dir} is of data version {manifest.get('data_version')}, "
+                             f"not {data_version}")
+
+        mmap_mode = 'r' if mmap else None
+        arrays = {name: np.load(os.path.join(snapshot_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+                  for name in ['node_ids', 'lon', 'lat', 'indptr', 'indices', 'edge_sources'] +
+                  [f"attribute_{name}" for name in EDGE_ATTRIBUTES]}
+        node_count, edge_count = manifest['node_count'], manifest['edge_count']
+        if len(arrays['indptr']) != node_count + 1 or any(
+                len(arrays[name]) != count for name, count in [('node_ids', node_count), ('lon', node_count),
+                                                               ('lat', node_count), ('indices', edge_count),
+                                                               ('edge_sources', edge_count)]):
+            raise ValueError(f"Graph snapshot {snapshot_dir} is incomplete")
+
+        graph = cls.__new__(cls)
+        # The ids stored as int64 are strings again, as the graphs read from the csv files or from Neo4j have them
+        graph.node_ids = arrays['node_ids'].astype(str).astype(object)
+        # Coordinates are stored as float32 (about 0.3 m), the haversine heuristic needs them in float64
+        graph.lon = arrays['lon'].astype(np.float64)
+        graph.lat = arrays['lat'].astype(np.float64)
+        graph.indptr = arrays['indptr']
+        graph.indices = arrays['indices']
+        graph.edge_sources = arrays['edge_sources']
+        graph.attributes = {name: arrays[f"attribute_{name}"] for name in EDGE_ATTRIBUTES}
+        graph._init_caches()
+        return graph
+
+    def save_snapshot(self, snapshot_dir, data_version=None):
+        """
+        Save the graph as a directory of .npy columns that from_snapshot can memory map: the node ids (int64 when
+        they are all integers) in the order of their dense indices, the float32 coordinates, the CSR arrays and
+        the float32 edge attributes, with a manifest.json of the versions and of the sizes written last.
+        Every file replaces the previous one only when complete, so the processes that mapped it keep reading it.
+        """
+        os.makedirs(snapshot_dir, exist_ok=True)
+        node_ids = self.node_ids.astype(np.int64) if self.node_ids.dtype.kind in 'iu' else self.node_ids.astype(str)
+        if node_ids.dtype.kind == 'U':
+            # Ids written as integers are stored as int64, the others as fixed width strings
+            try:
+                numeric = node_ids.astype(np.int64)
+                if np.array_equal(numeric.astype(str), node_ids):
+                    node_ids = numeric
+            except (ValueError, OverflowError):
+                pass
+
+        arrays = {'node_ids': node_ids,
+                  'lon': self.lon.astype(np.float32), 'lat': self.lat.astype(np.float32),
+                  'indptr': self.indptr.astype(np.int64), 'indices': self.indices.astype(np.int32),
+                  'edge_sources': self.edge_sources.astype(np.int32)}
+        arrays.update({f"attribute_{name}": self.attributes[name].astype(np.float32) for name in EDGE_ATTRIBUTES})
+        for name, values in arrays.items():
+            path = os.path.join(snapshot_dir, f"{name}.npy")
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, np.ascontiguousarray(values))
+            os.replace(path + ".tmp", path)
+
+        manifest = {'version': SNAPSHOT_VERSION, 'data_version': data_version,
+                    'node_count': self.node_count, 'edge_count': self.edge_count,
+                    'node_ids': str(arrays['node_ids'].dtype), 'attributes': EDGE_ATTRIBUTES,
+                    'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        path = os.path.join(snapshot_dir, "manifest.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(path + ".tmp", path)
+        return snapshot_dir
+
+    def index_of(self, node_id):
+        """
+        Dense index of a RoadJunction id
+        """
+        return self.node_index.get(str(node_id))
+
+    def combined_weight_stats(self):
+        """
+        Ranges of pm10_metre and inv_ga_metre used to normalize the combined weight
+        """
+        if self._combined_weight_stats is None:
+            pm10_metre = self.attributes['pm10_metre'].astype(np.float64)
+            inv_ga_metre = self.attributes['inv_ga_metre'].astype(np.float64)
+            self._combined_weight_stats = {
+                'min_pm10_metre': np.nanmin(pm10_metre), 'max_pm10_metre': np.nanmax(pm10_metre),
+                'min_inv_ga_metre': np.nanmin(inv_ga_metre), 'max_inv_ga_metre': np.nanmax(inv_ga_metre)}
+        return self._combined_weight_stats
+
+    def combined_weight_scales(self, pm10_ratio, inv_green_area_ratio):
+        """
+        Factors of pm10_metre and inv_ga_metre (less their minimum) in the combined weight: the ratios divided by
+        the ranges, 0 for a property with the same value on every edge, as in Neo4j
+        """
+        stats = self.combined_weight_stats()
+        pm10_range = stats['max_pm10_metre'] - stats['min_pm10_metre']
+        inv_ga_range = stats['max_inv_ga_metre'] - stats['min_inv_ga_metre']
+        return (pm10_ratio / pm10_range if pm10_range > 0 else 0.0,
+                inv_green_area_ratio / inv_ga_range if inv_ga_range > 0 else 0.0)
+
+    def combined_weight(self, pm10_ratio, inv_green_area_ratio):
+        """
+        Name of the edge attribute with the combined weight for the given ratios, computed at the first request
+        as in Neo4j: pm10_metre and inv_ga_metre normalized with their ranges, weighted by the ratios
+        """
+        name = f"combined_weight_{pm10_ratio}_{inv_green_area_ratio}"
+        if name not in self.attributes:
+            stats = self.combined_weight_stats()
+            pm10_scale, inv_ga_scale = self.combined_weight_scales(pm10_ratio, inv_green_area_ratio)
+            pm10_metre = self.attributes['pm10_metre'].astype(np.float64)
+            inv_ga_metre = self.attributes['inv_ga_metre'].astype(np.float64)
+            combined = pm10_scale * (pm10_metre - stats['min_pm10_metre']) + \
+                inv_ga_scale * (inv_ga_metre - stats['min_inv_ga_metre'])
+            self.attributes[name] = combined.astype(np.float32)
+            self.combined_weights[name] = (pm10_ratio, inv_green_area_ratio)
+        return name
+
+    def with_attributes(self, attributes):
+        """
+        Copy of the graph sharing the topology (nodes, CSR arrays and their lists) with new edge attribute columns,
+        in the order of the edges. The columns not given are shared with this graph, the combined weights are
+        computed again on the new columns.
+        """
+        graph = copy.copy(self)
+        graph.attributes = {name: values for name, values in self.attributes.items()
+                            if name not in self.combined_weights}
+        graph.attributes.update({name: np.asarray(values, dtype=np.float32) for name, values in attributes.items()})
+        graph._weights = {}
+        graph._weight_arrays = {}
+        graph._heuristic_scales = {}
+        graph._matrices = {}
+        graph._combined_weight_stats = None
+        graph.combined_weights = {}
+        for pm10_ratio, inv_green_area_ratio in self.combined_weights.values():
+            graph.combined_weight(pm10_ratio, inv_green_area_ratio)
+        return graph
+
+    def edges_between(self, source_ids, target_ids):
+        """
+        Positions of the edges between the pairs of RoadJunction ids, in both directions, and the pair of each
+        """
+        sources = np.array([self.node_index.get(str(node_id), -1) for node_id in source_ids], dtype=np.int64)
+        targets = np.array([self.node_index.get(str(node_id), -1) for node_id in target_ids], dtype=np.int64)
+        known = np.flatnonzero((sources >= 0) & (targets >= 0))
+        pairs = np.concatenate((known, known))
+        keys = np.concatenate((sources[known] * self.node_count + targets[known],
+                               targets[known] * self.node_count + sources[known]))
+
+        # Edges sorted by source and target, the parallel ones are all found
+        edge_keys = self.edge_sources.astype(np.int64) * self.node_count + self.indices
+        order = np.argsort(edge_keys, kind='stable')
+        first = np.searchsorted(edge_keys[order], keys, side='left')
+        counts = np.searchsorted(edge_keys[order], keys, side='right') - first
+        positions = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return order[positions], np.repeat(pairs, counts)
+
+    def with_air_quality(self, id_pairs, mean_air_quality_values):
+        """
+        Copy of the graph with new pm10 values on the edges between the pairs of RoadJunction ids (in both
+        directions), and their pm10_metre = pm10 * distance: the same properties App.add_edge_air_quality_in_bulk
+        and App.update_edge_air_quality write in Neo4j
+        """
+        edges, pairs = self.edges_between([pair[0] for pair in id_pairs], [pair[1] for pair in id_pairs])
+        values = np.asarray(mean_air_quality_values, dtype=np.float64)
+        pm10 = self.attributes['pm10'].copy()
+        pm10[edges] = values[pairs]
+        pm10_metre = self.attributes['pm10_metre'].copy()
+        pm10_metre[edges] = values[pairs] * self.attributes['distance'][edges].astype(np.float64)
+        return self.with_attributes({'pm10': pm10, 'pm10_metre': pm10_metre})
+
+    def changed_weights(self, previous):
+        """
+        Weights whose values differ from the ones of a previous copy of the graph with the same topology
+        """
+        return [name for name, values in self.attributes.items() if previous.attributes.get(name) is not values]
+
+    def weight_array(self, weight):
+        """
+        Weights of the edges as a float64 array, missing values make the edge not usable
+        """
+        if weight not in self._weight_arrays:
+            values = self.attributes[weight].astype(np.float64)
+            self._weight_arrays[weight] = np.where(np.isnan(values), np.inf, values)
+        return self._weight_arrays[weight]
+
+    def edge_weights(self, weight):
+        """
+        Weights of the edges as a list, for the search loops
+        """
+        if weight not in self._weights:
+            self._weights[weight] = self.weight_array(weight).tolist()
+        return self._weights[weight]
+
+    def heuristic(self, weight, target):
+        """
+        Lower bound of the cost from every node to the target: the haversine distance scaled by the smallest ratio
+        between the weight and the straight length of an edge, so it is admissible and consistent for any weight
+        """
+        if weight not in self._heuristic_scales:
+            length = haversine(self.lon[self.edge_sources], self.lat[self.edge_sources],
+                               self.lon[self.indices], self.lat[self.indices])
+            values = self.weight_array(weight)
+            valid = length > 0
+            scale = np.min(values[valid] / length[valid]) if valid.any() else 0.0
+            self._heuristic_scales[weight] = scale if np.isfinite(scale) and scale > 0 else 0.0
+
+        scale = self._heuristic_scales[weight]
+        if scale == 0.0:
+            return None
+        return (scale * haversine(self.lon, self.lat, self.lon[target], self.lat[target])).tolist()
+
+    def weight_matrix(self, weight, reverse=False):
+        """
+        Sparse adjacency matrix of the graph with the given weight, transposed for the searches towards a node
+        """
+        if (weight, reverse) not in self._matrices:
+            matrix = sparse.csr_matrix((self.weight_array(weight), self.indices, self.indptr),
+                                       shape=(self.node_count, self.node_count))
+            self._matrices[(weight, reverse)] = matrix.T.tocsr() if reverse else matrix
+        return self._matrices[(weight, reverse)]
+
+    def one_to_all(self, sources, weight='distance', reverse=False, limit=np.inf):
+        """
+        Costs of the shortest paths from the source node(s) to all the nodes (or from all the nodes to the sources,
+        with reverse=True) and the predecessors (successors, if reverse) of the nodes in the shortest path tree.
+        The search stops at the limit cost.
+        """
+        return csgraph.dijkstra(self.weight_matrix(weight, reverse), indices=sources, return_predecessors=True,
+                                limit=limit)
+
+    def lightest_edge(self, node, next_node, weight='distance'):
+        """
+        Edge from node to next_node with the lowest weight
+        """
+        weights = self.edge_weights(weight)
+        edges = [edge for edge in range(self._indptr[node], self._indptr[node + 1]) if self._indices[edge] == next_node]
+        return min(edges, key=lambda edge: weights[edge])
+
+    def tree_edges(self, predecessors, weight='distance', reverse=False):
+        """
+        Edge from the predecessor of every node in a shortest path tree (to the successor, with reverse=True, for
+        the trees towards a node), the lightest one if more, or -1 for the root and the nodes not reached
+        """
+        predecessors = np.asarray(predecessors)
+        child, parent = (self.edge_sources, self.indices) if reverse else (self.indices, self.edge_sources)
+        on_tree = np.flatnonzero(predecessors[child] == parent)
+        on_tree = on_tree[np.lexsort((self.weight_array(weight)[on_tree], child[on_tree]))]
+        _, first = np.unique(child[on_tree], return_index=True)
+
+        edges = np.full(self.node_count, -1, dtype=np.int64)
+        edges[child[on_tree[first]]] = on_tree[first]
+        return edges
+
+    def path_from_tree(self, predecessors, source, target, weight='distance'):
+        """
+        Edges of the path from source to target in the shortest path tree rooted in source
+        """
+        nodes = [target]
+        while nodes[-1] != source:
+            nodes.append(predecessors[nodes[-1]])
+        nodes.reverse()
+        return [self.lightest_edge(node, next_node, weight) for node, next_node in zip(nodes, nodes[1:])]
+
+    def shortest_path(self, source, target, weight='distance', heuristic=None, max_settled=None):
+        """
+        Dijkstra (or A*, with a heuristic list) between two dense node indices, stopping at the target.
+        Returns the cost and the list of the edges of the path, or None if the target is not reachable;
+        with max_settled, False if the target is not reached after settling max_settled nodes.
+        """
+        indptr, indices, weights = self._indptr, self._indices, self.edge_weights(weight)
+        heappush, heappop = heapq.heappush, heapq.heappop
+
+        dist = [float('inf')] * self.node_count
+        previous_edge = [-1] * self.node_count
+        settled = bytearray(self.node_count)
+        dist[source] = 0.0
+        heap = [(0.0, 0.0, source)]
+        remaining = self.node_count if max_settled is None else max_settled
+        while heap:
+            _, cost, node = heappop(heap)
+            if settled[node]:
+                continue
+            if node == target:
+                break
+            if remaining == 0:
+                return False
+            remaining -= 1
+            settled[node] = 1
+
+            for edge in range(indptr[node], indptr[node + 1]):
+                next_node = indices[edge]
+                next_cost = cost + weights[edge]
+                if next_cost < dist[next_node]:
+                    dist[next_node] = next_cost
+                    previous_edge[next_node] = edge
+                    if heuristic is None:
+                        heappush(heap, (next_cost, next_cost, next_node))
+                    else:
+                        heappush(heap, (next_cost + heuristic[next_node], next_cost, next_node))
+
+        if dist[target] == float('inf'):
+            return None
+
+        path_edges = []
+        node = target
+        while node != source:
+            edge = previous_edge[node]
+            path_edges.append(edge)
+            node = self.edge_sources[edge]
+        path_edges.reverse()
+
+        return dist[target], path_edges
+
+    def path_result(self, source, target, cost, path_edges):
+        """
+        Description of a path with the same fields of the paths returned by routing_path
+        """
+        path_edges = np.asarray(path_edges, dtype=np.int64)
+        nodes = np.concatenate(([self.index_of(source)], self.indices[path_edges])).astype(np.int64)
+        totals = {name: float(np.nansum(self.attributes[name][path_edges].astype(np.float64)))
+                  for name in ['distance', 'green_area', 'pm10_metre', 'inv_ga_metre', 'green_area_distance']}
+        pm10 = self.attributes['pm10'][path_edges].astype(np.float64)
+        avg_pm10 = float(np.nanmean(pm10)) if np.any(~np.isnan(pm10)) else None
+
+        return {'hops': len(nodes), 'source': source, 'target': target, 'cost': float(cost),
+                'distance': totals['distance'], 'pm10': avg_pm10, 'green_area': totals['green_area'],
+                'pm10_metre': totals['pm10_metre'], 'inv_ga_metre': totals['inv_ga_metre'],
+                'green_area_distance': totals['green_area_distance'],
+                'nodes': self.node_ids[nodes].tolist(),
+                'coordinates': np.column_stack((self.lon[nodes], self.lat[nodes])).tolist(),
+                'edges': [dict(zip(EDGE_PROPERTIES, values)) for values in zip(
+                    *[self.attributes[name][path_edges].astype(np.float64).tolist() for name in EDGE_PROPERTIES])]}
+
+    def route(self, source, target, weight='distance', algorithm='dijkstra'):
+        """
+        Path between two RoadJunction ids, with the same result of routing_path:
+        the execution time followed by the description of the path
+        """
+        start_time = time.time()
+
+        source_index, target_index = self.index_of(source), self.index_of(target)
+        if source_index is None or target_index is None:
+            return {'error': 'No path found'}
+
+        if algorithm == 'dijkstra':
+            # The search stops at the target, a far one is left to the search of csgraph over the whole graph,
+            # that settles the nodes several times faster
+            found = self.shortest_path(source_index, target_index, weight,
+                                       max_settled=max(self.node_count // SEARCH_SETTLED_FRACTION, 1))
+            if found is False:
+                costs, predecessors = self.one_to_all(source_index, weight)
+                found = None
+                if np.isfinite(costs[target_index]):
+                    found = costs[target_index], self.path_from_tree(predecessors, source_index, target_index,
+                                                                     weight)
+        elif algorithm == 'a_star':
+            found = self.shortest_path(source_index, target_index, weight, self.heuristic(weight, target_index))
+        else:
+            return {'error': f'Algorithm {algorithm} not supported'}
+
+        if found is None:
+            return {'error': 'No path found'}
+
+        path = self.path_result(source, target, *found)
+        return [time.time() - start_time, path]
@@ -0,0 +1,417 @@
+import sys
+import json
+import time
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from graph_bridge import App, combined_weight_ratios
+from routing_engine import RoutingGraph, read_snapshot_manifest
+from live_graph import LiveRoutingGraph
+from contraction_hierarchy import ContractionHierarchy
+from landmarks import Landmarks
+from spatial_index import SpatialIndex, snap_query
+from footway_routing import routing_path, memory_routing_path
+from pareto_routing import PARETO_EPSILON
+
+# Defaults of the routing_service field of config.json
+SERVICE_DEFAULTS = {'host': '127.0.0.1', 'port': 8080, 'workers': 4, 'max_queue': 16, 'cache_size': 1024,
+                    'version_check_interval': 1.0, 'latency_window': 10000}
+
+
+class ServiceBusy(Exception):
+    pass
+
+
+class LRUCache:
+    """
+    Least recently used cache of the routing results, safe to use from many threads
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class LatencyStats:
+    """
+    Latencies of the last requests, for the p50 and p99 of the service
+    """
+    def __init__(self, window):
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def add(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.count += 1
+
+    def summary(self):
+        with self.lock:
+            latencies = np.asarray(self.latencies)
+            count = self.count
+        if len(latencies) == 0:
+            return {'requests': count, 'p50_ms': None, 'p99_ms': None}
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        return {'requests': count, 'p50_ms': float(p50), 'p99_ms': float(p99)}
+
+
+class RoutingService:
+    """
+    Routing queries with the fields of routing_query.json, answered by a bounded pool of worker threads
+    sharing one Neo4j driver and, for the memory backend, one copy of the graph.
+    The results are cached by query and data version: when the air quality merge bumps the data version
+    the cache is emptied and the in-memory graph loaded again.
+    With the graph snapshot enabled the service starts from it without Neo4j, and connects to Neo4j when the
+    first query needs it; while Neo4j cannot be reached the memory backend answers from the snapshot.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.settings = dict(SERVICE_DEFAULTS, **config.get('routing_service', {}))
+        self.greeter_lock = threading.Lock()
+        self.greeter = None
+
+        self.executor = ThreadPoolExecutor(max_workers=self.settings['workers'])
+        # Requests running or waiting for a worker, beyond them the service answers busy
+        self.slots = threading.BoundedSemaphore(self.settings['workers'] + self.settings['max_queue'])
+        self.cache = LRUCache(self.settings['cache_size'])
+        self.latency = LatencyStats(self.settings['latency_window'])
+
+        self.version_lock = threading.Lock()
+        self.data_version = None
+        self.version_checked = 0.0
+
+        # In-memory graph with live weights, and the data version of Neo4j its weights match
+        self.router_lock = threading.Lock()
+        self.live = None
+        self.live_data_version = None
+        self.snapshot_data_version = None
+        snapshot_config = config.get('graph_snapshot') or {}
+        if snapshot_config.get('enabled', False):
+            snapshot_dir = snapshot_config.get('snapshot_dir', './output/graph_snapshot')
+            try:
+                self.snapshot_data_version = read_snapshot_manifest(snapshot_dir).get('data_version')
+                self.live = LiveRoutingGraph(RoutingGraph.from_snapshot(snapshot_dir))
+                self.live_data_version = self.snapshot_data_version
+            except (OSError, ValueError) as e:
+                self.snapshot_data_version = None
+                print(f"{e}, the graph is read from Neo4j")
+
+        # The positions of the nodes do not change with the data version
+        self.index_lock = threading.Lock()
+        self.spatial_index = None
+
+    def close(self):
+        self.executor.shutdown()
+        if self.greeter is not None:
+            self.greeter.close()
+
+    def neo4j(self):
+        """
+        The Neo4j driver, connected at the first use
+        """
+        with self.greeter_lock:
+            if self.greeter is None:
+                self.greeter = App(self.config['neo4j_URL'], self.config['neo4j_user'], self.config['neo4j_pwd'],
+                                   exit_on_failure=False)
+            return self.greeter
+
+    def current_data_version(self, force=False):
+        """
+        Data version of the edges, read again from Neo4j at most every version_check_interval seconds.
+        A new version empties the cache and drops the in-memory graph, unless its weights have already been
+        published to it.
+        """
+        with self.version_lock:
+            now = time.time()
+            if force or self.data_version is None or now - self.version_checked > \
+                    self.settings['version_check_interval']:
+                self.version_checked = now
+                try:
+                    data_version = self.neo4j().get_data_version()
+                except Exception as e:
+                    if self.snapshot_data_version is None:
+                        raise
+                    # The snapshot stands for the data until Neo4j is reachable again
+                    print(f"{e}, answering from the graph snapshot")
+                    data_version = self.snapshot_data_version if self.data_version is None else self.data_version
+                if data_version != self.data_version:
+                    self.data_version = data_version
+                    self.cache.clear()
+                    with self.router_lock:
+                        if self.live_data_version != data_version:
+                            self.live = None
+            return self.data_version
+
+    def invalidate(self):
+        """
+        Empty the cache and check the data version, called when the air quality merge has run
+        """
+        self.cache.clear()
+        return self.current_data_version(force=True)
+
+    def live_graph(self):
+        """
+        The in-memory graph, loaded at the first query of a data version from Neo4j or from the graph snapshot of
+        the same data version
+        """
+        with self.router_lock:
+            if self.live is None:
+                self.live = LiveRoutingGraph(RoutingGraph.load(self.config, self.neo4j(), self.data_version))
+                self.live_data_version = self.data_version
+            return self.live
+
+    def publish_air_quality(self, id_pairs, mean_air_quality_values, data_version=None):
+        """
+        Swap the pm10 values of the edges in the in-memory graph, without loading it again: the queries running
+        end with the previous values. data_version is the one of Neo4j after the same values have been written.
+        """
+        with self.router_lock:
+            live = self.live
+        if live is None:
+            # The graph is loaded with the new values at the next query
+            return {'published': False, 'data_version': self.invalidate()}
+
+        elapsed_time = live.publish_air_quality(id_pairs, mean_air_quality_values)
+        with self.router_lock:
+            if data_version is not None:
+                self.live_data_version = data_version
+        self.cache.clear()
+        return {'published': True, 'elapsed_time': elapsed_time, 'weights_version': live.current.version,
+                'data_version': self.current_data_version(force=True)}
+
+    def memory_router(self, live, buffer, algorithm, weight, ratios):
+        """
+        The graph of the buffer, or its hierarchy or landmarks prepared for the weight.
+        Returns the router and the name of the weight in the graph.
+        """
+        with self.router_lock, live.preparing():
+            graph = buffer.graph
+            if weight == 'combined_weight':
+                weight = graph.combined_weight(**ratios)
+
+            if algorithm == 'cch':
+                router = live.router(buffer, 'cch', lambda graph: ContractionHierarchy.load(
+                    graph, self.config.get('contraction_hierarchy_dir', './output/contraction_hierarchy')))
+                if weight not in router.metrics:
+                    router.customize([weight])
+            elif algorithm == 'alt':
+                router = live.router(buffer, 'alt',
+                                     lambda graph: Landmarks(graph, self.settings.get('landmarks', 16), weights=[]))
+                router.build([name for name in router.table_names(weight) if name not in router.tables])
+            else:
+                router = graph
+            return router, weight
+
+    def snap(self, query):
+        """
+        Query with the ids of the road junctions nearest to its coordinates, if it has any
+        """
+        if 'source_coordinates' not in query and 'destination_coordinates' not in query:
+            return query
+        with self.index_lock:
+            if self.spatial_index is None:
+                if self.snapshot_data_version is not None:
+                    self.spatial_index = SpatialIndex.from_graph(self.live_graph().current.graph)
+                else:
+                    self.spatial_index = SpatialIndex.from_neo4j(self.neo4j())
+        return snap_query(self.spatial_index, query)
+
+    def cache_key(self, query, data_version):
+        ratios = None
+        if query['weight'] == 'combined_weight':
+            ratios = tuple(sorted(combined_weight_ratios(query['combined_weight']).items()))
+        alternatives = tuple(sorted(query.get('alternatives', {}).items()))
+        # The weights published to the in-memory graph change without a new data version
+        live = self.live
+        weights_version = live.current.version if live is not None and query.get('backend') == 'memory' else None
+        return (str(query['source_id']), str(query['destination_id']), query['weight'], ratios,
+                query['algorithm'], query.get('top_k', 2), query.get('backend', 'neo4j'),
+                query.get('pareto_epsilon', PARETO_EPSILON), alternatives, weights_version, data_version)
+
+    def _route(self, query):
+        ratios = combined_weight_ratios(query['combined_weight']) if query['weight'] == 'combined_weight' else None
+        if query.get('backend', 'neo4j') == 'memory':
+            live = self.live_graph()
+            with live.reading() as buffer:
+                router, weight = self.memory_router(live, buffer, query['algorithm'], query['weight'], ratios)
+                return memory_routing_path(router, query['source_id'], query['destination_id'], weight,
+                                           query['algorithm'], False, query.get('pareto_epsilon', PARETO_EPSILON),
+                                           query.get('top_k', 2), query.get('alternatives'))
+        return routing_path(self.neo4j(), query['source_id'], query['destination_id'], query['weight'],
+                            query['algorithm'], query.get('top_k', 2), False, ratios)
+
+    def route(self, query):
+        """
+        Result of a routing query, from the cache or from a worker. Raises ServiceBusy when all the workers
+        are busy and the queue is full.
+        """
+        start_time = time.time()
+        query = self.snap(query)
+        key = self.cache_key(query, self.current_data_version())
+
+        result = self.cache.get(key)
+        cached = result is not None
+        if not cached:
+            if not self.slots.acquire(blocking=False):
+                raise ServiceBusy('Too many routing requests')
+            try:
+                result = self.executor.submit(self._route, query).result()
+            finally:
+                self.slots.release()
+            if 'error' not in result:
+                self.cache.put(key, result)
+
+        self.latency.add(time.time() - start_time)
+        if 'error' in result:
+            return result
+        return {'execution_time': result[0], 'paths': result[1:], 'cached': cached, 'data_version': key[-1]}
+
+    def stats(self):
+        summary = self.latency.summary()
+        summary.update({'cache_entries': len(self.cache.entries), 'cache_hits': self.cache.hits,
+                        'cache_misses': self.cache.misses, 'data_version': self.data_version})
+        if self.live is not None:
+            summary['weights'] = self.live.stats()
+        return summary
+
+
+def parse_air_quality_update(update):
+    """
+    The id_pairs, pm10 values and data_version of a POST /air_quality body, a ValueError if it is malformed.
+    The RoadJunction ids, strings as the merge sends them or integers, are returned as strings like the keys of
+    RoutingGraph.node_index.
+    """
+    if not isinstance(update, dict):
+        raise ValueError('the body is not an object')
+    id_pairs = update.get('id_pairs')
+    pm10 = update.get('pm10')
+    if not isinstance(id_pairs, list) or not isinstance(pm10, list):
+        raise ValueError('id_pairs and pm10 have to be lists')
+    if len(id_pairs) != len(pm10):
+        raise ValueError(f'{len(id_pairs)} id_pairs for {len(pm10)} pm10 values')
+    for pair in id_pairs:
+        if not isinstance(pair, list) or len(pair) != 2 or \
+                not all(isinstance(node, (str, int)) and not isinstance(node, bool) for node in pair):
+            raise ValueError(f'the id pair {pair} is not two RoadJunction ids')
+    for value in pm10:
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise ValueError(f'the pm10 value {value} is not a number')
+    return [[str(node) for node in pair] for pair in id_pairs], pm10, update.get('data_version')
+
+
+def json_default(value):
+    # numpy scalars of the in-memory results
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class RoutingRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /route with the fields of routing_query.json, GET /stats for the latency and the cache,
+    POST /invalidate after the air quality merge, or POST /air_quality with its id_pairs and pm10 values
+    to swap them in the in-memory graph
+    """
+    service = None
+
+    def send_json(self, status, body):
+        data = json.dumps(body, default=json_default).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.service.stats())
+        else:
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path == '/invalidate':
+            self.send_json(200, {'data_version': self.service.invalidate()})
+            return
+        if self.path == '/air_quality':
+            try:
+                update = parse_air_quality_update(
+                    json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0)))))
+                result = self.service.publish_air_quality(*update)
+            except ValueError as e:
+                self.send_json(400, {'error': f'Invalid air quality update: {e}'})
+            except Exception as e:
+                print(e)
+                self.send_json(500, {'error': str(e)})
+            else:
+                self.send_json(200, result)
+            return
+        if self.path != '/route':
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+
+        try:
+            query = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            result = self.service.route(query)
+        except ServiceBusy as e:
+            self.send_json(503, {'error': str(e)})
+        except (ValueError, KeyError) as e:
+            self.send_json(400, {'error': f'Invalid query: {e}'})
+        except Exception as e:
+            print(e)
+            self.send_json(500, {'error': str(e)})
+        else:
+            self.send_json(404 if 'error' in result else 200, result)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(config):
+    service = RoutingService(config)
+    RoutingRequestHandler.service = service
+    server = ThreadingHTTPServer((service.settings['host'], service.settings['port']), RoutingRequestHandler)
+    print(f"Routing service listening on {service.settings['host']}:{service.settings['port']}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    with open("data/config.json", "r") as file:
+        config_file = json.load(file)
+
+    try:
+        main(config_file)
+    except Exception as e:
+        print(e)
+        sys.exit(1)
@@ -0,0 +1,185 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from routing_engine import EARTH_RADIUS
+
+
+class SpatialIndex:
+    """
+    KD-tree of the RoadJunction nodes, and of points sampled along the edges, to snap longitude and latitude
+    to the nearest node or to the nearest point of an edge. The coordinates are projected in metres with an
+    equirectangular projection centred on the graph, accurate enough at the scale of a city.
+    """
+    def __init__(self, node_ids, lon, lat, edge_sources=None, edge_targets=None, spacing=20.0):
+        self.node_ids = np.asarray(node_ids).astype(str)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.origin_lat = np.radians(np.nanmean(self.lat))
+
+        valid = np.isfinite(self.lon) & np.isfinite(self.lat)
+        self.node_rows = np.flatnonzero(valid)
+        self.nodes = self.project(self.lon[valid], self.lat[valid])
+        self.node_tree = cKDTree(self.nodes)
+
+        self.edge_tree = None
+        if edge_sources is not None:
+            self._build_edge_tree(np.asarray(edge_sources), np.asarray(edge_targets), spacing)
+
+    @classmethod
+    def from_graph(cls, graph, spacing=20.0):
+        """
+        Index of the nodes and the edges of a RoutingGraph, each pair of opposite edges once
+        """
+        sources, targets = graph.edge_sources, graph.indices
+        pairs = np.column_stack((np.minimum(sources, targets), np.maximum(sources, targets)))
+        _, keep = np.unique(pairs, axis=0, return_index=True)
+        return cls(graph.node_ids, graph.lon, graph.lat, sources[keep], targets[keep], spacing)
+
+    @classmethod
+    def from_records(cls, nodes, edges=None, spacing=20.0):
+        """
+        Index of the records of App.get_road_junction_nodes and, optionally, App.get_edges_endpoints
+        """
+        nodes = pd.DataFrame([list(node) for node in nodes], columns=['id', 'lon', 'lat'])
+        if edges is None:
+            return cls(nodes['id'], nodes['lon'], nodes['lat'])
+        index = pd.Index(nodes['id'].astype(str))
+        sources = index.get_indexer([str(edge[0]) for edge in edges])
+        targets = index.get_indexer([str(edge[1]) for edge in edges])
+        known = (sources >= 0) & (targets >= 0)
+        return cls(nodes['id'], nodes['lon'], nodes['lat'], sources[known], targets[known], spacing)
+
+    @classmethod
+    def from_neo4j(cls, greeter, with_edges=True, spacing=20.0):
+        """
+        Index of the nodes and, optionally, of the edges read from Neo4j
+        """
+        edges = greeter.get_edges_endpoints() if with_edges else None
+        return cls.from_records(greeter.get_road_junction_nodes(), edges, spacing)
+
+    @classmethod
+    def from_csv(cls, junctions_path):
+        """
+        Index of the nodes in the road_junctions.csv file written by export_to_csv.py
+        """
+        nodes = pd.read_csv(junctions_path, dtype={'id': str}).dropna()
+        return cls(nodes['id'], nodes['lon'], nodes['lat'])
+
+    def project(self, lon, lat):
+        """
+        Coordinates in metres of the given longitudes and latitudes
+        """
+        lon, lat = np.radians(np.asarray(lon, dtype=np.float64)), np.radians(np.asarray(lat, dtype=np.float64))
+        return np.column_stack((EARTH_RADIUS * lon * np.cos(self.origin_lat), EARTH_RADIUS * lat))
+
+    def unproject(self, points):
+        """
+        Longitudes and latitudes of points in metres
+        """
+        return np.degrees(points[:, 0] / (EARTH_RADIUS * np.cos(self.origin_lat))), \
+            np.degrees(points[:, 1] / EARTH_RADIUS)
+
+    def _build_edge_tree(self, sources, targets, spacing):
+        """
+        Points every spacing metres along the edges: the nearest edge of a point has a sample within spacing / 2
+        of the nearest point of the edge, so the samples find all the candidate edges
+        """
+        self.spacing = spacing
+        points = self.project(self.lon, self.lat)
+        valid = np.isfinite(points[sources]).all(axis=1) & np.isfinite(points[targets]).all(axis=1)
+        self.edge_sources, self.edge_targets = sources[valid], targets[valid]
+        self.edge_start, self.edge_end = points[self.edge_sources], points[self.edge_targets]
+
+        length = np.linalg.norm(self.edge_end - self.edge_start, axis=1)
+        samples = np.ceil(length / spacing).astype(np.int64) + 1
+        self.sample_edges = np.repeat(np.arange(len(length)), samples)
+        first = np.cumsum(samples) - samples
+        fraction = (np.arange(len(self.sample_edges)) - np.repeat(first, samples)) / \
+            np.repeat(np.maximum(samples - 1, 1), samples)
+        sample_points = self.edge_start[self.sample_edges] + \
+            fraction[:, None] * (self.edge_end - self.edge_start)[self.sample_edges]
+        self.edge_tree = cKDTree(sample_points)
+
+    def snap_nodes(self, lon, lat, max_distance=np.inf):
+        """
+        Nearest RoadJunction of every point: returns the ids (None when farther than max_distance metres)
+        and the distances in metres
+        """
+        distances, rows = self.node_tree.query(self.project(np.atleast_1d(lon), np.atleast_1d(lat)),
+                                               distance_upper_bound=max_distance)
+        found = np.isfinite(distances)
+        ids = np.full(len(rows), None, dtype=object)
+        ids[found] = self.node_ids[self.node_rows[rows[found]]]
+        return ids, distances
+
+    def snap_edges(self, lon, lat, max_distance=np.inf):
+        """
+        Nearest point on an edge of every point. Returns a DataFrame with the ids of the edge endpoints,
+        the offset of the snapped point along the edge (0 at the source, 1 at the target), its distance
+        in metres and its coordinates; the rows farther than max_distance have no edge.
+        """
+        if self.edge_tree is None:
+            raise ValueError('The spatial index has no edges')
+        points = self.project(np.atleast_1d(lon), np.atleast_1d(lat))
+
+        # The nearest sample bounds the distance of the nearest edge, the samples within spacing / 2 more
+        # belong to all the edges that can be nearer
+        nearest, _ = self.edge_tree.query(points)
+        candidates = self.edge_tree.query_ball_point(points, nearest + self.spacing / 2)
+        counts = np.fromiter((len(candidate) for candidate in candidates), dtype=np.int64, count=len(points))
+        point_rows = np.repeat(np.arange(len(points)), counts)
+        edges = self.sample_edges[np.concatenate(candidates).astype(np.int64)] if counts.sum() else \
+            np.zeros(0, dtype=np.int64)
+
+        # Exact projection of every point on its candidate edges
+        start, vector = self.edge_start[edges], self.edge_end[edges] - self.edge_start[edges]
+        squared_length = np.einsum('ij,ij->i', vector, vector)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            offset = np.einsum('ij,ij->i', points[point_rows] - start, vector) / squared_length
+        offset = np.clip(np.nan_to_num(offset, nan=0.0), 0.0, 1.0)
+        snapped = start + offset[:, None] * vector
+        distance = np.linalg.norm(points[point_rows] - snapped, axis=1)
+
+        # Nearest candidate of every point
+        order = np.lexsort((distance, point_rows))
+        first = order[np.searchsorted(point_rows[order], np.arange(len(points)))]
+        snap_lon, snap_lat = self.unproject(snapped[first])
+        result = pd.DataFrame({'source': self.node_ids[self.edge_sources[edges[first]]],
+                               'target': self.node_ids[self.edge_targets[edges[first]]],
+                               'offset': offset[first], 'distance': distance[first],
+                               'lon': snap_lon, 'lat': snap_lat})
+
+        too_far = result['distance'] > max_distance
+        result[['source', 'target']] = result[['source', 'target']].astype(object)
+        result.loc[too_far, ['source', 'target']] = None
+        return result
+
+    def snap(self, lon, lat, mode='node', max_distance=np.inf):
+        """
+        RoadJunction ids for the points: the nearest node, or with mode 'edge' the endpoint of the nearest
+        edge nearer to the snapped point along the edge
+        """
+        if mode == 'node':
+            return self.snap_nodes(lon, lat, max_distance)[0]
+        snapped = self.snap_edges(lon, lat, max_distance)
+        ids = np.where(snapped['offset'] <= 0.5, snapped['source'], snapped['target'])
+        ids[snapped['source'].isna().to_numpy()] = None
+        return ids
+
+
+def snap_query(index, routing_query):
+    """
+    Routing query with source_id and destination_id found from source_coordinates and destination_coordinates
+    ([lon, lat]), when given, snapped as set by snap ('node' or 'edge') within snap_max_distance metres
+    """
+    routing_query = dict(routing_query)
+    for field in ['source', 'destination']:
+        coordinates = routing_query.get(f'{field}_coordinates')
+        if coordinates is None:
+            continue
+        node_id = index.snap(coordinates[0], coordinates[1], routing_query.get('snap', 'node'),
+                             routing_query.get('snap_max_distance') or np.inf)[0]
+        if node_id is None:
+            raise ValueError(f'No road junction near the {field} coordinates {coordinates}')
+        routing_query[f'{field}_id'] = node_id
+    return routing_query
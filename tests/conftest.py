@@ -0,0 +1,45 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from routing_engine import RoutingGraph
+
+
+@pytest.fixture
+def road_edges():
+    """
+    Records of App.get_road_edges for a 4 x 3 grid of RoadJunction nodes, with string ids as Neo4j stores them
+    """
+    ids = [[str(386879983 + 1000003 * (row * 4 + col)) for col in range(4)] for row in range(3)]
+    records = []
+    for row in range(3):
+        for col in range(4):
+            for next_row, next_col in [(row, col + 1), (row + 1, col)]:
+                if next_row == 3 or next_col == 4:
+                    continue
+                lon0, lat0 = 10.9 + 0.001 * col, 44.6 + 0.001 * row
+                lon1, lat1 = 10.9 + 0.001 * next_col, 44.6 + 0.001 * next_row
+                distance = 80.0 + 10 * row + col
+                green_area = 10.0 * (row + col)
+                pm10 = 20.0 + row + 2 * col
+                for source, target, coordinates in [(ids[row][col], ids[next_row][next_col], (lon0, lat0, lon1, lat1)),
+                                                    (ids[next_row][next_col], ids[row][col], (lon1, lat1, lon0, lat0))]:
+                    records.append([source, target, *coordinates, 'street', distance, green_area, pm10,
+                                    pm10 * distance, distance / max(green_area, 1.0), None])
+    return records
+
+
+@pytest.fixture
+def edges_endpoints(road_edges):
+    """
+    Records of App.get_edges_endpoints for the same graph, one per pair of nodes with the lower id first
+    """
+    return [[source, target, source_lon, source_lat, target_lon, target_lat]
+            for source, target, source_lon, source_lat, target_lon, target_lat, *_ in road_edges if source < target]
+
+
+@pytest.fixture
+def graph(road_edges):
+    return RoutingGraph.from_records(road_edges)
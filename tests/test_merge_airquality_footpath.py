@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+import merge_airquality_footpath
+from merge_airquality_footpath import check_sampling_config, sample_edges, sample_raster_in_tiles
+
+TRANSFORM = (10.8, 0.001, 0, 44.7, 0, -0.001)
+
+
+class Band:
+    """
+    Band of a GeoTIFF with 16 x 16 blocks, recording the windows read
+    """
+    def __init__(self, data):
+        self.data = data
+        self.YSize, self.XSize = data.shape
+        self.windows = []
+
+    def GetBlockSize(self):
+        return [16, 16]
+
+    def ReadAsArray(self, x_off, y_off, x_size, y_size):
+        self.windows.append((x_off, y_off, x_size, y_size))
+        return self.data[y_off:y_off + y_size, x_off:x_off + x_size].copy()
+
+
+class Raster:
+    def __init__(self, data):
+        self.band = Band(data)
+        self.RasterYSize, self.RasterXSize = data.shape
+
+    def GetRasterBand(self, index):
+        return self.band
+
+    def GetGeoTransform(self):
+        return TRANSFORM
+
+
+@pytest.fixture
+def edges():
+    """
+    Short edges all over the raster and a few long ones crossing it
+    """
+    rng = np.random.default_rng(0)
+    lon = 10.8 + rng.random((300, 1)) * 0.4
+    lat = 44.7 - rng.random((300, 1)) * 0.3
+    ends = np.hstack((lon, lat, lon + rng.normal(0, 0.003, (300, 1)), lat + rng.normal(0, 0.003, (300, 1))))
+    ends[:5] = [[10.801, 44.699, 11.199, 44.401], [10.8, 44.55, 11.2, 44.55], [10.95, 44.7, 10.95, 44.4],
+                [10.79, 44.71, 11.21, 44.39], [11.1, 44.41, 10.85, 44.69]]
+    return [(str(i), str(i + 1000), *end) for i, end in enumerate(ends.tolist())]
+
+
+@pytest.mark.parametrize('window_mean', ['grid', 'integral'])
+def test_tiles_stay_within_the_budget(monkeypatch, edges, window_mean):
+    data = np.random.default_rng(1).random((300, 400)) * 40
+    raster = Raster(data)
+    monkeypatch.setattr(merge_airquality_footpath.gdal, 'Open', lambda path: raster, raising=False)
+
+    budget_mb = 0.08
+    config = {'air_quality_in_footpath': {'buffer_size': 3, 'tile_budget_mb': budget_mb, 'window_mean': window_mean}}
+    mean_values = sample_raster_in_tiles(config, 'raster.tif', edges)
+
+    windows = raster.band.windows
+    assert max(x_size * y_size for _, _, x_size, y_size in windows) * 8 <= budget_mb * 1024 * 1024
+    assert len(set(windows)) == len(windows)
+    assert np.allclose(mean_values, sample_edges(config, data, TRANSFORM, edges), rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('settings, valid', [
+    ({'batch_sampling': True, 'sampling_mode': 'spacing', 'window_mean': 'integral'}, True),
+    ({'batch_sampling': False, 'sampling_mode': 'fixed', 'window_mean': 'grid'}, True),
+    ({'batch_sampling': False, 'sampling_mode': 'spacing'}, False),
+    ({'batch_sampling': False, 'window_mean': 'integral'}, False),
+    ({'sampling_operator': True, 'sampling_mode': 'spacing'}, True),
+    ({'batch_sampling': True, 'sampling_operator': True, 'window_mean': 'integral'}, False),
+    ({'incremental': {'enabled': True}, 'window_mean': 'integral'}, True),
+    ({'batch_sampling': True, 'window_mean': 'box'}, False),
+])
+def test_sampling_config(settings, valid):
+    if valid:
+        check_sampling_config(settings)
+    else:
+        with pytest.raises(ValueError):
+            check_sampling_config(settings)
@@ -0,0 +1,12 @@
+import pytest
+
+from pareto_routing import pareto_search
+
+
+def test_exact_pareto_search_needs_max_labels(graph):
+    source, target = graph.index_of(graph.node_ids[0]), graph.index_of(graph.node_ids[-1])
+    assert pareto_search(graph, source, target)
+    assert len(pareto_search(graph, source, target, epsilon=0.0, max_labels=2)) <= 2
+
+    with pytest.raises(ValueError):
+        pareto_search(graph, source, target, epsilon=0.0)
@@ -0,0 +1,22 @@
+import json
+import numpy as np
+import pytest
+
+from routing_engine import RoutingGraph
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_snapshot_round_trip(graph, tmp_path, mmap):
+    graph.save_snapshot(tmp_path / "snapshot", data_version=3)
+    snapshot = RoutingGraph.from_snapshot(tmp_path / "snapshot", mmap=mmap, data_version=3)
+
+    source, target = graph.node_ids[0], graph.node_ids[-1]
+    for weight in ['distance', 'pm10_metre']:
+        _, path = graph.route(source, target, weight)
+        _, snapshot_path = snapshot.route(source, target, weight)
+        assert snapshot_path['nodes'] == path['nodes']
+        assert all(isinstance(node, str) for node in snapshot_path['nodes'])
+        assert snapshot_path['cost'] == pytest.approx(path['cost'], rel=1e-6)
+        assert json.dumps(snapshot_path['nodes']) == json.dumps(path['nodes'])
+    assert snapshot.node_index == graph.node_index
+    assert np.array_equal(snapshot.indices, graph.indices)
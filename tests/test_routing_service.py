@@ -0,0 +1,101 @@
+import json
+import threading
+import numpy as np
+import pytest
+
+import merge_airquality_footpath
+from live_graph import LiveRoutingGraph
+from routing_service import RoutingService, RoutingRequestHandler, ThreadingHTTPServer, parse_air_quality_update
+
+
+class Greeter:
+    """
+    Neo4j side of the service and of the merge: only the data version after the merge is read
+    """
+    def get_data_version(self):
+        return 7
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def service(graph):
+    """
+    Routing service running on a free port with the graph in memory, and the config of the merge to reach it
+    """
+    routing_service = RoutingService({'routing_service': {'workers': 1}})
+    routing_service.greeter = Greeter()
+    routing_service.live = LiveRoutingGraph(graph)
+    routing_service.live_data_version = 6
+    RoutingRequestHandler.service = routing_service
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RoutingRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config = {'routing_service': {'host': '127.0.0.1', 'port': server.server_address[1], 'publish_air_quality': True}}
+    yield routing_service, config
+    server.shutdown()
+    server.server_close()
+    routing_service.close()
+
+
+def merge_body(edges_endpoints, values):
+    """
+    Body of POST /air_quality as the air quality merge sends it
+    """
+    id_pairs = [[edge[0], edge[1]] for edge in edges_endpoints]
+    return json.loads(json.dumps({'id_pairs': [list(pair) for pair in id_pairs],
+                                  'pm10': np.asarray(values, dtype=np.float64).tolist(), 'data_version': 7}))
+
+
+def test_air_quality_update_of_the_merge(graph, edges_endpoints):
+    values = np.arange(len(edges_endpoints), dtype=np.float64) + 40.0
+    id_pairs, pm10, data_version = parse_air_quality_update(merge_body(edges_endpoints, values))
+    assert data_version == 7
+
+    updated = graph.with_air_quality(id_pairs, pm10)
+    edges, pairs = graph.edges_between([pair[0] for pair in id_pairs], [pair[1] for pair in id_pairs])
+    assert len(edges) == 2 * len(edges_endpoints)
+    assert np.allclose(updated.attributes['pm10'][edges], values[pairs])
+
+
+def test_air_quality_update_integer_ids(graph, edges_endpoints):
+    body = merge_body(edges_endpoints, [1.0] * len(edges_endpoints))
+    body['id_pairs'] = [[int(node) for node in pair] for pair in body['id_pairs']]
+    id_pairs, _, _ = parse_air_quality_update(body)
+    assert all(node in graph.node_index for pair in id_pairs for node in pair)
+
+
+@pytest.mark.parametrize('body', [
+    [],
+    {'id_pairs': 1, 'pm10': []},
+    {'id_pairs': [['1', '2']], 'pm10': []},
+    {'id_pairs': [['1']], 'pm10': [1.0]},
+    {'id_pairs': [['1', None]], 'pm10': [1.0]},
+    {'id_pairs': [['1', '2']], 'pm10': ['x']},
+])
+def test_malformed_air_quality_update(body):
+    with pytest.raises(ValueError):
+        parse_air_quality_update(body)
+
+
+def test_merge_publishes_to_the_service(service, edges_endpoints, capsys):
+    routing_service, config = service
+    id_pairs = [[edge[0], edge[1]] for edge in edges_endpoints]
+    values = np.arange(len(id_pairs), dtype=np.float64) + 40.0
+    merge_airquality_footpath.notify_routing_service(config, Greeter(), id_pairs, values.tolist())
+
+    assert 'Routing service updated, data version 7' in capsys.readouterr().out
+    graph = routing_service.live.current.graph
+    edges, pairs = graph.edges_between([pair[0] for pair in id_pairs], [pair[1] for pair in id_pairs])
+    assert np.allclose(graph.attributes['pm10'][edges], values[pairs])
+    assert routing_service.live_data_version == 7
+
+
+def test_merge_reports_a_refused_update(service, edges_endpoints, capsys):
+    _, config = service
+    id_pairs = [[edge[0], None] for edge in edges_endpoints]
+    merge_airquality_footpath.notify_routing_service(config, Greeter(), id_pairs, [1.0] * len(id_pairs))
+
+    out = capsys.readouterr().out
+    assert 'status 400' in out and 'Invalid air quality update' in out
+    assert 'not reachable' not in out
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from time_profiles import read_measurements, station_profiles
+
+COORDINATES = "ID_STATION,NAME,LONGITUDE,LATITUDE,ID_AQ_LEGAL_STATION\n" \
+              "1,Parco Ferrari,10.9063267634516,44.6506116841645,9625\n" \
+              "14,Via Alessandro Volta,10.913416,44.645073,\n"
+
+
+@pytest.fixture
+def coords_path(tmp_path):
+    path = tmp_path / "sensor_coordinates.csv"
+    path.write_text(COORDINATES)
+    return path
+
+
+def test_arpae_codes_need_the_station_ids(tmp_path, coords_path):
+    path = tmp_path / "04000002_005_202412.csv"
+    path.write_text("COD_STAZ,ID_PARAM,DATA_FINE,VALORE,VALIDAZIONE\n" +
+                    "".join(f"4000002,5,02/01/2024 {hour:02d}:00,{20 + hour},S\n" for hour in range(24)) +
+                    "4000022,5,02/01/2024 00:00,27,S\n")
+    with pytest.raises(ValueError):
+        read_measurements(path)
+
+    measurements = read_measurements(path, {'4000002': 1})
+    assert set(measurements['station']) == {1}
+    _, _, values = station_profiles(measurements, coords_path, 24)
+    assert np.allclose(values, [20.0 + np.arange(24)])
+
+
+def test_measures_of_a_single_slot(tmp_path, coords_path):
+    path = tmp_path / "measures.csv"
+    path.write_text("ID_STATION,DATE,PARAM,VALUE\n1,2024-02-04,PM10,17\n14,2024-02-04,PM10,39\n")
+    with pytest.raises(ValueError):
+        station_profiles(read_measurements(path), coords_path, 24)
+
+
+def test_measures_missing_in_some_slots(tmp_path, coords_path, capsys):
+    path = tmp_path / "measures.csv"
+    path.write_text("ID_STATION,DATE,PARAM,VALUE\n1,2024-02-04 08:00,PM10,30\n1,2024-02-04 18:00,PM10,10\n")
+    _, _, values = station_profiles(read_measurements(path), coords_path, 24)
+    assert 'cover 2 slots of 24' in capsys.readouterr().out
+    assert values[0, 8] == 30.0 and values[0, 18] == 10.0 and values[0, 0] == 20.0
@@ -0,0 +1,336 @@
+import os
+import sys
+import json
+import time
+import heapq
+import numpy as np
+import pandas as pd
+from routing_engine import RoutingGraph
+from contraction_hierarchy import topology_key
+
+# Seconds of the period covered by the slots: a day up to 24 slots, a week beyond
+DAY = 86400
+WEEK = 7 * DAY
+
+# Slots of pm10_metre kept as lists by a router, a walk spans only a few of them
+CACHED_SLOTS = 4
+
+# Weights of the routing_query.json that depend on the departure time
+TIME_DEPENDENT_WEIGHTS = ['pm10_metre', 'combined_weight']
+
+
+def slot_seconds(slots):
+    """
+    Length in seconds of a slot, when the slots cover a day (up to 24 slots) or a week
+    """
+    return (DAY if slots <= 24 else WEEK) / slots
+
+
+def period_seconds(times, slots):
+    """
+    Seconds since the start of the day (or of the week, starting on Monday) of the given times
+    """
+    times = pd.DatetimeIndex(pd.to_datetime(times))
+    seconds = times.hour * 3600 + times.minute * 60 + times.second
+    if slots > 24:
+        seconds += times.dayofweek * DAY
+    return np.asarray(seconds, dtype=np.float64)
+
+
+def slot_of(times, slots):
+    """
+    Slot of the profiles of the given times
+    """
+    return (period_seconds(times, slots) // slot_seconds(slots)).astype(np.int64) % slots
+
+
+def read_measurements(measures_path, station_ids=None):
+    """
+    Measures of a sensor csv file (ID_STATION, DATE, PARAM, VALUE) or of an ARPAE file
+    (COD_STAZ, ID_PARAM, DATA_FINE, VALORE, VALIDAZIONE), as a DataFrame with the columns station, time and value.
+    The COD_STAZ codes of ARPAE are not the ID_STATION of the sensor coordinates: station_ids maps every code
+    to the ID_STATION of the same station, and the measures of the codes not mapped are left out.
+    """
+    df = pd.read_csv(measures_path)
+    if 'COD_STAZ' in df.columns:
+        if not station_ids:
+            raise ValueError(f"{measures_path} is an ARPAE file, time_profiles.station_ids has to map its COD_STAZ "
+                             f"codes to the ID_STATION of the sensor coordinates")
+        codes = df['COD_STAZ'].astype(np.int64)
+        stations = codes.map({int(code): station for code, station in station_ids.items()})
+        unmapped = sorted(codes[stations.isna()].unique().tolist())
+        if unmapped:
+            print(f"Warning: the ARPAE stations {unmapped} are not in time_profiles.station_ids, their measures "
+                  f"are left out")
+        mapped = stations.notna()
+        return pd.DataFrame({'station': stations[mapped].astype(np.int64),
+                             'time': pd.to_datetime(df['DATA_FINE'][mapped], format='%d/%m/%Y %H:%M'),
+                             'value': pd.to_numeric(df['VALORE'][mapped], errors='coerce')})
+    return pd.DataFrame({'station': df['ID_STATION'], 'time': pd.to_datetime(df['DATE']),
+                         'value': pd.to_numeric(df['VALUE'], errors='coerce')})
+
+
+def station_profiles(measurements, coords_path, slots=24):
+    """
+    Mean PM10 of every station with known coordinates in every slot; the slots without measures take the mean
+    of the station. Returns the longitudes and latitudes of the stations and their stations x slots values.
+    Measures all in one slot (daily values, or a single date) would give flat profiles, the same as the static
+    pm10, and raise a ValueError; measures missing in some of the slots only print a warning.
+    """
+    coordinates = pd.read_csv(coords_path)
+    measurements = measurements.dropna(subset=['value'])
+    measurements = measurements[measurements['station'].isin(coordinates['ID_STATION'])]
+    if measurements.empty:
+        raise ValueError(f"No measures of the stations in {coords_path}")
+
+    measured_slots = slot_of(measurements['time'], slots)
+    distinct_slots = len(np.unique(measured_slots))
+    if distinct_slots < 2:
+        raise ValueError(f"The measures cover a single slot of {slots}, hourly measures are needed for the profiles "
+                         f"to change during the {'day' if slots <= 24 else 'week'}")
+    if distinct_slots < slots:
+        print(f"Warning: the measures cover {distinct_slots} slots of {slots}, the others take the mean of the "
+              f"station")
+
+    means = measurements.assign(slot=measured_slots).pivot_table(
+        index='station', columns='slot', values='value', aggfunc='mean').reindex(columns=range(slots))
+    values = means.to_numpy(dtype=np.float64)
+    values = np.where(np.isnan(values), np.nanmean(values, axis=1, keepdims=True), values)
+
+    coordinates = coordinates.set_index('ID_STATION').loc[means.index]
+    return coordinates['LONGITUDE'].to_numpy(dtype=np.float64), coordinates['LATITUDE'].to_numpy(dtype=np.float64), \
+        values
+
+
+def edge_profiles(graph, station_lon, station_lat, station_values, power=4, points=5, chunk_size=65536):
+    """
+    PM10 profile of every edge: the inverse distance weighting of the station values of every slot, as in the
+    raster of interpolation.py (distances in degrees, every station), averaged over points evenly spaced along
+    the edge. Returns a slots x edges float32 matrix.
+    """
+    profiles = np.empty((station_values.shape[1], graph.edge_count), dtype=np.float32)
+    position = np.linspace(0.0, 1.0, points)
+
+    for start in range(0, graph.edge_count, chunk_size):
+        sources = graph.edge_sources[start:start + chunk_size]
+        targets = graph.indices[start:start + chunk_size]
+        lon = graph.lon[sources][:, None] + position * (graph.lon[targets] - graph.lon[sources])[:, None]
+        lat = graph.lat[sources][:, None] + position * (graph.lat[targets] - graph.lat[sources])[:, None]
+
+        # Normalized weights of the stations at every point, then their mean along the edge
+        distance = np.hypot(lon[:, :, None] - station_lon, lat[:, :, None] - station_lat)
+        weights = 1.0 / np.maximum(distance, 1e-12) ** power
+        weights /= weights.sum(axis=2, keepdims=True)
+        profiles[:, start:start + chunk_size] = (weights.mean(axis=1) @ station_values).T
+
+    return profiles
+
+
+def profiles_path(graph, profile_dir, slots):
+    return os.path.join(profile_dir, f"profiles_{topology_key(graph)}_{slots}.npy")
+
+
+def save_profiles(graph, profiles, profile_dir='./output/time_profiles'):
+    """
+    Save the profiles as a .npy file keyed by the graph topology, slot by slot so that a slot is a contiguous block
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    path = profiles_path(graph, profile_dir, profiles.shape[0])
+    np.save(path, np.ascontiguousarray(profiles, dtype=np.float32))
+    print(f"PM10 profiles saved at {path}")
+    return path
+
+
+def load_profiles(graph, profile_dir='./output/time_profiles', slots=24):
+    """
+    Memory map of the profiles of the graph: the slots are read from the disk only when a query reaches them
+    """
+    path = profiles_path(graph, profile_dir, slots)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode='r')
+
+
+class TimeDependentRouter:
+    """
+    Routing on the PM10 profiles of the edges: the PM10 of an edge is the one of the slot of the time it is reached,
+    walking at the given speed (metres per second) from the departure time.
+    """
+    def __init__(self, graph, profiles, departure=None, speed=1.3):
+        self.graph = graph
+        self.profiles = profiles
+        self.slots = profiles.shape[0]
+        self.departure = departure
+        self.speed = speed
+        self._slot_pm10_metre = {}
+        self._pm10_metre_range = None
+
+    def slot_pm10_metre(self, slot):
+        """
+        pm10_metre of the edges in a slot, as a list for the search loop, read once from the profiles
+        """
+        if slot not in self._slot_pm10_metre:
+            if len(self._slot_pm10_metre) >= CACHED_SLOTS:
+                del self._slot_pm10_metre[next(iter(self._slot_pm10_metre))]
+            pm10 = np.asarray(self.profiles[slot], dtype=np.float64)
+            self._slot_pm10_metre[slot] = (pm10 * self.graph.attributes['distance']).tolist()
+        return self._slot_pm10_metre[slot]
+
+    def pm10_metre_range(self):
+        """
+        Range of pm10_metre over all the slots, used to normalize the combined weight
+        """
+        if self._pm10_metre_range is None:
+            distance = self.graph.attributes['distance'].astype(np.float64)
+            low, high = np.inf, -np.inf
+            for slot in range(self.slots):
+                pm10_metre = np.asarray(self.profiles[slot], dtype=np.float64) * distance
+                low, high = min(low, np.nanmin(pm10_metre)), max(high, np.nanmax(pm10_metre))
+            self._pm10_metre_range = low, high
+        return self._pm10_metre_range
+
+    def check_weight(self, weight):
+        """
+        Raise a ValueError for a weight that does not depend on the time (only pm10_metre and the combined weights
+        of the graph do)
+        """
+        if weight != 'pm10_metre' and weight not in self.graph.combined_weights:
+            raise ValueError(f"The departure algorithm needs the weight pm10_metre or combined_weight, "
+                             f"{weight} does not depend on the time")
+
+    def edge_cost(self, weight):
+        """
+        Function of the pm10_metre of the slot and of the edge giving the cost of the edge for the weight
+        (pm10_metre or a combined weight of the graph)
+        """
+        self.check_weight(weight)
+        if weight == 'pm10_metre':
+            return None
+
+        pm10_ratio, inv_green_area_ratio = self.graph.combined_weights[weight]
+        low, high = self.pm10_metre_range()
+        _, inv_ga_scale = self.graph.combined_weight_scales(pm10_ratio, inv_green_area_ratio)
+        inv_ga = (inv_ga_scale * (self.graph.weight_array('inv_ga_metre') -
+                                  self.graph.combined_weight_stats()['min_inv_ga_metre'])).tolist()
+        scale = pm10_ratio / (high - low) if high > low else 0.0
+        return lambda pm10_metre, edge: scale * (pm10_metre - low) + inv_ga[edge]
+
+    def shortest_path(self, source, target, departure, weight='pm10_metre'):
+        """
+        Time dependent Dijkstra between two dense node indices: every node is reached at the time of its best
+        path, and the edges leaving it are weighted with the PM10 of the slot of that time.
+        Returns the cost, the edges and the arrival time (seconds from the start of the period) at every node of
+        the path, or None if the target is not reachable.
+        Every node is settled once, at its lowest cost: the exposure costs are not FIFO (a dearer path reaching a
+        node later, in another slot, can continue on cleaner edges), so the path is the optimal one when the walk
+        does not cross a slot boundary and otherwise is not guaranteed to be.
+        """
+        graph = self.graph
+        indptr, indices = graph._indptr, graph._indices
+        distance = graph.edge_weights('distance')
+        cost_of = self.edge_cost(weight)
+        length, slots, speed = slot_seconds(self.slots), self.slots, self.speed
+
+        dist = [float('inf')] * graph.node_count
+        arrival = [0.0] * graph.node_count
+        previous_edge = [-1] * graph.node_count
+        settled = bytearray(graph.node_count)
+        dist[source] = 0.0
+        arrival[source] = departure
+        heap = [(0.0, source)]
+        while heap:
+            cost, node = heapq.heappop(heap)
+            if settled[node]:
+                continue
+            if node == target:
+                break
+            settled[node] = 1
+
+            pm10_metre = self.slot_pm10_metre(int(arrival[node] // length) % slots)
+            for edge in range(indptr[node], indptr[node + 1]):
+                next_node = indices[edge]
+                edge_cost = pm10_metre[edge] if cost_of is None else cost_of(pm10_metre[edge], edge)
+                next_cost = cost + edge_cost
+                if next_cost < dist[next_node]:
+                    dist[next_node] = next_cost
+                    arrival[next_node] = arrival[node] + distance[edge] / speed
+                    previous_edge[next_node] = edge
+                    heapq.heappush(heap, (next_cost, next_node))
+
+        if dist[target] == float('inf'):
+            return None
+
+        path_edges = []
+        node = target
+        while node != source:
+            path_edges.append(previous_edge[node])
+            node = graph.edge_sources[previous_edge[node]]
+        path_edges.reverse()
+        times = [departure] + [arrival[graph._indices[edge]] for edge in path_edges]
+        return dist[target], path_edges, times
+
+    def route_at(self, source, target, departure, weight='pm10_metre'):
+        """
+        Path between two RoadJunction ids leaving at the departure time, with the same result of routing_path
+        and the PM10 of the edges at the time they are reached, with their departure and arrival times
+        """
+        start_time = time.time()
+        self.check_weight(weight)
+
+        source_index, target_index = self.graph.index_of(source), self.graph.index_of(target)
+        if source_index is None or target_index is None:
+            return {'error': 'No path found'}
+
+        departure = pd.Timestamp(departure)
+        found = self.shortest_path(source_index, target_index, float(period_seconds([departure], self.slots)[0]),
+                                   weight)
+        if found is None:
+            return {'error': 'No path found'}
+        cost, path_edges, times = found
+
+        path = self.graph.path_result(source, target, cost, path_edges)
+        slots = (np.asarray(times[:-1]) // slot_seconds(self.slots)).astype(np.int64) % self.slots
+        pm10 = np.asarray(self.profiles[slots, path_edges], dtype=np.float64) if path_edges else np.zeros(0)
+        for edge, value in zip(path['edges'], pm10.tolist()):
+            edge['pm10'], edge['pm10_metre'] = value, value * edge['distance']
+        path['pm10'] = float(np.mean(pm10)) if len(pm10) else None
+        path['pm10_metre'] = float(np.sum(pm10 * self.graph.attributes['distance'][path_edges]))
+        path['departure'] = str(departure)
+        path['arrival'] = str(departure + pd.Timedelta(seconds=times[-1] - times[0]))
+        return [time.time() - start_time, path]
+
+    def route(self, source, target, weight='pm10_metre', algorithm='departure'):
+        return self.route_at(source, target, self.departure or pd.Timestamp.now(), weight)
+
+
+def main(config):
+    """
+    Build the PM10 profiles of the edges of the graph from the sensor measures
+    """
+    profile_config = config.get('time_profiles', {})
+    slots = profile_config.get('slots', 24)
+
+    # Neo4j is read only without a graph snapshot
+    graph = RoutingGraph.load(config)
+
+    start_time = time.time()
+    station_lon, station_lat, station_values = station_profiles(
+        read_measurements(profile_config.get('measures_path', config['measures_path']),
+                          profile_config.get('station_ids')),
+        config['sensor_coords_path'], slots)
+    profiles = edge_profiles(graph, station_lon, station_lat, station_values, config['idw']['power'])
+    print(f"Profiles of {slots} slots for {graph.edge_count} edges from {len(station_lon)} stations "
+          f"in {time.time() - start_time:.2f} s")
+
+    return save_profiles(graph, profiles, profile_config.get('profile_dir', './output/time_profiles'))
+
+
+if __name__ == "__main__":
+    with open("data/config.json", "r") as file:
+        config_file = json.load(file)
+
+    try:
+        main(config_file)
+    except Exception as e:
+        print(e)
+        sys.exit(1)